@@ -0,0 +1,262 @@
+#   File:   Benchmarks.py
+#
+#   Brief:  Implement a benchmark suite of the image analysis paths, run from the command line.
+#           Each case is timed over a number of repeats after a few warm-up runs, for each frame size,
+#           and its peak memory is measured with tracemalloc in one more run.
+#           The results are written as JSON with the times of all the repeats and their statistics.
+#           Given a baseline written before, the medians are compared case by case
+#           and the cases that got slower or faster by more than the threshold are reported,
+#           the exit status is 1 if any case got slower.
+#           Before the cases are timed, the sector sums of SectorPowers are checked against the sums over the masks
+#           of MatrixWindows.segmentMasks that they replace, for checkSizes and the frame sizes,
+#           the exit status is 1 if they do not match.
+#
+#           The numpy configuration hides cupy from the modules under test, the cupy configuration needs cupy.
+#
+#   Usage:  python Benchmarks.py [--output results.json] [--compare baseline.json] [options]
+
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import numpy
+
+import FftEngine
+import MatrixWindows
+import SemImage
+import SectorPowers
+import HistogramEqualisation
+import DisplayPreparation
+import FocusEstimator
+from SemController import SemController
+from SemCorrector import SemCorrector
+from SemSimulator import SemSimulator
+
+frameSizes = [(512, 384), (1024, 768), (2048, 1536), (4096, 3072)]
+checkSizes = [(64, 64), (96, 192), (256, 384), (512, 256), (97, 65)]
+_modulesUsingCupy = [FftEngine, MatrixWindows, SemImage, SectorPowers, HistogramEqualisation, DisplayPreparation, FocusEstimator]
+
+def useConfiguration(configuration):
+    if configuration == 'numpy':
+        for module in _modulesUsingCupy:
+            module.cupy = None
+    elif not SemImage.cupy:
+        raise RuntimeError('Benchmarks: could not import cupy, the cupy configuration is not available.')
+    MatrixWindows.clearCache()
+
+def frame(width, height):
+    random = numpy.random.default_rng(0)
+    return random.integers(0, 256, (height, width), dtype='uint8')
+
+def synchronise():
+    if SemImage.cupy:
+        SemImage.cupy.cuda.Device().synchronize()
+
+def semImageCases(width, height):
+    image = frame(width, height)
+    engine = FftEngine.fftEngine(image.shape, onDevice=True)
+
+    def applyHann(engine=None):
+        semImage = SemImage.SemImage(image, engine)
+        return lambda: semImage.applyHann()
+
+    def updateFft(engine=None):
+        semImage = SemImage.SemImage(image, engine)
+        return lambda: semImage.updateFft()
+
+    def updateHalfPower(engine=None):
+        semImage = SemImage.SemImage(image, engine)
+        return lambda: semImage.updateHalfPower()
+
+    def updateHistogram():
+        semImage = SemImage.SemImage(image)
+        return lambda: semImage.updateHistogram()
+
+    def applyHistogramEqualisation():
+        semImage = SemImage.SemImage(image)
+        return lambda: (semImage.setImage(image), semImage.applyHistogramEqualisation())
+
+    def applyHistogramEqualisationInTiles():
+        semImage = SemImage.SemImage(image)
+        return lambda: (semImage.setImage(image), semImage.applyHistogramEqualisationInTiles())
+
+    return {
+        'SemImage.applyHann': applyHann(),
+        'SemImage.applyHann[engine]': applyHann(engine),
+        'SemImage.updateFft': updateFft(),
+        'SemImage.updateFft[engine]': updateFft(engine),
+        'SemImage.updateHalfPower': updateHalfPower(),
+        'SemImage.updateHalfPower[engine]': updateHalfPower(engine),
+        'SemImage.updateHistogram': updateHistogram(),
+        'SemImage.applyHistogramEqualisation': applyHistogramEqualisation(),
+        'SemImage.applyHistogramEqualisationInTiles': applyHistogramEqualisationInTiles(),
+    }
+
+def matrixWindowsCases(width, height):
+    # The cache is cleared before every call, so that the builders are timed and not the look-ups.
+    def uncached(build):
+        return lambda: (MatrixWindows.clearCache(), build())
+
+    return {
+        'MatrixWindows.hann': uncached(lambda: MatrixWindows.hann(height, width)),
+        'MatrixWindows.hannMask': uncached(lambda: MatrixWindows.hannMask(height, width, 0.5)),
+        'MatrixWindows.discMask': uncached(lambda: MatrixWindows.discMask(height, width, 100)),
+        'MatrixWindows.segmentMasks': uncached(lambda: MatrixWindows.segmentMasks(width, height)),
+        'MatrixWindows.sectorLabels': uncached(lambda: MatrixWindows.sectorLabels(width, height)),
+        'MatrixWindows.halfSectorLabels': uncached(lambda: MatrixWindows.halfSectorLabels(width, height)),
+        'MatrixWindows.halfFrequencies': uncached(lambda: MatrixWindows.halfFrequencies(width, height)),
+        'MatrixWindows.halfPolarLabels': uncached(lambda: MatrixWindows.halfPolarLabels(width, height, 16, 16, 0.01, 0.45)),
+    }
+
+def correctorCases(width, height):
+    # One iteration against the simulator, without frame times or waits, so that only the computation is timed.
+    simulator = SemSimulator()
+    simulator.simulatingFrameTime = False
+    corrector = SemCorrector(SemController(simulator))
+    corrector.rasterWidth = width
+    corrector.rasterHeight = height
+    corrector.frameWaitTimeFactor = 0
+    corrector.numberOfIterations = 1
+
+    def iterate():
+        simulator.Set('AP_WD', '5.2')
+        corrector.iterate()
+
+    return {'SemCorrector.iterate': iterate}
+
+def checkSectorPowers(sizes, tolerance=1e-9):
+    # Gives the sizes whose sums, from the full or the half-plane FFT, differ from the mask sums by more than tolerance.
+    failures = []
+    for width, height in sizes:
+        image = frame(width, height).astype('float64')
+        fft = numpy.fft.fftshift(numpy.abs(numpy.fft.fft2(image))**2)
+        halfFft = numpy.fft.fftshift(numpy.abs(numpy.fft.rfft2(image))**2, axes=0)
+        masks = MatrixWindows.segmentMasks(width, height)
+        expected = [fft.sum()] + [fft[mask].sum() for mask in masks]
+        for name, powers in [('sectorPowers', SectorPowers.sectorPowers(fft)), ('halfSectorPowers', SectorPowers.halfSectorPowers(halfFft, width))]:
+            sums = [powers.total, powers.r12, powers.s12, powers.r34, powers.s34]
+            error = max(abs(sum - mask) / mask for sum, mask in zip(sums, expected))
+            if error > tolerance:
+                failures.append((name, width, height))
+                print('Benchmarks: {} {}x{} differs from the mask sums by {:.1e}.'.format(name, width, height, error))
+    if not failures:
+        print('Benchmarks: the sector sums match the mask sums for {} sizes.'.format(len(sizes)))
+    return failures
+
+def statistics(times):
+    times = numpy.asarray(times)
+    return {
+        'minimum': float(times.min()),
+        'median': float(numpy.median(times)),
+        'mean': float(times.mean()),
+        'standardDeviation': float(times.std()),
+        'percentile90': float(numpy.percentile(times, 90)),
+        'maximum': float(times.max()),
+    }
+
+def measure(function, repeats, warmUps):
+    for _ in range(warmUps):
+        function()
+    synchronise()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        synchronise()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    synchronise()
+    peakMemory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return times, peakMemory
+
+def run(configuration='numpy', sizes=None, repeats=20, warmUps=2, nameFilter=None, iterating=True):
+    useConfiguration(configuration)
+    if sizes is None:
+        sizes = frameSizes
+    results = []
+    for width, height in sizes:
+        cases = {}
+        cases.update(semImageCases(width, height))
+        cases.update(matrixWindowsCases(width, height))
+        if iterating:
+            cases.update(correctorCases(width, height))
+        for name, function in cases.items():
+            if nameFilter and nameFilter not in name:
+                continue
+            caseRepeats = max(1, repeats // 4) if name == 'SemCorrector.iterate' else repeats
+            times, peakMemory = measure(function, caseRepeats, warmUps)
+            result = {'name': name, 'configuration': configuration, 'width': width, 'height': height,
+                      'times': times, 'statistics': statistics(times), 'peakMemory': peakMemory}
+            results.append(result)
+            print('Benchmarks: {} {}x{}, median {:.3f} ms, peak memory {:.1f} MB.'.format(
+                name, width, height, result['statistics']['median'] * 1000, peakMemory / 2**20))
+    return {'metadata': metadata(configuration, repeats, warmUps), 'results': results}
+
+def metadata(configuration, repeats, warmUps):
+    return {
+        'configuration': configuration,
+        'repeats': repeats,
+        'warmUps': warmUps,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'cupy': SemImage.cupy.__version__ if SemImage.cupy else None,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+    }
+
+def compare(results, baseline, threshold=0.1):
+    # Gives the cases whose median changed by more than threshold, as a fraction of the baseline.
+    key = lambda result: (result['name'], result['configuration'], result['width'], result['height'])
+    baselineResults = {key(result): result for result in baseline['results']}
+    changes = []
+    for result in results['results']:
+        before = baselineResults.get(key(result))
+        if before is None:
+            continue
+        ratio = result['statistics']['median'] / before['statistics']['median']
+        if abs(ratio - 1) > threshold:
+            changes.append((key(result), ratio))
+            print('Benchmarks: {} {}x{} is {} by {:.0%}, median {:.3f} ms, was {:.3f} ms.'.format(
+                result['name'], result['width'], result['height'], 'slower' if ratio > 1 else 'faster', abs(ratio - 1),
+                result['statistics']['median'] * 1000, before['statistics']['median'] * 1000))
+    if not changes:
+        print('Benchmarks: no change beyond {:.0%} from the baseline.'.format(threshold))
+    return changes
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Benchmark the image analysis paths.')
+    parser.add_argument('--output', default='benchmarks.json', help='JSON file of the results')
+    parser.add_argument('--compare', default=None, help='JSON file of baseline results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change of the median reported by the comparison')
+    parser.add_argument('--configuration', choices=['numpy', 'cupy'], default='numpy')
+    parser.add_argument('--sizes', nargs='+', default=None, help='frame sizes as WIDTHxHEIGHT')
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--warm-ups', type=int, default=2)
+    parser.add_argument('--filter', default=None, help='only run the cases whose names contain this')
+    parser.add_argument('--no-iterate', action='store_true', help='skip SemCorrector.iterate')
+    arguments = parser.parse_args(arguments)
+
+    sizes = None
+    if arguments.sizes:
+        sizes = [tuple(int(n) for n in size.lower().split('x')) for size in arguments.sizes]
+    useConfiguration(arguments.configuration)
+    if checkSectorPowers(checkSizes + (sizes or frameSizes)):
+        return 1
+    results = run(arguments.configuration, sizes, arguments.repeats, arguments.warm_ups, arguments.filter, not arguments.no_iterate)
+    with open(arguments.output, 'w') as file:
+        json.dump(results, file, indent=1)
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            baseline = json.load(file)
+        if any(ratio > 1 for _, ratio in compare(results, baseline, arguments.threshold)):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+#   File:   CommandQueue.py
+#
+#   Brief:  Implement the CommandQueue class, which runs commands one at a time on a single owner thread.
+#           Any thread submits a command and gets a concurrent.futures.Future of its result back.
+#           Waiting commands run in order of priority, highPriority first, and in the order they were submitted
+#           within a priority. A command that has not started can be cancelled through its future,
+#           or with all the other waiting commands of its priority, optionally only those submitted by one thread.
+#           A command called from the owner thread runs at once, so commands can call other commands.
+#           initialise is called on the owner thread before the first command, for example to set up COM on it.
+
+import time
+import heapq
+import itertools
+import logging
+import threading
+import concurrent.futures
+
+logger = logging.getLogger('CommandQueue')
+
+class CommandQueue:
+
+    highPriority = 0
+    normalPriority = 1
+    lowPriority = 2
+
+    def __init__(self, initialise=None):
+        self.executed = 0
+        self.cancelled = 0
+
+        self._initialise = initialise
+        self._commands = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+        self._waits = {}
+        self._thread = None
+        self._closed = False
+
+    def __len__(self):
+        with self._condition:
+            return len(self._commands)
+
+    def onOwnerThread(self):
+        return threading.current_thread() is self._thread
+
+    def submit(self, function, *args, priority=normalPriority, **kwargs):
+        future = concurrent.futures.Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('CommandQueue: the queue is closed.')
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._runCommands, daemon=True)
+                self._thread.start()
+            command = (priority, next(self._order), time.perf_counter(), future, function, args, kwargs, threading.current_thread())
+            heapq.heappush(self._commands, command)
+            self._condition.notify()
+        return future
+
+    def call(self, function, *args, priority=normalPriority, **kwargs):
+        # Run a command and wait for its result, raises CancelledError if it is cancelled before it runs.
+        if self.onOwnerThread():
+            return function(*args, **kwargs)
+        return self.submit(function, *args, priority=priority, **kwargs).result()
+
+    def cancel(self, priority=None, thread=None):
+        # Cancel the waiting commands of one priority, or all of them, the running command is left to finish.
+        # With a thread, only the commands submitted by that thread are cancelled.
+        with self._condition:
+            kept = []
+            for command in self._commands:
+                if (priority is None or command[0] == priority) and (thread is None or command[7] is thread):
+                    command[3].cancel()
+                    self.cancelled += 1
+                else:
+                    kept.append(command)
+            cancelled = len(self._commands) - len(kept)
+            heapq.heapify(kept)
+            self._commands = kept
+        return cancelled
+
+    def waitTimes(self):
+        # Count, mean and maximum time in s the commands waited in the queue, by priority.
+        with self._condition:
+            return {priority: {'count': count, 'mean': total / count, 'maximum': maximum}
+                    for priority, (count, total, maximum) in self._waits.items()}
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self.cancel()
+        if self._thread is not None and not self.onOwnerThread():
+            self._thread.join()
+
+    def _runCommands(self):
+        if self._initialise is not None:
+            try:
+                self._initialise()
+            except Exception as error:
+                logger.error('CommandQueue: could not initialise the owner thread, %s.', error)
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._commands or self._closed)
+                if not self._commands:
+                    return
+                priority, _, submitted, future, function, args, kwargs, _ = heapq.heappop(self._commands)
+                if not future.set_running_or_notify_cancel():
+                    self.cancelled += 1
+                    continue
+                wait = time.perf_counter() - submitted
+                count, total, maximum = self._waits.get(priority, (0, 0.0, 0.0))
+                self._waits[priority] = (count + 1, total + wait, max(maximum, wait))
+            try:
+                future.set_result(function(*args, **kwargs))
+            except BaseException as error:
+                future.set_exception(error)
+            with self._condition:
+                self.executed += 1
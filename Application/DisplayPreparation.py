@@ -0,0 +1,52 @@
+#   File:   DisplayPreparation.py
+#
+#   Brief:  Implement functions that turn images and spectra into small integer arrays ready to be drawn.
+#           Frames are reduced by the smallest integer factor that fits them into the display, averaging blocks of pixels,
+#           then quantised, so that with cupy only display-sized arrays are copied back to the host.
+#           The functions take numpy or cupy arrays and return arrays of the same kind.
+
+import numpy
+
+try:
+    import cupy
+except:
+    cupy = None
+
+def reductionFactor(width, height, displayWidth, displayHeight):
+    if displayWidth <= 0 or displayHeight <= 0:
+        return 1
+    return max(1, width // displayWidth, height // displayHeight)
+
+def downsample(array, factor):
+    if factor == 1:
+        return array
+    height = array.shape[0] // factor
+    width = array.shape[1] // factor
+    blocks = array[:height * factor, :width * factor].reshape(height, factor, width, factor)
+    return blocks.mean(axis=(1, 3), dtype='float32')
+
+def prepareImage(image, displayWidth, displayHeight):
+    xp = _arrayModule(image)
+    factor = reductionFactor(image.shape[1], image.shape[0], displayWidth, displayHeight)
+    if factor == 1 and image.dtype == 'uint8':
+        return image
+    image = xp.clip(downsample(image, factor), 0, 255)
+    return xp.rint(image).astype('uint8')
+
+def prepareSpectrum(spectrum, displayWidth, displayHeight, logScale=True):
+    # Log-scaled spectra are stretched over 8 bits, the others are clipped to 16 bits.
+    xp = _arrayModule(spectrum)
+    factor = reductionFactor(spectrum.shape[1], spectrum.shape[0], displayWidth, displayHeight)
+    spectrum = downsample(spectrum, factor)
+    if not logScale:
+        return xp.clip(spectrum, 0, 65535).astype('uint16')
+    spectrum = xp.log1p(spectrum, dtype='float32')
+    peak = float(spectrum.max())
+    if peak > 0:
+        spectrum *= 255 / peak
+    return spectrum.astype('uint8')
+
+def _arrayModule(array):
+    if cupy:
+        return cupy.get_array_module(array)
+    return numpy
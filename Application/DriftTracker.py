@@ -0,0 +1,215 @@
+#   File:   DriftTracker.py
+#
+#   Brief:  Implement the DriftTracker class, which follows the drift of a stream of frames by phase correlation.
+#           Each frame is correlated with the previous frame, or with a reference frame if comparingWithReference,
+#           using the half spectrum its SemImage already computed for halfPower, so a frame costs one inverse FFT.
+#           The peak of the correlation is refined to a fraction of a pixel along each axis from its two neighbours.
+#           A sharp peak, as given by clean images, is sinc-shaped with one neighbour below zero and is refined from its larger
+#           neighbour (Foroosh, Zerubia and Berthod, 2002). The peak of noisy images is broadened, with both neighbours
+#           above zero, and is refined with a parabola through the logarithms of the three samples, as for a Gaussian.
+#           The drift of a frame is its shift from the previous frame in pixels, positive to the right and down,
+#           and the position is the sum of the drifts since the first frame, or the shift from the reference.
+#           Frames should be given in the order they were grabbed, with the time they were grabbed.
+#           Given their sequence numbers, driftPerFrame is the drift divided by the frames since the previous frame,
+#           so frames may be skipped, and a frame older than the previous one is ignored.
+#           A frame is reliable if its correlation peak is at least minimumPeakHeight, 1 being a perfect match.
+#           Strongly defocused or featureless frames are not, their drift cannot be measured.
+#           The stream is stable after stableFrames reliable frames in a row that drifted by at most stabilityThreshold.
+#           The last historyLength frames are kept in the history.
+
+import time
+import logging
+import threading
+from collections import deque
+import numpy
+
+try:
+    import cupy
+except:
+    cupy = None
+
+try:
+    from scipy import fft as realFft
+except:
+    realFft = numpy.fft
+
+logger = logging.getLogger('DriftTracker')
+
+class DriftTracker:
+
+    def __init__(self):
+        self.comparingWithReference = False
+        self.stabilityThreshold = 0.25 # In pixels.
+        self.stableFrames = 3
+        self.minimumPeakHeight = 0.1
+        self.historyLength = 1000
+
+        self.driftPerFrame = 0.0 # In pixels.
+        self.driftRate = 0.0 # In pixels per s.
+        self.peakHeight = 0.0
+        self.reliable = False
+        self.stable = False
+
+        self._reference = None
+        self._spare = None
+        self._shape = None
+        self._time = None
+        self._sequence = None
+        self._position = (0.0, 0.0)
+        self._stableCount = 0
+        self._history = deque(maxlen=self.historyLength)
+        self._lock = threading.Lock()
+
+    def update(self, semImage, timestamp=None, sequence=None):
+        # The image should be the same size as the previous ones, a new size starts the tracking again.
+        spectrum, shape = self.spectrumOf(semImage)
+        return self.updateSpectrum(spectrum, shape, timestamp, sequence)
+
+    def spectrumOf(self, semImage):
+        # The half spectrum of the image and the shape of the image, computed if the image has not computed it yet.
+        if cupy:
+            return semImage.halfSpectrum(returnCupy=True), semImage.image(returnCupy=True).shape
+        return semImage.halfSpectrum(), semImage.image().shape
+
+    def updateSpectrum(self, spectrum, shape, timestamp=None, sequence=None):
+        # Gives the entry of the frame in the history, None for the first frame and for a frame older than the previous one.
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        with self._lock:
+            if self._reference is None or self._shape != tuple(shape) or self._reference.shape != spectrum.shape:
+                self._start(spectrum, shape, timestamp, sequence)
+                return None
+            frames = 1
+            if sequence is not None and self._sequence is not None:
+                frames = sequence - self._sequence
+                if frames <= 0:
+                    return None
+            self._sequence = sequence
+
+            shiftY, shiftX, peakHeight = phaseCorrelation(spectrum, self._reference, self._shape)
+            if self.comparingWithReference:
+                driftX = shiftX - self._position[0]
+                driftY = shiftY - self._position[1]
+                self._position = (shiftX, shiftY)
+            else:
+                driftX = shiftX
+                driftY = shiftY
+                self._position = (self._position[0] + shiftX, self._position[1] + shiftY)
+                self._keep(spectrum)
+
+            drift = float(numpy.hypot(driftX, driftY))
+            interval = timestamp - self._time
+            self._time = timestamp
+            reliable = peakHeight >= self.minimumPeakHeight
+            if reliable and drift / frames <= self.stabilityThreshold:
+                self._stableCount += 1
+            else:
+                self._stableCount = 0
+
+            self.driftPerFrame = drift / frames
+            self.driftRate = drift / interval if interval > 0 else 0.0
+            self.peakHeight = peakHeight
+            self.reliable = reliable
+            self.stable = self._stableCount >= self.stableFrames
+
+            entry = {'time': timestamp, 'driftX': driftX, 'driftY': driftY, 'positionX': self._position[0], 'positionY': self._position[1],
+                     'peakHeight': peakHeight, 'reliable': reliable, 'stable': self.stable}
+            if self._history.maxlen != self.historyLength:
+                self._history = deque(self._history, maxlen=max(self.historyLength, 1))
+            self._history.append(entry)
+            return entry
+
+    def position(self):
+        # In pixels, (x, y).
+        with self._lock:
+            return self._position
+
+    def history(self):
+        with self._lock:
+            return list(self._history)
+
+    def reset(self):
+        with self._lock:
+            self._reference = None
+            self._shape = None
+            self._time = None
+            self._sequence = None
+            self._position = (0.0, 0.0)
+            self._stableCount = 0
+            self._history.clear()
+            self.driftPerFrame = 0.0
+            self.driftRate = 0.0
+            self.peakHeight = 0.0
+            self.reliable = False
+            self.stable = False
+
+    def _start(self, spectrum, shape, timestamp, sequence):
+        self._spare = None
+        self._shape = tuple(shape)
+        self._time = timestamp
+        self._sequence = sequence
+        self._position = (0.0, 0.0)
+        self._stableCount = 0
+        self.stable = False
+        self._keep(spectrum)
+
+    def _keep(self, spectrum):
+        # The spectrum may be a buffer of an FftEngine, so it is copied, into the array of the frame before last.
+        if self._spare is None or self._spare.shape != spectrum.shape:
+            xp = cupy.get_array_module(spectrum) if cupy else numpy
+            self._spare = xp.empty_like(spectrum)
+        self._spare[...] = spectrum
+        self._reference, self._spare = self._spare, self._reference
+
+    def guiReset(self):
+        self.reset()
+
+    def guiPrintHistory(self):
+        for entry in self.history()[-10:]:
+            logger.info('DriftTracker: drift (%(driftX).2f, %(driftY).2f) px, position (%(positionX).2f, %(positionY).2f) px, '
+                        'peak %(peakHeight).2f, reliable %(reliable)s, stable %(stable)s.', entry)
+
+def phaseCorrelation(spectrum, referenceSpectrum, shape):
+    # Gives the shift (y, x) in pixels of the image of spectrum from that of referenceSpectrum and the height of the peak,
+    # both spectra being unshifted real-input FFTs of images of shape.
+    xp = cupy.get_array_module(spectrum) if cupy else numpy
+    crossPower = spectrum * xp.conj(referenceSpectrum)
+    magnitude = xp.abs(crossPower)
+    magnitude += 1e-12
+    crossPower /= magnitude
+    if xp is numpy:
+        correlation = realFft.irfft2(crossPower, s=shape)
+    else:
+        correlation = cupy.fft.irfft2(crossPower, s=shape)
+
+    height, width = shape
+    peak = int(correlation.argmax())
+    y, x = divmod(peak, width)
+    rows = xp.asarray([(y - 1) % height, y, (y + 1) % height])
+    columns = xp.asarray([(x - 1) % width, x, (x + 1) % width])
+    neighbours = correlation[rows[:, None], columns[None, :]]
+    if xp is not numpy:
+        neighbours = cupy.asnumpy(neighbours)
+    neighbours = neighbours.astype('float64')
+
+    shiftY = y + _subpixelOffset(*neighbours[:, 1])
+    shiftX = x + _subpixelOffset(*neighbours[1, :])
+    if shiftY > height / 2:
+        shiftY -= height
+    if shiftX > width / 2:
+        shiftX -= width
+    return float(shiftY), float(shiftX), float(neighbours[1, 1])
+
+def _subpixelOffset(before, peak, after):
+    # Offset of the peak from the middle sample, within one sample.
+    if peak <= 0:
+        return 0.0
+    if before > 0 and after > 0:
+        before, peak, after = numpy.log([before, peak, after])
+        curvature = before - 2 * peak + after
+        if curvature >= 0:
+            return 0.0
+        return float(numpy.clip(0.5 * (before - after) / curvature, -0.5, 0.5))
+    if after >= before:
+        return after / (after + peak) if after > 0 else 0.0
+    return -before / (before + peak) if before > 0 else 0.0
@@ -0,0 +1,131 @@
+#   File:   FftEngine.py
+#
+#   Brief:  Implement the FftEngine class, which runs the FFTs of frames of one shape.
+#           An engine keeps its FFT plan and pools of output buffers, so that frames of a fixed raster size
+#           do not set up plans or allocate arrays for every frame.
+#           The buffers of a pool are handed out in turn, a buffer is reused after poolSize more requests,
+#           so a frame stays valid while the following poolSize - 1 frames are processed.
+#           Engines are not shared between threads, fftEngine gives each thread its own.
+#           The shape may also be that of a stack of frames (N, H, W), which are transformed together over the last two axes.
+
+import os
+import threading
+import numpy
+
+try:
+    import cupy
+    import cupyx.scipy.fft
+except:
+    cupy = None
+
+try:
+    from scipy import fft as scipyFft
+except:
+    scipyFft = None
+
+_numpyFftTakesOut = int(numpy.__version__.split('.')[0]) >= 2
+_engines = threading.local()
+
+def fftEngine(shape, onDevice=False):
+    if not hasattr(_engines, 'engines'):
+        _engines.engines = {}
+    key = (tuple(shape), bool(cupy) and onDevice)
+    if key not in _engines.engines:
+        _engines.engines[key] = FftEngine(*key)
+    return _engines.engines[key]
+
+class FftEngine:
+
+    def __init__(self, shape, onDevice=False):
+        self.shape = tuple(shape)
+        self.halfShape = self.shape[:-1] + (self.shape[-1] // 2 + 1,)
+        self.rowAxis = len(self.shape) - 2
+        self.onDevice = bool(cupy) and onDevice
+        self.poolSize = 3
+        self.workers = os.cpu_count() or 1
+
+        self._xp = cupy if self.onDevice else numpy
+        self._pools = {}
+        self._fftPlan = None
+        self._rfftPlan = None
+        if self.onDevice:
+            self._fftPlan = cupyx.scipy.fft.get_fft_plan(self.buffer('spectrum', self.shape, 'complex64'), axes=(-2, -1), value_type='C2C')
+            self._rfftPlan = cupyx.scipy.fft.get_fft_plan(self.buffer('windowed', self.shape, 'float32'), axes=(-2, -1), value_type='R2C')
+
+    def buffer(self, name, shape=None, dtype='float32'):
+        if shape is None:
+            shape = self.shape
+        key = (name, tuple(shape), dtype)
+        if key not in self._pools:
+            self._pools[key] = [[self._xp.empty(shape, dtype=dtype) for _ in range(self.poolSize)], 0]
+        pool = self._pools[key]
+        buffer = pool[0][pool[1]]
+        pool[1] = (pool[1] + 1) % len(pool[0])
+        return buffer
+
+    def fft2(self, image):
+        spectrum = self.buffer('spectrum', self.shape, 'complex64')
+        if self.onDevice:
+            spectrum[...] = image
+            with self._fftPlan:
+                return cupy.fft.fft2(spectrum)
+        if scipyFft:
+            spectrum.real[...] = image
+            spectrum.imag[...] = 0
+            fft = scipyFft.fft2(spectrum, overwrite_x=True, workers=self.workers)
+            if fft is not spectrum and not numpy.shares_memory(fft, spectrum):
+                spectrum[...] = fft
+            return spectrum
+        if _numpyFftTakesOut:
+            return numpy.fft.fft2(image.astype('float32', copy=False), out=spectrum)
+        spectrum[...] = numpy.fft.fft2(image)
+        return spectrum
+
+    def rfft2(self, image):
+        image = image.astype('float32', copy=False)
+        if self.onDevice:
+            with self._rfftPlan:
+                return cupy.fft.rfft2(image)
+        if scipyFft:
+            # The real-input FFT of scipy cannot write into a buffer, copying its result into one would only add a copy.
+            return scipyFft.rfft2(image, workers=self.workers)
+        spectrum = self.buffer('halfSpectrum', self.halfShape, 'complex64')
+        if _numpyFftTakesOut:
+            return numpy.fft.rfft2(image, out=spectrum)
+        spectrum[...] = numpy.fft.rfft2(image)
+        return spectrum
+
+    def fft(self, image, out=None):
+        if out is None:
+            out = self.buffer('fft', self.shape, 'float32')
+        shiftedAbs(self.fft2(image), out, (self.rowAxis, self.rowAxis + 1))
+        return out
+
+    def halfPower(self, image, out=None):
+        return self.halfPowerOf(self.rfft2(image), out)
+
+    def halfPowerOf(self, spectrum, out=None):
+        # The power of a spectrum already given by rfft2.
+        if out is None:
+            out = self.buffer('halfPower', self.halfShape, 'float32')
+        shiftedAbs(spectrum, out, (self.rowAxis,), squared=True)
+        return out
+
+def shiftedAbs(spectrum, out, axes, squared=False):
+    # Write abs(fftshift(spectrum, axes)) into out, one block at a time, without temporaries.
+    xp = cupy.get_array_module(spectrum) if cupy else numpy
+    blocks = [((), ())]
+    for axis in range(spectrum.ndim):
+        n = spectrum.shape[axis]
+        if axis in axes:
+            half = n // 2
+            pairs = [(slice(0, n - half), slice(half, n)), (slice(n - half, n), slice(0, half))]
+        else:
+            pairs = [(slice(None), slice(None))]
+        blocks = [(source + (s,), target + (t,)) for source, target in blocks for s, t in pairs]
+    for source, target in blocks:
+        block = out[target]
+        xp.abs(spectrum[source], out=block)
+        if squared:
+            xp.square(block, out=block)
+    return out
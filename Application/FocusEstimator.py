@@ -0,0 +1,135 @@
+#   File:   FocusEstimator.py
+#
+#   Brief:  Implement the FocusEstimator class, which estimates the errors of the working distance and the stigmators
+#           from one pair of underfocused and overfocused images.
+#
+#           The probe is modelled as a Gaussian with covariance (d * I + A)^2 + p * I, in pixels, where d is the defocus
+#           and A = [[a, b], [b, -a]] is the astigmatism.
+#           Taking the images at defocus d - o and d + o, the log ratio of their FFT powers at frequency f is
+#               log(P_of / P_uf) = -16 pi^2 o (d |f|^2 + a (fx^2 - fy^2) + 2 b fx fy),
+#           which is linear in d, a and b, so they are found by least squares over polar bins of the spectra.
+#           The power of the frequencies beyond maximumFrequency is taken as the noise floor and subtracted.
+#
+#           defocusBlur and astigmatismBlur convert the working distance and the stigmators into pixels of blur
+#           at full resolution, they need to be calibrated for the microscope and magnification.
+#           stigmatorAngle is the angle between the axes of the stigmators and the axes of the image.
+#
+#           Errors within workingDistanceTolerance and stigmatorTolerance are small enough to be left uncorrected.
+#           The standard errors of the estimated errors are taken from the covariance of the fit,
+#           the confidence is 1 when they are zero and falls to 0.5 when the largest of them reaches its tolerance.
+#           Far from the focus the images keep too few frequencies for the model to hold,
+#           so the confidence is 0 when the estimated working distance error is beyond trustRegion offsets.
+
+import math
+import numpy
+
+import MatrixWindows
+
+try:
+    import cupy
+except:
+    cupy = None
+
+class FocusEstimate:
+
+    def __init__(self, workingDistance=0.0, stigmatorX=0.0, stigmatorY=0.0, confidence=0.0,
+                 workingDistanceError=math.inf, stigmatorXError=math.inf, stigmatorYError=math.inf):
+        # Errors from the best settings and their standard errors, in mm and per cent.
+        self.workingDistance = workingDistance
+        self.stigmatorX = stigmatorX
+        self.stigmatorY = stigmatorY
+        self.confidence = confidence
+        self.workingDistanceError = workingDistanceError
+        self.stigmatorXError = stigmatorXError
+        self.stigmatorYError = stigmatorYError
+
+class FocusEstimator:
+
+    def __init__(self):
+        self.defocusBlur = 100.0 # In pixels per mm.
+        self.astigmatismBlur = 0.2 # In pixels per per cent.
+        self.stigmatorAngle = 0.0 # In degrees.
+
+        self.radialBins = 64
+        self.angularBins = 16
+        self.minimumFrequency = 0.01 # In cycles per pixel.
+        self.maximumFrequency = 0.45 # In cycles per pixel.
+        self.signalToNoise = 2.0
+        self.minimumBins = 8
+
+        self.workingDistanceTolerance = 0.005 # In mm.
+        self.stigmatorTolerance = 1.0 # In per cent.
+        self.trustRegion = 1.5 # In working distance offsets.
+
+        self._geometries = {}
+
+    def polarPowers(self, halfPower, width):
+        # Sum a half-plane power spectrum (see SemImage.halfPower) over the polar bins, the noise region and the rest.
+        height = halfPower.shape[0]
+        onDevice = cupy is not None and isinstance(halfPower, cupy.ndarray)
+        labels = MatrixWindows.halfPolarLabels(width, height, self.radialBins, self.angularBins, self.minimumFrequency, self.maximumFrequency, onDevice)
+        xp = cupy.get_array_module(halfPower) if cupy else numpy
+        bins = self.radialBins * self.angularBins
+        sums = xp.bincount(labels.ravel(), weights=halfPower.ravel(), minlength=bins + 2)
+        if xp is not numpy:
+            sums = cupy.asnumpy(sums)
+        return sums
+
+    def estimate(self, polarPowersUf, polarPowersOf, width, height, offset, scale=1.0):
+        # offset is the working distance offset of the images in mm and scale the size of a pixel relative to full resolution.
+        counts, regressors = self._geometry(width, height)
+        bins = self.radialBins * self.angularBins
+
+        meansUf = polarPowersUf[:bins] / numpy.maximum(counts[:bins], 1)
+        meansOf = polarPowersOf[:bins] / numpy.maximum(counts[:bins], 1)
+        noiseUf = polarPowersUf[bins] / max(counts[bins], 1)
+        noiseOf = polarPowersOf[bins] / max(counts[bins], 1)
+        signalsUf = meansUf - noiseUf
+        signalsOf = meansOf - noiseOf
+        valid = (counts[:bins] > 0) & (signalsUf > self.signalToNoise * noiseUf) & (signalsOf > self.signalToNoise * noiseOf)
+        if valid.sum() < self.minimumBins:
+            return FocusEstimate()
+
+        ratios = numpy.log(signalsOf[valid] / signalsUf[valid])
+        weights = numpy.sqrt(counts[:bins][valid])
+        design = regressors[valid] * weights[:, None]
+        coefficients, _, rank, _ = numpy.linalg.lstsq(design, ratios * weights, rcond=None)
+        if rank < 3:
+            return FocusEstimate()
+        residuals = ratios * weights - design @ coefficients
+        covariance = numpy.linalg.inv(design.T @ design) * (residuals**2).sum() / (len(ratios) - 3)
+
+        # Convert d, a and b into the errors of the working distance and the stigmators, along with their covariance.
+        pixelsPerMm = self.defocusBlur / scale
+        pixelsPerPerCent = self.astigmatismBlur / scale
+        factor = -16 * math.pi**2 * pixelsPerMm * offset
+        angle = math.radians(2 * self.stigmatorAngle)
+        transform = numpy.array([[1 / pixelsPerMm, 0, 0],
+                                 [0, math.cos(angle) / pixelsPerPerCent, math.sin(angle) / pixelsPerPerCent],
+                                 [0, -math.sin(angle) / pixelsPerPerCent, math.cos(angle) / pixelsPerPerCent]]) / factor
+        workingDistance, stigmatorX, stigmatorY = (float(e) for e in transform @ coefficients)
+        workingDistanceError, stigmatorXError, stigmatorYError = (float(e) for e in numpy.sqrt(numpy.diag(transform @ covariance @ transform.T)))
+
+        relativeError = max(workingDistanceError / self.workingDistanceTolerance, stigmatorXError / self.stigmatorTolerance, stigmatorYError / self.stigmatorTolerance)
+        confidence = 1 / (1 + relativeError**2)
+        if abs(workingDistance) > self.trustRegion * offset:
+            confidence = 0.0
+        return FocusEstimate(workingDistance, stigmatorX, stigmatorY, confidence, workingDistanceError, stigmatorXError, stigmatorYError)
+
+    def _geometry(self, width, height):
+        # Pixel counts and mean regressors |f|^2, fx^2 - fy^2 and 2 fx fy of the polar bins.
+        key = (width, height, self.radialBins, self.angularBins, self.minimumFrequency, self.maximumFrequency)
+        if key not in self._geometries:
+            labels = MatrixWindows.halfPolarLabels(width, height, self.radialBins, self.angularBins, self.minimumFrequency, self.maximumFrequency)
+            if not isinstance(labels, numpy.ndarray):
+                labels = cupy.asnumpy(labels)
+            fy, fx = MatrixWindows.halfFrequencies(width, height)
+            bins = self.radialBins * self.angularBins
+            labels = labels.ravel()
+            counts = numpy.bincount(labels, minlength=bins + 2).astype('float64')
+            regressors = numpy.empty((bins, 3))
+            for i, values in enumerate((fx**2 + fy**2, fx**2 - fy**2, 2 * fx * fy)):
+                sums = numpy.bincount(labels, weights=numpy.broadcast_to(values, (height, fx.shape[1])).ravel(), minlength=bins + 2)
+                regressors[:, i] = sums[:bins] / numpy.maximum(counts[:bins], 1)
+            self._geometries[key] = (counts, regressors)
+        return self._geometries[key]
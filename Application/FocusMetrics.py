@@ -0,0 +1,230 @@
+#   File:   FocusMetrics.py
+#
+#   Brief:  Implement a command line tool that computes focus metrics of a folder of images or of a recorded session.
+#           For each image it computes the sector powers used by SemCorrector, the energy of the FFT
+#           and statistics of the histogram, and writes them as one row of a CSV or Parquet file.
+#           The histogram is taken in the grey levels of the image, which must be 8 or 16-bit.
+#           The images are split into chunks that are analysed by a pool of processes,
+#           and the rows are written as the chunks finish, in the order of the images.
+#           No Qt module is imported, so the tool runs without a display.
+#
+#   Usage:  python FocusMetrics.py <folder or session> <output.csv or output.parquet> [options]
+
+import os
+import sys
+import csv
+import glob
+import argparse
+import concurrent.futures
+import numpy
+from PIL import Image
+
+import SectorPowers
+from ImageSequence import mapTiff
+from SemImage import SemImage
+from SessionRecorder import SessionPlayback
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except:
+    pyarrow = None
+
+metadataColumns = ['workingDistance', 'stigmatorX', 'stigmatorY', 'frameTime']
+metricColumns = ['total', 'r12', 's12', 'r34', 's34', 'fftEnergy',
+                 'mean', 'standardDeviation', 'minimum', 'maximum', 'percentile1', 'percentile99',
+                 'entropy', 'underexposed', 'overexposed']
+columns = ['index', 'source', 'width', 'height'] + metadataColumns + metricColumns
+
+class MetricOptions:
+
+    # The defaults are those of SemCorrector, discMaskRadius is in pixels of a frame rasterWidth wide.
+    def __init__(self):
+        self.applyHann = True
+        self.applyDiscMask = False
+        self.usingRealFft = False
+        self.discMaskRadius = 100
+        self.rasterWidth = 1024
+        self.radialBins = 1
+
+def isSession(path):
+    return os.path.exists(os.path.join(path, 'index.jsonl'))
+
+def listImages(folder, pattern='*.tif'):
+    return sorted(glob.glob(os.path.join(glob.escape(folder), pattern)))
+
+def readImage(path):
+    image = mapTiff(path) if path.lower().endswith(('.tif', '.tiff')) else None
+    if image is not None:
+        return image
+    with Image.open(path) as image:
+        return numpy.asarray(image.convert('L'))
+
+def imageMetrics(image, options):
+    image = numpy.asarray(image)
+    height, width = image.shape
+    metrics = {'width': width, 'height': height}
+
+    semImage = SemImage(image)
+    semImage.bitDepth = bitDepth(image)
+    counts, _ = semImage.histogram()
+    metrics.update(histogramStatistics(numpy.asarray(counts, dtype='float64')))
+
+    if options.applyHann:
+        semImage.applyHann()
+    radius = options.discMaskRadius * width / options.rasterWidth if options.applyDiscMask else None
+    if options.usingRealFft:
+        powers = SectorPowers.halfSectorPowers(semImage.halfFft(), width, radius, options.radialBins)
+    else:
+        powers = SectorPowers.sectorPowers(semImage.fft(), radius, options.radialBins)
+    metrics.update({name: float(getattr(powers, name)) for name in ('total', 'r12', 's12', 'r34', 's34')})
+
+    # The energy of the full plane, the half-plane columns that stand for two frequencies are counted twice.
+    halfPower = semImage.halfPower()
+    weights = numpy.full(halfPower.shape[1], 2.0)
+    weights[0] = 1
+    if width % 2 == 0:
+        weights[-1] = 1
+    metrics['fftEnergy'] = float((halfPower.sum(axis=0, dtype='float64') * weights).sum())
+    return metrics
+
+def bitDepth(image):
+    # The histogram statistics are in grey levels of the image, 8 or 16-bit.
+    if image.dtype == 'uint8':
+        return 8
+    if image.dtype == 'uint16':
+        return 16
+    raise ValueError('FocusMetrics: images must be 8 or 16-bit unsigned integers, not {}.'.format(image.dtype))
+
+def histogramStatistics(counts):
+    levels = numpy.arange(len(counts))
+    total = counts.sum()
+    if total == 0:
+        return {}
+    probabilities = counts / total
+    mean = (levels * probabilities).sum()
+    cumulative = numpy.cumsum(probabilities)
+    nonZero = probabilities[probabilities > 0]
+    occupied = numpy.nonzero(counts)[0]
+    return {
+        'mean': float(mean),
+        'standardDeviation': float(numpy.sqrt(((levels - mean)**2 * probabilities).sum())),
+        'minimum': int(occupied[0]),
+        'maximum': int(occupied[-1]),
+        'percentile1': int(numpy.searchsorted(cumulative, 0.01)),
+        'percentile99': int(numpy.searchsorted(cumulative, 0.99)),
+        'entropy': float(-(nonZero * numpy.log2(nonZero)).sum()),
+        'underexposed': float(probabilities[0]),
+        'overexposed': float(probabilities[-1]),
+    }
+
+_sessions = {}
+
+def analyseChunk(source, items, options):
+    # Runs in a worker process, items are image paths for a folder and frame indices for a session.
+    rows = []
+    for index, item in items:
+        row = {'index': index}
+        if isSession(source):
+            if source not in _sessions:
+                _sessions[source] = SessionPlayback(source)
+            session = _sessions[source]
+            image = session.frame(item)
+            metadata = session.metadata(item)
+            row['source'] = '{}:{}'.format(metadata['chunk'], metadata['slot'])
+            row.update({name: metadata[name] for name in metadataColumns if name in metadata})
+        else:
+            image = readImage(item)
+            row['source'] = os.path.basename(item)
+        row.update(imageMetrics(image, options))
+        rows.append(row)
+    return rows
+
+class CsvWriter:
+
+    def __init__(self, path):
+        self._file = open(path, 'w', newline='')
+        self._writer = csv.DictWriter(self._file, fieldnames=columns, restval='')
+        self._writer.writeheader()
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+class ParquetWriter:
+
+    def __init__(self, path):
+        self._path = path
+        self._writer = None
+
+    def write(self, rows):
+        table = pyarrow.Table.from_pydict({name: [row.get(name) for row in rows] for name in columns})
+        if self._writer is None:
+            self._writer = pyarrow.parquet.ParquetWriter(self._path, table.schema)
+        self._writer.write_table(table.cast(self._writer.schema))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+def run(source, output, options=None, workers=None, chunkSize=16, pattern='*.tif'):
+    if options is None:
+        options = MetricOptions()
+    if isSession(source):
+        items = list(range(len(SessionPlayback(source))))
+    else:
+        items = listImages(source, pattern)
+    if not items:
+        print('FocusMetrics: no images in {}.'.format(source))
+        return 0
+
+    if output.lower().endswith('.parquet'):
+        if pyarrow is None:
+            print('FocusMetrics: could not import pyarrow, write a CSV file instead.')
+            return 0
+        writer = ParquetWriter(output)
+    else:
+        writer = CsvWriter(output)
+
+    items = list(enumerate(items))
+    chunks = [items[start:start + chunkSize] for start in range(0, len(items), chunkSize)]
+    count = 0
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for rows in executor.map(analyseChunk, [source] * len(chunks), chunks, [options] * len(chunks)):
+                writer.write(rows)
+                count += len(rows)
+                print('FocusMetrics: {} of {} images.'.format(count, len(items)))
+    finally:
+        writer.close()
+    return count
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Compute the focus metrics of a folder of images or of a recorded session.')
+    parser.add_argument('source', help='folder of images or session folder with an index.jsonl')
+    parser.add_argument('output', help='CSV file, or Parquet file if it ends with .parquet')
+    parser.add_argument('--pattern', default='*.tif', help='pattern of the images in a folder')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser.add_argument('--chunk-size', type=int, default=16, help='number of images given to a process at once')
+    parser.add_argument('--no-hann', action='store_true', help='do not apply the Hann window')
+    parser.add_argument('--disc-mask-radius', type=float, default=None, help='apply a disc mask of this radius')
+    parser.add_argument('--raster-width', type=int, default=1024, help='width the disc mask radius refers to')
+    parser.add_argument('--real-fft', action='store_true', help='use the half-plane of the real-input FFT')
+    parser.add_argument('--radial-bins', type=int, default=1, help='number of rings of the sector powers')
+    arguments = parser.parse_args(arguments)
+
+    options = MetricOptions()
+    options.applyHann = not arguments.no_hann
+    if arguments.disc_mask_radius is not None:
+        options.applyDiscMask = True
+        options.discMaskRadius = arguments.disc_mask_radius
+    options.rasterWidth = arguments.raster_width
+    options.usingRealFft = arguments.real_fft
+    options.radialBins = arguments.radial_bins
+    run(arguments.source, arguments.output, options, arguments.workers, arguments.chunk_size, arguments.pattern)
+
+if __name__ == '__main__':
+    sys.exit(main())
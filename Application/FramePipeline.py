@@ -0,0 +1,206 @@
+#   File:   FramePipeline.py
+#
+#   Brief:  Implement the FramePipeline class, which acquires and analyses frames away from the GUI thread.
+#           An acquisition thread grabs frames into a FrameRing, a pool of analysis workers takes frames from it
+#           and puts the results into a second FrameRing, from which the consumer takes the latest result.
+#           The rings are bounded and drop their oldest entries when full, so that a slow stage never stalls the
+#           stages before it and the consumer always gets the newest frame.
+#           grab returns a frame or None if there is none, analyse is called from several workers at once
+#           and must not share buffers between calls, and notify is called from the workers after each result.
+#           Results are only published in the order their frames were grabbed, a result older than one already published
+#           is dropped. ordered, if given, is called with each published result, its sequence number and the time
+#           its frame was grabbed, one call at a time and in that order, for work that must see the frames in sequence.
+
+import time
+import logging
+import threading
+import concurrent.futures
+from collections import deque
+
+logger = logging.getLogger('FramePipeline')
+
+class FrameRing:
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.dropped = 0
+
+        self._entries = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def __len__(self):
+        with self._condition:
+            return len(self._entries)
+
+    def put(self, entry):
+        with self._condition:
+            if len(self._entries) >= self.capacity:
+                self._entries.popleft()
+                self.dropped += 1
+            self._entries.append(entry)
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        # Take the oldest entry, waiting for one if the ring is empty, None if the ring is closed.
+        with self._condition:
+            self._condition.wait_for(lambda: self._entries or self._closed, timeout)
+            if not self._entries:
+                return None
+            return self._entries.popleft()
+
+    def latest(self):
+        # Take the newest entry without waiting and drop the older ones, None if the ring is empty.
+        with self._condition:
+            if not self._entries:
+                return None
+            entry = self._entries.pop()
+            self.dropped += len(self._entries)
+            self._entries.clear()
+            return entry
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def open(self):
+        with self._condition:
+            self._entries.clear()
+            self._closed = False
+
+class FrameRate:
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.rate = 0.0
+
+        self._count = 0
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def tick(self):
+        with self._lock:
+            self._count += 1
+            now = time.perf_counter()
+            if now - self._start >= self.interval:
+                self.rate = self._count / (now - self._start)
+                self._count = 0
+                self._start = now
+
+    def reset(self):
+        with self._lock:
+            self.rate = 0.0
+            self._count = 0
+            self._start = time.perf_counter()
+
+class FramePipeline:
+
+    def __init__(self, grab, analyse, notify=None, capacity=4, workers=2, ordered=None):
+        self.grab = grab
+        self.analyse = analyse
+        self.notify = notify
+        self.ordered = ordered
+        self.workers = workers
+
+        self.frames = FrameRing(capacity)
+        self.results = FrameRing(capacity)
+        self.acquisitionRate = FrameRate()
+        self.analysisRate = FrameRate()
+        self.displayRate = FrameRate()
+
+        self._running = False
+        self._acquisitionThread = None
+        self._executor = None
+        self._sequence = 0
+        self._latestSequence = -1
+        self._staleResults = 0
+        self._sequenceLock = threading.Lock()
+
+    def running(self):
+        return self._running
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._sequence = 0
+        self._latestSequence = -1
+        self._staleResults = 0
+        self.frames.open()
+        self.results.open()
+        for rate in (self.acquisitionRate, self.analysisRate, self.displayRate):
+            rate.reset()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        for _ in range(self.workers):
+            self._executor.submit(self._analyseFrames)
+        self._acquisitionThread = threading.Thread(target=self._acquireFrames, daemon=True)
+        self._acquisitionThread.start()
+
+    def stop(self):
+        if self._acquisitionThread is None:
+            return
+        self._running = False
+        self.frames.close()
+        self.results.close()
+        self._acquisitionThread.join()
+        self._executor.shutdown(wait=True)
+        self._acquisitionThread = None
+        self._executor = None
+
+    def takeLatest(self):
+        # Called by the consumer, gives the newest analysed frame or None if nothing new has been analysed.
+        entry = self.results.latest()
+        if entry is None:
+            return None
+        self.displayRate.tick()
+        return entry[1]
+
+    def queueDepth(self):
+        return len(self.frames)
+
+    def droppedFrames(self):
+        return self.frames.dropped + self.results.dropped + self._staleResults
+
+    def _acquireFrames(self):
+        while self._running:
+            try:
+                frame = self.grab()
+            except Exception as error:
+                logger.error('FramePipeline: could not grab a frame, %s.', error)
+                self._running = False
+                break
+            if frame is None:
+                time.sleep(0.01)
+                continue
+            self.frames.put((self._sequence, time.perf_counter(), frame))
+            self._sequence += 1
+            self.acquisitionRate.tick()
+        self.frames.close()
+
+    def _analyseFrames(self):
+        while True:
+            entry = self.frames.get()
+            if entry is None:
+                return
+            sequence, grabTime, frame = entry
+            try:
+                result = self.analyse(frame)
+            except Exception as error:
+                logger.error('FramePipeline: could not analyse a frame, %s.', error)
+                continue
+            self.analysisRate.tick()
+            # Workers finish out of order, a result older than one already published is dropped.
+            with self._sequenceLock:
+                if sequence < self._latestSequence:
+                    self._staleResults += 1
+                    continue
+                self._latestSequence = sequence
+                if self.ordered:
+                    try:
+                        self.ordered(result, sequence, grabTime)
+                    except Exception as error:
+                        logger.error('FramePipeline: could not process a frame in order, %s.', error)
+                self.results.put((sequence, result))
+            if self.notify:
+                self.notify()
@@ -0,0 +1,93 @@
+#   File:   HistogramEqualisation.py
+#
+#   Brief:  Implement histogram equalisation of integer images through look-up tables.
+#           Histograms are counted with bincount and images are remapped with a single take,
+#           which can write back into the image itself.
+#           equaliseInTiles is a contrast limited adaptive equalisation, every tile gets its own look-up table
+#           and each pixel blends the tables of the four nearest tiles.
+
+import numpy
+
+try:
+    import cupy
+except:
+    cupy = None
+
+def histogram(image, bitDepth=8):
+    xp = _arrayModule(image)
+    return xp.bincount(image.ravel(), minlength=2**bitDepth)[:2**bitDepth]
+
+def transferMap(counts, bitDepth=8):
+    xp = _arrayModule(counts)
+    maxLevel = 2**bitDepth - 1
+    values = xp.cumsum(counts, axis=-1, dtype='float64')
+    values = values / values[..., -1:]
+    values = values * maxLevel
+    return values.round().astype('uint{}'.format(bitDepth))
+
+def remap(image, transferMap, out=None):
+    xp = _arrayModule(image)
+    if out is None:
+        out = xp.empty(image.shape, dtype=transferMap.dtype)
+    # Each element is read before it is written, so out may be the image itself.
+    if xp is numpy:
+        return numpy.take(transferMap, image, out=out, mode='clip')
+    return cupy.take(transferMap, image, out=out)
+
+def equalise(image, bitDepth=8, counts=None, out=None):
+    if counts is None:
+        counts = histogram(image, bitDepth)
+    return remap(image, transferMap(counts, bitDepth), out)
+
+def equaliseInTiles(image, tilesX=8, tilesY=8, clipLimit=2.0, bitDepth=8, out=None):
+    xp = _arrayModule(image)
+    levels = 2**bitDepth
+    height, width = image.shape
+    tileHeight = -(-height // min(tilesY, height))
+    tileWidth = -(-width // min(tilesX, width))
+    # The rounded up tile size can cover the image with fewer tiles, the others would be empty.
+    tilesY = -(-height // tileHeight)
+    tilesX = -(-width // tileWidth)
+
+    # One bincount counts the histograms of all the tiles.
+    rowTiles = xp.arange(height) // tileHeight
+    colTiles = xp.arange(width) // tileWidth
+    labels = (rowTiles[:, None] * tilesX + colTiles[None, :]) * levels + image
+    counts = xp.bincount(labels.ravel(), minlength=tilesY*tilesX*levels).reshape(tilesY, tilesX, levels)
+
+    # Clip each histogram at clipLimit times its mean and spread the excess over all the levels.
+    if clipLimit > 0:
+        limit = xp.maximum(counts.sum(axis=-1, keepdims=True) * clipLimit / levels, 1)
+        excess = xp.maximum(counts - limit, 0).sum(axis=-1, keepdims=True)
+        counts = xp.minimum(counts, limit) + excess / levels
+
+    maps = transferMap(counts, bitDepth).astype('float32')
+
+    # Blend the maps of the four tiles around each pixel, weighted by the distances to the tile centres.
+    rowPositions = (xp.arange(height, dtype='float32') + 0.5) / tileHeight - 0.5
+    colPositions = (xp.arange(width, dtype='float32') + 0.5) / tileWidth - 0.5
+    rows0 = xp.clip(xp.floor(rowPositions), 0, tilesY - 1).astype('intp')
+    cols0 = xp.clip(xp.floor(colPositions), 0, tilesX - 1).astype('intp')
+    rows1 = xp.minimum(rows0 + 1, tilesY - 1)
+    cols1 = xp.minimum(cols0 + 1, tilesX - 1)
+    rowWeights = xp.clip(rowPositions - rows0, 0, 1)[:, None]
+    colWeights = xp.clip(colPositions - cols0, 0, 1)[None, :]
+
+    top = maps[rows0[:, None], cols0[None, :], image] * (1 - colWeights)
+    top += maps[rows0[:, None], cols1[None, :], image] * colWeights
+    bottom = maps[rows1[:, None], cols0[None, :], image] * (1 - colWeights)
+    bottom += maps[rows1[:, None], cols1[None, :], image] * colWeights
+    top *= 1 - rowWeights
+    bottom *= rowWeights
+    top += bottom
+
+    if out is None:
+        out = xp.empty(image.shape, dtype='uint{}'.format(bitDepth))
+    xp.rint(top, out=top)
+    out[...] = top
+    return out
+
+def _arrayModule(array):
+    if cupy:
+        return cupy.get_array_module(array)
+    return numpy
@@ -0,0 +1,135 @@
+#   File:   ImageSequence.py
+#
+#   Brief:  Implement the ImageSequence class, which replays a folder of recorded images as a source of frames.
+#           The next prefetchFrames images are decoded ahead by a pool of threads, so reading a frame does not wait for the disk.
+#           Uncompressed greyscale TIFFs with contiguous strips are memory mapped instead of decoded,
+#           the prefetching then only reads their pages into the page cache.
+#           The sequence can loop, seek and hold a playback rate in frames per second, 0 plays as fast as frames are read.
+
+import os
+import glob
+import mmap
+import time
+import threading
+import concurrent.futures
+import numpy
+from PIL import Image
+
+class ImageSequence:
+
+    def __init__(self, folder, pattern='*.tif'):
+        self.folder = folder
+        self.looping = True
+        self.playbackRate = 0.0 # In frames per second.
+        self.prefetchFrames = 8
+        self.memoryMapping = True
+
+        self._paths = sorted(glob.glob(os.path.join(glob.escape(folder), pattern)))
+        self._index = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self._nextTime = None
+
+    def __len__(self):
+        return len(self._paths)
+
+    def position(self):
+        return self._index
+
+    def seek(self, index):
+        with self._lock:
+            if not self._paths:
+                return
+            self._index = index % len(self._paths)
+            self._nextTime = None
+            self._prefetch()
+
+    def next(self):
+        # Give the next frame, or None at the end of a sequence that does not loop.
+        with self._lock:
+            if self._index >= len(self._paths):
+                if not self.looping or not self._paths:
+                    return None
+                self._index = 0
+            index = self._index
+            self._index += 1
+            self._prefetch(index)
+            future = self._pending.pop(index)
+            self._prefetch()
+        self._waitForPlayback()
+        return future.result()
+
+    def read(self, index):
+        path = self._paths[index]
+        if self.memoryMapping:
+            image = mapTiff(path)
+            if image is not None:
+                # Touch one byte of every page so that the frame is in memory before it is used.
+                image.reshape(-1)[::mmap.PAGESIZE].sum()
+                return image
+        with Image.open(path) as image:
+            return numpy.asarray(image)
+
+    def close(self):
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+            self._pending.clear()
+        self._executor.shutdown(wait=False)
+
+    def _prefetch(self, first=None):
+        # Keep decodes running for the window of frames starting at first, and cancel those outside it.
+        if first is None:
+            first = self._index
+        window = []
+        for offset in range(max(self.prefetchFrames, 1)):
+            index = first + offset
+            if index >= len(self._paths):
+                if not self.looping:
+                    break
+                index %= len(self._paths)
+            window.append(index)
+        for index in list(self._pending):
+            if index not in window:
+                self._pending.pop(index).cancel()
+        for index in window:
+            if index not in self._pending:
+                self._pending[index] = self._executor.submit(self.read, index)
+
+    def _waitForPlayback(self):
+        if self.playbackRate <= 0:
+            self._nextTime = None
+            return
+        now = time.perf_counter()
+        if self._nextTime is not None and self._nextTime > now:
+            time.sleep(self._nextTime - now)
+            now = self._nextTime
+        self._nextTime = now + 1 / self.playbackRate
+
+def mapTiff(path):
+    # Memory map an uncompressed 8 or 16 bit greyscale TIFF stored in contiguous strips, None if it is not one.
+    with Image.open(path) as image:
+        tags = image.tag_v2
+        if image.mode == 'L':
+            dataType = numpy.dtype('uint8')
+        elif image.mode == 'I;16':
+            dataType = numpy.dtype('<u2')
+        elif image.mode == 'I;16B':
+            dataType = numpy.dtype('>u2')
+        else:
+            return None
+        width, height = image.size
+        compression = tags.get(259, 1)
+        photometric = tags.get(262, 1)
+        planar = tags.get(284, 1)
+        offsets = tags.get(273)
+        counts = tags.get(279)
+    if compression != 1 or photometric != 1 or planar != 1 or not offsets or not counts:
+        return None
+    for offset, count, nextOffset in zip(offsets, counts, offsets[1:]):
+        if offset + count != nextOffset:
+            return None
+    if sum(counts) < width * height * dataType.itemsize:
+        return None
+    return numpy.memmap(path, dtype=dataType, mode='r', offset=offsets[0], shape=(height, width))
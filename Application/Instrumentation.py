@@ -0,0 +1,169 @@
+#   File:   Instrumentation.py
+#
+#   Brief:  Implement the Instrumentation class, which times the stages of acquiring and analysing frames,
+#           and the logging set up of the tool.
+#
+#           The stages are timed with "with instrumentation.stage(name):" or given a measured time with record,
+#           the last windowSize times of each stage are kept and summarised as percentiles.
+#           When enabled is False a stage is a shared context that does nothing and record returns at once,
+#           so the timing left in the hot paths costs a method call.
+#           The summary of each stage in stages is shown as a line of text for ObjectInspector,
+#           refreshed at most every refreshInterval seconds as times are recorded,
+#           and the summaries of all stages can be written as JSON or CSV.
+#           With cupy the stages are timed on the host, so a stage ending in a GPU launch is not timed to its end.
+#
+#           configureLogging sends the log records of the tool to the console as plain messages,
+#           and optionally to a file of JSON lines holding the message and the values given in extra.
+
+import sys
+import csv
+import json
+import time
+import logging
+import threading
+import numpy
+
+class Instrumentation:
+
+    stages = ['iteration', 'settleWait', 'grab', 'decode', 'window', 'fft', 'maskReduction',
+              'analysis', 'drift', 'render', 'paint', 'comGet', 'comSet']
+
+    def __init__(self):
+        self.enabled = False
+        self.windowSize = 1000
+        self.refreshInterval = 0.5 # In s.
+        self.jsonPath = 'Timings.json'
+        self.csvPath = 'Timings.csv'
+
+        # In ms, count and 50th, 95th and 99th percentiles of the last windowSize times.
+        for name in self.stages:
+            setattr(self, name, '')
+
+        self._times = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._nextRefresh = 0.0
+
+    def stage(self, name):
+        if not self.enabled:
+            return _untimedStage
+        return _TimedStage(self, name)
+
+    def record(self, name, duration):
+        # Duration in s.
+        if not self.enabled:
+            return
+        with self._lock:
+            times = self._times.get(name)
+            if times is None or len(times) != self.windowSize:
+                times = numpy.full(max(self.windowSize, 1), numpy.nan)
+                self._times[name] = times
+                self._counts[name] = 0
+            times[self._counts[name] % len(times)] = duration
+            self._counts[name] += 1
+        now = time.perf_counter()
+        if now >= self._nextRefresh:
+            self._nextRefresh = now + self.refreshInterval
+            self.refresh()
+
+    def summary(self):
+        # Count, mean, percentiles and maximum in ms of the recent times of each stage.
+        with self._lock:
+            recent = {name: times[~numpy.isnan(times)] * 1000 for name, times in self._times.items()}
+            counts = dict(self._counts)
+        summary = {}
+        for name, times in recent.items():
+            if len(times) == 0:
+                continue
+            p50, p95, p99 = numpy.percentile(times, [50, 95, 99])
+            summary[name] = {'count': counts[name], 'samples': len(times), 'mean': float(times.mean()),
+                             'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'maximum': float(times.max())}
+        return summary
+
+    def refresh(self):
+        for name, stage in self.summary().items():
+            if name in self.stages:
+                setattr(self, name, '{count}, {p50:.3f} / {p95:.3f} / {p99:.3f}'.format(**stage))
+
+    def reset(self):
+        with self._lock:
+            self._times.clear()
+            self._counts.clear()
+        for name in self.stages:
+            setattr(self, name, '')
+
+    def dumpJson(self, path):
+        with open(path, 'w') as file:
+            json.dump({'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'unit': 'ms', 'stages': self.summary()}, file, indent=1)
+
+    def dumpCsv(self, path):
+        fields = ['stage', 'count', 'samples', 'mean', 'p50', 'p95', 'p99', 'maximum']
+        with open(path, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=fields)
+            writer.writeheader()
+            for name, stage in self.summary().items():
+                writer.writerow(dict(stage, stage=name))
+
+    def guiRefresh(self):
+        self.refresh()
+
+    def guiReset(self):
+        self.reset()
+
+    def guiDumpJson(self):
+        self.dumpJson(self.jsonPath)
+
+    def guiDumpCsv(self):
+        self.dumpCsv(self.csvPath)
+
+class _TimedStage:
+
+    def __init__(self, instrumentation, name):
+        self._instrumentation = instrumentation
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self._instrumentation.record(self._name, time.perf_counter() - self._start)
+        return False
+
+class _UntimedStage:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+_untimedStage = _UntimedStage()
+
+instrumentation = Instrumentation()
+
+class JsonLinesFormatter(logging.Formatter):
+
+    # The attributes of every log record, the others were given in extra.
+    _standardAttributes = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname, 'logger': record.name, 'thread': record.threadName,
+                 'message': record.getMessage()}
+        entry.update({name: value for name, value in vars(record).items() if name not in self._standardAttributes})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def configureLogging(level=logging.INFO, path=None):
+    handlers = [logging.StreamHandler(sys.stdout)]
+    handlers[0].setFormatter(logging.Formatter('%(message)s'))
+    if path:
+        handlers.append(logging.FileHandler(path))
+        handlers[1].setFormatter(JsonLinesFormatter())
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
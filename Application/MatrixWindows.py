@@ -1,110 +1,181 @@
 #   File:   MatrixWindows.py
 #
 #   Author: Liuchuyao Xu, 2020
+#
+#   Brief:  Implement functions that build windows and masks for images and their FFTs.
+#           The windows and masks only depend on their sizes, so each one is built once and kept in a cache,
+#           which evicts the least recently used entry when it holds more than cacheSize entries.
+#           Windows are float32, masks are bool and label maps are intp, which bincount takes without a conversion.
+#           The cached arrays are shared, they must not be modified.
+
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy
+
+logger = logging.getLogger('MatrixWindows')
 
 try:
     import cupy
 except:
-    import numpy
     cupy = None
-    print('MatrixWindows: could not import cupy, GPU acceleration will be disabled.')
+    logger.warning('MatrixWindows: could not import cupy, GPU acceleration will be disabled.')
+
+cacheSize = 32
+_cache = OrderedDict()
+_cacheLock = threading.Lock()
 
 def hann(width, height, returnCupy=False):
-    if cupy:
-        row = cupy.hanning(width)
-        col = cupy.hanning(height)
-        window = cupy.outer(row, col)
-        window = cupy.sqrt(window)
-        if returnCupy:
-            return window
-        else:
-            return cupy.asnumpy(window)
-    else:
-        row = numpy.hanning(width)
-        col = numpy.hanning(height)
-        window = numpy.outer(row, col)
-        window = numpy.sqrt(window)
-        return window
+    return _cached(('hann', width, height), _hann, returnCupy)
 
 def hannMask(width, height, threshold, returnCupy=False):
-    if cupy:
-        row = cupy.hanning(width)
-        col = cupy.hanning(height)
-        window = cupy.outer(row, col)
-        window = cupy.sqrt(window)
-        window = window > threshold
-        window = window.astype(int)
-        if returnCupy:
-            return window
-        else:
-            return cupy.asnumpy(window)
-    else:
-        row = numpy.hanning(width)
-        col = numpy.hanning(height)
-        window = numpy.outer(row, col)
-        window = numpy.sqrt(window)
-        window = window > threshold
-        window = window.astype(int)
-        return window
+    return _cached(('hannMask', width, height, threshold), _hannMask, returnCupy)
 
 def discMask(width, height, radius, returnCupy=False):
-    if cupy:
-        xOrigin = (width - 1) / 2
-        yOrigin = (height - 1) / 2
-        xIndices, yIndices = cupy.ogrid[0:width, 0:height]
-        window = (xIndices - xOrigin)**2 + (yIndices - yOrigin)**2
-        window = window <= (radius * radius)
-        window = window.astype(int)
-        if returnCupy:
-            return window
-        else:
-            return cupy.asnumpy(window)
-    else:
-        xOrigin = (width - 1) / 2
-        yOrigin = (height - 1) / 2
-        xIndices, yIndices = numpy.ogrid[0:width, 0:height]
-        window = (xIndices - xOrigin)**2 + (yIndices - yOrigin)**2
-        window = window <= (radius * radius)
-        window = window.astype(int)
-        return window
+    return _cached(('discMask', width, height, radius), _discMask, returnCupy)
 
 def segmentMasks(width, height, returnCupy=False):
-    if cupy:
-        xOrigin = (width - 1) / 2
-        yOrigin = (height - 1) / 2
-        xIndices, yIndices = cupy.ogrid[0:height, 0:width]
-        xIndices = xIndices - xOrigin
-        yIndices = yIndices - yOrigin
-        window = yIndices / xIndices
-        window = cupy.arctan(window)
-        window = window * 180 / cupy.pi
-        q1 = (window > -22.5) & (window <= 22.5)
-        q2 = (window > 22.5) & (window <= 67.5)
-        q3 = (window > 67.5) | (window <= -67.5)
-        q4 = (window > -67.5) & (window <= -22.5)
-        q1 = q1.astype(int)
-        q2 = q2.astype(int)
-        q3 = q3.astype(int)
-        q4 = q4.astype(int)
-        if returnCupy:
-            return (q1, q2, q3, q4)
+    return _cached(('segmentMasks', width, height), _segmentMasks, returnCupy)
+
+def sectorLabels(width, height, radius=None, radialBins=1, returnCupy=False):
+    return _cached(('sectorLabels', width, height, radius, radialBins), _sectorLabels, returnCupy)
+
+def halfSectorLabels(width, height, radius=None, radialBins=1, returnCupy=False):
+    return _cached(('halfSectorLabels', width, height, radius, radialBins), _halfSectorLabels, returnCupy)
+
+def halfFrequencies(width, height, returnCupy=False):
+    return _cached(('halfFrequencies', width, height), _halfFrequencies, returnCupy)
+
+def halfPolarLabels(width, height, radialBins, angularBins, minimumFrequency, maximumFrequency, returnCupy=False):
+    return _cached(('halfPolarLabels', width, height, radialBins, angularBins, minimumFrequency, maximumFrequency), _halfPolarLabels, returnCupy)
+
+def clearCache():
+    with _cacheLock:
+        _cache.clear()
+
+def _cached(key, build, returnCupy):
+    onDevice = bool(cupy) and returnCupy
+    key = key + (onDevice,)
+    with _cacheLock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    xp = cupy if cupy else numpy
+    value = build(xp, *key[1:-1])
+    if cupy and not onDevice:
+        if isinstance(value, tuple):
+            value = tuple(cupy.asnumpy(v) for v in value)
         else:
-            return (cupy.asnumpy(q1), cupy.asnumpy(q2), cupy.asnumpy(q3), cupy.asnumpy(q4))
+            value = cupy.asnumpy(value)
+    if isinstance(value, tuple):
+        for v in value:
+            _protect(v)
     else:
-        xOrigin = (width - 1) / 2
-        yOrigin = (height - 1) / 2
-        xIndices, yIndices = numpy.ogrid[0:height, 0:width]
-        xIndices = xIndices - xOrigin
-        yIndices = yIndices - yOrigin
+        _protect(value)
+
+    with _cacheLock:
+        _cache[key] = value
+        _cache.move_to_end(key)
+        while len(_cache) > cacheSize:
+            _cache.popitem(last=False)
+    return value
+
+def _protect(array):
+    if isinstance(array, numpy.ndarray):
+        array.flags.writeable = False
+
+def _hann(xp, width, height):
+    row = xp.hanning(width)
+    col = xp.hanning(height)
+    window = xp.outer(row, col)
+    window = xp.sqrt(window)
+    return window.astype('float32')
+
+def _hannMask(xp, width, height, threshold):
+    row = xp.hanning(width)
+    col = xp.hanning(height)
+    window = xp.outer(row, col)
+    window = xp.sqrt(window)
+    return window > threshold
+
+def _discMask(xp, width, height, radius):
+    xOrigin = (width - 1) / 2
+    yOrigin = (height - 1) / 2
+    xIndices, yIndices = xp.ogrid[0:width, 0:height]
+    window = (xIndices - xOrigin)**2 + (yIndices - yOrigin)**2
+    return window <= (radius * radius)
+
+def _segmentMasks(xp, width, height):
+    xOrigin = (width - 1) / 2
+    yOrigin = (height - 1) / 2
+    xIndices, yIndices = xp.ogrid[0:height, 0:width]
+    xIndices = xIndices - xOrigin
+    yIndices = yIndices - yOrigin
+    with numpy.errstate(divide='ignore', invalid='ignore'):
         window = yIndices / xIndices
-        window = numpy.arctan(window)
-        window = window * 180 / numpy.pi
-        q1 = (window > -22.5) & (window <= 22.5)
-        q2 = (window > 22.5) & (window <= 67.5)
-        q3 = (window > 67.5) | (window <= -67.5)
-        q4 = (window > -67.5) & (window <= -22.5)
-        q1 = q1.astype(int)
-        q2 = q2.astype(int)
-        q3 = q3.astype(int)
-        q4 = q4.astype(int)
-        return (q1, q2, q3, q4)
+    window = xp.arctan(window)
+    window = window * 180 / xp.pi
+    q1 = (window > -22.5) & (window <= 22.5)
+    q2 = (window > 22.5) & (window <= 67.5)
+    q3 = (window > 67.5) | (window <= -67.5)
+    q4 = (window > -67.5) & (window <= -22.5)
+    return (q1, q2, q3, q4)
+
+def _sectorLabels(xp, width, height, radius, radialBins):
+    # Label each pixel as ring * 5 + segment, following the geometry of segmentMasks and of discMask for a (height, width) FFT.
+    # Segments 0 to 3 are the masks of segmentMasks and segment 4 holds pixels in none of them.
+    # Pixels outside the radius, if one is given, get the label radialBins * 5, otherwise the rings reach the corners.
+    q1, q2, q3, q4 = _segmentMasks(xp, width, height)
+    labels = xp.full((height, width), 4, dtype='intp')
+    labels[q1] = 0
+    labels[q2] = 1
+    labels[q3] = 2
+    labels[q4] = 3
+
+    rowOrigin = (height - 1) / 2
+    colOrigin = (width - 1) / 2
+    rowIndices, colIndices = xp.ogrid[0:height, 0:width]
+    squaredDistances = (rowIndices - rowOrigin)**2 + (colIndices - colOrigin)**2
+    ringRadius = radius if radius is not None else float(squaredDistances.max())**0.5
+    rings = xp.floor(xp.sqrt(squaredDistances) * (radialBins / ringRadius)).astype('intp')
+    rings = xp.minimum(rings, radialBins - 1)
+    labels += rings * 5
+    if radius is not None:
+        labels[squaredDistances > radius * radius] = radialBins * 5
+    return labels
+
+def _halfSectorLabels(xp, width, height, radius, radialBins):
+    # Label the half-plane of a real-input FFT, shifted along the rows, with the labels of the full shifted FFT.
+    # Each half-plane pixel also stands for its conjugate at the mirrored frequency, which gets the second map.
+    # Columns holding their own conjugates are labelled radialBins * 5 in the second map, so that they are only counted once.
+    labels = _sectorLabels(xp, width, height, radius, radialBins)
+    halfWidth = width // 2 + 1
+    rows = xp.arange(height)
+    cols = xp.arange(halfWidth)
+    direct = labels[rows[:, None], ((cols + width // 2) % width)[None, :]]
+    mirrored = labels[((2 * (height // 2) - rows) % height)[:, None], ((width // 2 - cols) % width)[None, :]]
+    mirrored[:, 0] = radialBins * 5
+    if width % 2 == 0:
+        mirrored[:, width // 2] = radialBins * 5
+    return (direct, mirrored)
+
+def _halfFrequencies(xp, width, height):
+    # Frequencies in cycles per pixel of the half-plane of a real-input FFT shifted along the rows.
+    fy = (xp.arange(height) - height // 2) / height
+    fx = xp.arange(width // 2 + 1) / width
+    return (fy[:, None], fx[None, :])
+
+def _halfPolarLabels(xp, width, height, radialBins, angularBins, minimumFrequency, maximumFrequency):
+    # Label the half-plane as ring * angularBins + sector, the angles are taken modulo 180 degrees.
+    # Frequencies above maximumFrequency get the label radialBins * angularBins and those below minimumFrequency the next one.
+    fy, fx = _halfFrequencies(xp, width, height)
+    radii = xp.sqrt(fx**2 + fy**2)
+    angles = xp.arctan2(fy, fx) % xp.pi
+    rings = xp.floor((radii - minimumFrequency) * (radialBins / (maximumFrequency - minimumFrequency))).astype('intp')
+    sectors = xp.floor(angles * (angularBins / xp.pi)).astype('intp') % angularBins
+    labels = xp.clip(rings, 0, radialBins - 1) * angularBins + sectors
+    labels[radii > maximumFrequency] = radialBins * angularBins
+    labels[radii < minimumFrequency] = radialBins * angularBins + 1
+    return labels
@@ -0,0 +1,91 @@
+#   File:   SectorPowers.py
+#
+#   Brief:  Implement the sums of an FFT over the segments used by SemCorrector.
+#           All the sums are taken in one pass with bincount over a label map from MatrixWindows.sectorLabels,
+#           instead of multiplying the FFT by each mask in turn.
+#           halfSectorPowers gives the same sums from the half-plane of a real-input FFT, see SemImage.halfFft.
+#           The batch functions take a stack of FFTs (N, H, W). On the GPU all of them are reduced with a single bincount,
+#           the labels of each frame being offset past those of the previous frames, on the CPU the frames share the label map.
+
+import numpy
+
+import MatrixWindows
+
+try:
+    import cupy
+except:
+    cupy = None
+
+class SectorPowers:
+
+    def __init__(self, table):
+        # table[ring, segment], segments as in MatrixWindows.sectorLabels.
+        self.table = table
+        self.total = table.sum()
+        self.r12 = table[:, 0].sum()
+        self.s12 = table[:, 1].sum()
+        self.r34 = table[:, 2].sum()
+        self.s34 = table[:, 3].sum()
+        self.radialProfile = table.sum(axis=1)
+        self.azimuthalProfile = table[:, 0:4].sum(axis=0)
+        # Set by SemCorrector.
+        self.frameShape = None
+        self.polarPowers = None
+
+    def __sub__(self, other):
+        return SectorPowers(self.table - other.table)
+
+def sectorPowers(fft, radius=None, radialBins=1):
+    height = fft.shape[0]
+    width = fft.shape[1]
+    onDevice = cupy is not None and isinstance(fft, cupy.ndarray)
+    labels = MatrixWindows.sectorLabels(width, height, radius, radialBins, returnCupy=onDevice)
+    return sectorPowersFromLabels(fft, labels, radialBins)
+
+def sectorPowersFromLabels(fft, labels, radialBins=1):
+    xp = cupy.get_array_module(fft) if cupy else numpy
+    sums = xp.bincount(labels.ravel(), weights=fft.ravel(), minlength=radialBins*5 + 1)
+    if xp is not numpy:
+        sums = cupy.asnumpy(sums)
+    return SectorPowers(sums[:radialBins*5].reshape(radialBins, 5))
+
+def halfSectorPowers(halfFft, width, radius=None, radialBins=1):
+    height = halfFft.shape[0]
+    onDevice = cupy is not None and isinstance(halfFft, cupy.ndarray)
+    direct, mirrored = MatrixWindows.halfSectorLabels(width, height, radius, radialBins, returnCupy=onDevice)
+    xp = cupy.get_array_module(halfFft) if cupy else numpy
+    weights = halfFft.ravel()
+    sums = xp.bincount(direct.ravel(), weights=weights, minlength=radialBins*5 + 1)
+    sums += xp.bincount(mirrored.ravel(), weights=weights, minlength=radialBins*5 + 1)
+    if xp is not numpy:
+        sums = cupy.asnumpy(sums)
+    return SectorPowers(sums[:radialBins*5].reshape(radialBins, 5))
+
+def sectorPowersBatch(ffts, radius=None, radialBins=1):
+    height = ffts.shape[1]
+    width = ffts.shape[2]
+    onDevice = cupy is not None and isinstance(ffts, cupy.ndarray)
+    labels = MatrixWindows.sectorLabels(width, height, radius, radialBins, returnCupy=onDevice)
+    return _batchSums(ffts, (labels,), radialBins)
+
+def halfSectorPowersBatch(halfFfts, width, radius=None, radialBins=1):
+    height = halfFfts.shape[1]
+    onDevice = cupy is not None and isinstance(halfFfts, cupy.ndarray)
+    labels = MatrixWindows.halfSectorLabels(width, height, radius, radialBins, returnCupy=onDevice)
+    return _batchSums(halfFfts, labels, radialBins)
+
+def _batchSums(ffts, labelMaps, radialBins):
+    xp = cupy.get_array_module(ffts) if cupy else numpy
+    frames = ffts.shape[0]
+    labelsPerFrame = radialBins*5 + 1
+    sums = xp.zeros((frames, labelsPerFrame))
+    if xp is numpy:
+        for labels in labelMaps:
+            for frame in range(frames):
+                sums[frame] += numpy.bincount(labels.ravel(), weights=ffts[frame].ravel(), minlength=labelsPerFrame)
+    else:
+        offsets = (xp.arange(frames) * labelsPerFrame)[:, None, None]
+        for labels in labelMaps:
+            sums += xp.bincount((labels[None, :, :] + offsets).ravel(), weights=ffts.ravel(), minlength=frames*labelsPerFrame).reshape(frames, labelsPerFrame)
+        sums = cupy.asnumpy(sums)
+    return [SectorPowers(frameSums[:radialBins*5].reshape(radialBins, 5)) for frameSums in sums]
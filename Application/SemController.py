@@ -6,17 +6,58 @@
 #           The class gives direct access to the API of the SEM
 #           The class provides functions that the API does not directly support.
 #
+#           The API is reached through a backend object, by default the ole control.
+#           Any object providing InitialiseRemoting, Get, Set and Grab like the ole control can be used as a backend.
+#           A backend may also provide GrabArray(x, y, width, height, reduction, out),
+#           which returns the frame as a uint8 array without going through a file.
+#
+#           getParameter, getParameters and setParameter go through a cache of the values read and set,
+#           which are trusted for parameterCacheLifetime seconds, so repeated reads and sets of the same value
+#           do not make a round trip to the SEM. Values are kept in the units of Get, setParameter takes the units of Set.
+#           The number of calls to the backend and their latencies are counted.
+#
+#           Every call on the backend is made through a CommandQueue, on one owner thread,
+#           so that SemCorrector and SemImageViewer can drive the SEM at the same time without their calls interleaving.
+#           The methods take a priority, SemImageViewer grabs at CommandQueue.highPriority so that live viewing
+#           is not held up by corrector moves waiting at CommandQueue.normalPriority.
+#           The Async methods return a future instead of waiting, cancelCommands cancels the waiting commands of a priority,
+#           or only those of one thread, so that SemCorrector can stop its own commands without cancelling those of the viewer.
+#           grabArray takes the raster to grab as (x, y, width, height, reduction), by default the one in imageX, imageY,
+#           imageWidth, imageHeight and imageReduction, which is left to the user and SemImageViewer.
+#           SemCorrector passes its own rasters, so that its grabs never change the raster of other callers.
+#
 #   Abbreviations:
 #           ole     Microsoft Object Linking and Embedding document
 
+import os
+import time
+import atexit
 import tempfile
+import logging
+import threading
+import numpy
 from PIL import Image
-from win32com import client
+
+from CommandQueue import CommandQueue
+from Instrumentation import instrumentation
+
+logger = logging.getLogger('SemController')
+
+try:
+    import pythoncom
+    from win32com import client
+except:
+    pythoncom = None
+    client = None
+    logger.warning('SemController: could not import win32com, only local backends will be available.')
 
 class SemController:
 
-    def __init__(self):
-        self._sem = None
+    # Set takes the working distance in mm and Get gives it in m.
+    _setScales = {'AP_WD': 1000}
+
+    def __init__(self, backend=None):
+        self._sem = backend
         self.ole = 'CZ.EmApiCtrl.1'
         self.semInitialised = False
 
@@ -26,34 +67,266 @@ class SemController:
         self.imageHeight = 768
         self.imageReduction = 0
 
+        self.parameterCacheLifetime = 0.5 # In s.
+        self.meanGetLatency = 0.0 # In ms.
+        self.meanSetLatency = 0.0 # In ms.
+        self._getCalls = 0
+        self._setCalls = 0
+        self._cacheHits = 0
+        self._skippedSets = 0
+        self._parameterCache = {}
+        self._latencies = {}
+        self._parameterLock = threading.Lock()
+        self._commands = CommandQueue(self._initialiseOwnerThread)
+
+        self.stagingFolder = tempfile.gettempdir()
+        self._stagingBuffer = bytearray()
+        self._backendGrabsArrays = False
+
+        atexit.register(self.deleteStagingFile)
+
         self.initSem()
 
     def initSem(self):
         if self.semInitialised:
             return
-        self._sem = client.Dispatch(self.ole)
+        self._commands.call(self._initialiseBackend, priority=CommandQueue.highPriority)
+
+    def _initialiseOwnerThread(self):
+        if pythoncom is not None:
+            pythoncom.CoInitialize()
+
+    def _initialiseBackend(self):
+        # The ole control is created on the owner thread, which is the only thread calling it.
+        if self.semInitialised:
+            return
+        if self._sem is None:
+            if client is None:
+                logger.error('SemController: no backend available.')
+                return
+            self._sem = client.Dispatch(self.ole)
         self._sem.InitialiseRemoting()
+        self._backendGrabsArrays = hasattr(self._sem, 'GrabArray')
         self.semInitialised = True
 
     def sem(self):
+        # Calls on the backend must be made on the owner thread, through submit or call.
         if not self.semInitialised:
             self.initSem()
         return self._sem
 
+    def submit(self, function, *args, priority=CommandQueue.normalPriority, **kwargs):
+        return self._commands.submit(function, *args, priority=priority, **kwargs)
+
+    def call(self, function, *args, priority=CommandQueue.normalPriority, **kwargs):
+        return self._commands.call(function, *args, priority=priority, **kwargs)
+
+    def cancelCommands(self, priority=None, thread=None):
+        return self._commands.cancel(priority, thread)
+
+    def getParameter(self, name, default=0.0, priority=CommandQueue.normalPriority):
+        return self.getParameters([name], default, priority)[name]
+
+    def getParameters(self, names, default=0.0, priority=CommandQueue.normalPriority):
+        # Read a set of parameters, those not in the cache are read from the SEM in one command.
+        values = {}
+        now = time.perf_counter()
+        with self._parameterLock:
+            for name in names:
+                if name in self._parameterCache and now - self._parameterCache[name][1] <= self.parameterCacheLifetime:
+                    values[name] = self._parameterCache[name][0]
+                    self._cacheHits += 1
+        missing = [name for name in names if name not in values]
+        if missing:
+            values.update(self._commands.call(self._getFromBackend, missing, default, priority=priority))
+        return values
+
+    def getParametersAsync(self, names, default=0.0, priority=CommandQueue.normalPriority):
+        return self._commands.submit(self.getParameters, names, default, priority=priority)
+
+    def _getFromBackend(self, names, default):
+        values = {}
+        sem = self.sem()
+        for name in names:
+            start = time.perf_counter()
+            code, value = sem.Get(name, default)
+            self._countCall('Get', name, time.perf_counter() - start)
+            if code == 0:
+                with self._parameterLock:
+                    self._parameterCache[name] = (value, time.perf_counter())
+            values[name] = value
+        return values
+
+    def setParameter(self, name, value, priority=CommandQueue.normalPriority):
+        # Set a parameter unless the cache already holds the value.
+        value = float(value)
+        cachedValue = value / self._setScales.get(name, 1)
+        with self._parameterLock:
+            entry = self._parameterCache.get(name)
+            if entry is not None and time.perf_counter() - entry[1] <= self.parameterCacheLifetime and entry[0] == cachedValue:
+                self._skippedSets += 1
+                return 0
+        return self._commands.call(self._setOnBackend, name, value, cachedValue, priority=priority)
+
+    def setParameterAsync(self, name, value, priority=CommandQueue.normalPriority):
+        return self._commands.submit(self.setParameter, name, value, priority=priority)
+
+    def _setOnBackend(self, name, value, cachedValue):
+        start = time.perf_counter()
+        code = self.sem().Set(name, str(value))
+        self._countCall('Set', name, time.perf_counter() - start)
+        with self._parameterLock:
+            if code == 0:
+                self._parameterCache[name] = (cachedValue, time.perf_counter())
+            else:
+                self._parameterCache.pop(name, None)
+        return code
+
+    def clearParameterCache(self, names=None):
+        with self._parameterLock:
+            if names is None:
+                self._parameterCache.clear()
+            else:
+                for name in names:
+                    self._parameterCache.pop(name, None)
+
+    def latencies(self):
+        # Count, mean and maximum latency in s of the calls to the backend, by call and parameter.
+        with self._parameterLock:
+            return {'{} {}'.format(*key): {'count': count, 'mean': total / count, 'maximum': maximum}
+                    for key, (count, total, maximum) in self._latencies.items()}
+
+    def counters(self):
+        with self._parameterLock:
+            return {'getCalls': self._getCalls, 'setCalls': self._setCalls, 'cacheHits': self._cacheHits, 'skippedSets': self._skippedSets}
+
+    def _countCall(self, call, name, latency):
+        with self._parameterLock:
+            count, total, maximum = self._latencies.get((call, name), (0, 0.0, 0.0))
+            self._latencies[(call, name)] = (count + 1, total + latency, max(maximum, latency))
+            if call == 'Get':
+                instrumentation.record('comGet', latency)
+                self._getCalls += 1
+                self.meanGetLatency += (latency * 1000 - self.meanGetLatency) / self._getCalls
+            else:
+                instrumentation.record('comSet', latency)
+                self._setCalls += 1
+                self.meanSetLatency += (latency * 1000 - self.meanSetLatency) / self._setCalls
+
+    def stagingPath(self):
+        return os.path.join(self.stagingFolder, 'SemController-{}.bmp'.format(os.getpid()))
+
+    def grabArray(self, raster=None, out=None, priority=CommandQueue.normalPriority):
+        return self._commands.call(self._grabFromBackend, raster or self.raster(), out, priority=priority)
+
+    def grabArrayAsync(self, raster=None, out=None, priority=CommandQueue.normalPriority):
+        return self._commands.submit(self._grabFromBackend, raster or self.raster(), out, priority=priority)
+
+    def raster(self):
+        # Taken when the grab is submitted, so that a grab is not affected by changes made while it waits.
+        return (self.imageX, self.imageY, self.imageWidth, self.imageHeight, self.imageReduction)
+
+    def _grabFromBackend(self, raster, out=None):
+        # The staging file and buffer are only used on the owner thread.
+        sem = self.sem()
+        if self._backendGrabsArrays:
+            with instrumentation.stage('grab'):
+                return sem.GrabArray(*raster, out)
+        path = self.stagingPath()
+        with instrumentation.stage('grab'):
+            sem.Grab(*raster, path)
+        with instrumentation.stage('decode'):
+            return self.readStagingFile(path, out)
+
+    def readStagingFile(self, path, out=None):
+        # The whole file is read into a reused buffer and the pixels are parsed in place,
+        # the only copy made is the one flipping the rows into the returned array.
+        with open(path, 'rb', buffering=0) as file:
+            size = os.fstat(file.fileno()).st_size
+            if len(self._stagingBuffer) < size:
+                self._stagingBuffer = bytearray(size)
+            buffer = memoryview(self._stagingBuffer)[:size]
+            file.readinto(buffer)
+
+        header = numpy.frombuffer(buffer, dtype='<u4', count=3, offset=2)
+        pixelOffset = int(header[2])
+        dibSize, width, height = numpy.frombuffer(buffer, dtype='<i4', count=3, offset=14)
+        bitCount = int(numpy.frombuffer(buffer, dtype='<u2', count=1, offset=28)[0])
+        compression = int(numpy.frombuffer(buffer, dtype='<u4', count=1, offset=30)[0])
+        if bitCount != 8 or compression != 0:
+            image = Image.open(path)
+            image = numpy.asarray(image.convert('L'))
+            if out is None:
+                return numpy.ascontiguousarray(image)
+            numpy.copyto(out, image)
+            return out
+
+        width = int(width)
+        topDown = height < 0
+        height = abs(int(height))
+        stride = (width + 3) & ~3
+        pixels = numpy.frombuffer(buffer, dtype='uint8', count=stride*height, offset=pixelOffset)
+        pixels = pixels.reshape(height, stride)[:, :width]
+        if not topDown:
+            pixels = pixels[::-1]
+
+        if out is None:
+            out = numpy.empty((height, width), dtype='uint8')
+
+        colourCount = int(numpy.frombuffer(buffer, dtype='<u4', count=1, offset=46)[0]) or 256
+        palette = numpy.frombuffer(buffer, dtype='uint8', count=4*colourCount, offset=14+int(dibSize))
+        palette = palette.reshape(colourCount, 4)[:, 0]
+        if colourCount == 256 and (palette == numpy.arange(256)).all():
+            numpy.copyto(out, pixels)
+        else:
+            lookUpTable = numpy.zeros(256, dtype='uint8')
+            lookUpTable[:colourCount] = palette
+            numpy.take(lookUpTable, pixels, out=out)
+        return out
+
+    def deleteStagingFile(self):
+        try:
+            os.remove(self.stagingPath())
+        except OSError:
+            pass
+
     def grabImage(self):
-        filename = tempfile.TemporaryFile(suffix='.bmp').name
-        self.sem().Grab(self.imageX, self.imageY, self.imageWidth, self.imageHeight, self.imageReduction, filename)
-        return Image.open(filename)
+        return Image.fromarray(self.grabArray())
+
+    def guiClearParameterCache(self):
+        self.clearParameterCache()
+
+    def guiPrintLatencies(self):
+        logger.info('SemController: %(getCalls)s gets, %(setCalls)s sets, %(cacheHits)s cache hits, %(skippedSets)s sets skipped.', self.counters())
+        for name, latency in sorted(self.latencies().items()):
+            logger.info('SemController: %s, %s calls, mean %.3f ms, maximum %.3f ms.', name, latency['count'], latency['mean'] * 1000, latency['maximum'] * 1000)
+        logger.info('SemController: %s commands run, %s cancelled, %s waiting.', self._commands.executed, self._commands.cancelled, len(self._commands))
+        for priority, wait in sorted(self._commands.waitTimes().items()):
+            logger.info('SemController: priority %s, %s commands, mean wait %.3f ms, maximum wait %.3f ms.', priority, wait['count'], wait['mean'] * 1000, wait['maximum'] * 1000)
+
+    def guiCancelCommands(self):
+        logger.info('SemController: cancelled %s commands.', self.cancelCommands())
 
     def guiGrabAndSaveImage(self):
-        image = self.grabImage()
-        image.save('image.PNG', format='PNG')
+        # Grabbed and saved on a worker thread, so that neither the GUI nor the commands waiting in the queue
+        # are held up by the save, only the grab goes through the queue.
+        threading.Thread(target=self._grabAndSaveImage, daemon=True).start()
+
+    def _grabAndSaveImage(self):
+        try:
+            image = self.grabArray(priority=CommandQueue.highPriority)
+        except Exception as error:
+            logger.error('SemController: could not grab the image, %s.', error)
+            return
+        Image.fromarray(image).save('image.PNG', format='PNG')
 
 if __name__ == '__main__':
     import sys
     from PySide2 import QtWidgets
     from ObjectInspector import ObjectInspector
+    from Instrumentation import configureLogging
 
+    configureLogging()
     app = QtWidgets.QApplication(sys.argv)
     semc = ObjectInspector(SemController())
     semc.show()
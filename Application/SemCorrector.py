@@ -4,13 +4,25 @@
 #
 #   Brief:  Implement an algorithm for automatically correcting the focusing and astigmatism of an SEM.
 
+import os
 import time
 import numpy
+import logging
 import threading
+import concurrent.futures
 import matplotlib.pyplot as plt
 
+import FftEngine
 import MatrixWindows
+import SectorPowers
+from CommandQueue import CommandQueue
+from DriftTracker import DriftTracker
+from FocusEstimator import FocusEstimator
+from Instrumentation import instrumentation
 from SemImage import SemImage
+from SessionRecorder import SessionRecorder
+
+logger = logging.getLogger('SemCorrector')
 
 class SemCorrector:
 
@@ -27,11 +39,63 @@ class SemCorrector:
         self.workingDistanceOffset = 0.02 # In mm.
 
         self.frameWaitTimeFactor = 1.5
+        self.pipelined = False
+
+        # Coarse to fine correction starts at image reduction coarseLevels, with steps and offsets scaled by 2^level,
+        # and moves one level finer every time the working distance passes the focus.
+        # Stigmators are only corrected at level 0.
+        self.coarseToFine = False
+        self.coarseLevels = 2
+
+        # The focus estimator corrects all three settings at once from the fitted errors,
+        # stepping is used instead when the confidence of the fit is below focusEstimatorConfidence.
+        # Each correction is limited to a step, and errors within the tolerances of the estimator are left as corrected.
+        self.usingFocusEstimator = False
+        self.focusEstimatorConfidence = 0.9
+        self.focusEstimator = FocusEstimator()
+
+        # A through-focus series takes throughFocusFrames images spread over throughFocusSpan around the working distance,
+        # analyses them as one stack and moves the working distance to the peak of their FFT powers.
+        self.throughFocusFrames = 7
+        self.throughFocusSpan = 0.12 # In mm.
+        self.throughFocusDistances = None
+        self.throughFocusPowers = None
+
+        # A focus map measures a focus pair over a grid of focusMapColumns by focusMapRows tiles of the raster,
+        # cut from one frame or, with focusMapGrabbingTiles, grabbed as one small raster per tile,
+        # and analyses all the tiles as one stack. Each map holds a value per tile, normalised by the power of the tile:
+        # the defocus is positive where the tile is underfocused, the astigmatisms follow the signs of dP_r12 - dP_r34
+        # and dP_s12 - dP_s34 used to step the stigmators.
+        self.focusMapColumns = 4
+        self.focusMapRows = 3
+        self.focusMapGrabbingTiles = False
+        self.focusMapDefocus = None
+        self.focusMapAstigmatismX = None
+        self.focusMapAstigmatismY = None
+
+        # Each run records the frames of the focus pairs with their settings and sector powers
+        # into a new session folder in recordingFolder, see SessionRecorder.
+        self.recording = False
+        self.recordingFolder = 'Sessions'
+
+        self.detectingSettling = False
+        self.settleRasterWidth = 256
+        self.settleRasterHeight = 192
+        self.settleImageReduction = 0
+        self.settleTolerance = 0.0005 # Relative change of the FFT power of successive frames.
+        self.settleStableFrames = 3
+        # Settling also waits for the drift measured by driftTracker on the settle frames to become stable,
+        # unless the frames are too defocused for the drift to be measured.
+        self.settlingOnDrift = False
+        self.driftTracker = DriftTracker()
 
         self.applyHann = True
         self.applyDiscMask = False
+        self.usingRealFft = False
+        self.usingFftEngine = True
 
         self.discMaskRadius = 100
+        self.radialBins = 1
 
         self.defocusingThreshold = 0.05
         self.astigmatismThreshold = 0.002
@@ -40,180 +104,603 @@ class SemCorrector:
         self.wdIterations = None
         self.sxIterations = None
         self.syIterations = None
+        self.iterationTimes = None
+        self.waitTimes = None
+        self.fixedWaitTimes = None
 
         self.stigmatorCorrected = False
         self.workingDistanceCorrected = False
 
+        self._executor = None
+        self._recorder = None
+        self._runLock = threading.Lock()
+        self._runThread = None
+        self._stopping = False
+        self._level = 0
+        self._previousWd = None
+        self._previousRatio = None
+        self._waitTime = 0.0
+        self._fixedWaitTime = 0.0
+
     def iterate(self):
-        wd = self.sem.sem().Get("AP_WD", 0.0)[1] * 1000 # In mm.
-        sx = self.sem.sem().Get("AP_STIG_X", 0.0)[1] # In per cent.
-        sy = self.sem.sem().Get("AP_STIG_Y", 0.0)[1] # In per cent.
+        self.sem.clearParameterCache()
+        parameters = self.sem.getParameters(["AP_WD", "AP_STIG_X", "AP_STIG_Y"])
+        wd = parameters["AP_WD"] * 1000 # In mm.
+        sx = parameters["AP_STIG_X"] # In per cent.
+        sy = parameters["AP_STIG_Y"] # In per cent.
 
         self.wdIterations = [wd]
         self.sxIterations = [sx]
         self.syIterations = [sy]
+        self.iterationTimes = []
+        self.waitTimes = []
+        self.fixedWaitTimes = []
+
+        self._level = self.coarseLevels if self.coarseToFine else 0
+        self._previousRatio = None
+
+        # In pipelined mode the working distance of the next underfocused image is set as soon as it is known,
+        # so the working distance read back from the SEM is not the nominal one.
+        # The SEM is away from the nominal working distance wd from the start of each focus pair until its corrections are set,
+        # and is moved back to it if the run stops or fails in between.
+        underfocused = False
+        offNominal = False
+
+        if self.recording:
+            self._recorder = SessionRecorder(os.path.join(self.recordingFolder, time.strftime('Corrector-%Y%m%d-%H%M%S')))
+
+        try:
+            for iteration in range(self.numberOfIterations):
+                if self._stopping:
+                    break
+                logger.info("--------------------")
+                start = time.perf_counter()
+                self._waitTime = 0.0
+                self._fixedWaitTime = 0.0
+
+                raster = self.raster(self._level if self.coarseToFine else None)
+                scale = 2**self._level
+
+                parameters = self.sem.getParameters(["AP_WD", "AP_STIG_X", "AP_STIG_Y", "AP_FRAME_TIME"])
+                if not underfocused:
+                    wd = parameters["AP_WD"] * 1000 # In mm.
+                sx = parameters["AP_STIG_X"] # In per cent.
+                sy = parameters["AP_STIG_Y"] # In per cent.
+                ft = parameters["AP_FRAME_TIME"] / 1000 # In s.
+                logger.info("SemCorrector: start iteration.")
+                logger.info("Initial settings: \n"
+                            "Working distance %s mm.\n"
+                            "Stigmator X      %s.\n"
+                            "Stigmator Y      %s.\n"
+                            "Frame time       %s s.\n"
+                            "Level            %s.", wd, sx, sy, ft, self._level,
+                            extra={'event': 'initialSettings', 'iteration': iteration, 'workingDistance': wd,
+                                   'stigmatorX': sx, 'stigmatorY': sy, 'frameTime': ft, 'coarseLevel': self._level})
+
+                offNominal = True
+                powersUf, powersOf = self.measureFocusPair(wd, ft, underfocused, self.workingDistanceOffset * scale, raster)
+                P_uf = powersUf.total
+                P_uf_r12 = powersUf.r12
+                P_uf_r34 = powersUf.r34
+                P_uf_s12 = powersUf.s12
+                P_uf_s34 = powersUf.s34
+                logger.info("FFT of the underfocused image:\n"
+                            "P_uf     %s.\n"
+                            "P_uf_r12 %s.\n"
+                            "P_uf_r34 %s.\n"
+                            "P_uf_s12 %s.\n"
+                            "P_uf_s34 %s.", P_uf, P_uf_r12, P_uf_r34, P_uf_s12, P_uf_s34,
+                            extra={'event': 'underfocusedPowers', 'iteration': iteration, 'total': float(P_uf),
+                                   'r12': float(P_uf_r12), 'r34': float(P_uf_r34), 's12': float(P_uf_s12), 's34': float(P_uf_s34)})
+
+                P_of = powersOf.total
+                P_of_r12 = powersOf.r12
+                P_of_r34 = powersOf.r34
+                P_of_s12 = powersOf.s12
+                P_of_s34 = powersOf.s34
+                logger.info("FFT of the overfocused image:\n"
+                            "P_of     %s.\n"
+                            "P_of_r12 %s.\n"
+                            "P_of_r34 %s.\n"
+                            "P_of_s12 %s.\n"
+                            "P_of_s34 %s.", P_of, P_of_r12, P_of_r34, P_of_s12, P_of_s34,
+                            extra={'event': 'overfocusedPowers', 'iteration': iteration, 'total': float(P_of),
+                                   'r12': float(P_of_r12), 'r34': float(P_of_r34), 's12': float(P_of_s12), 's34': float(P_of_s34)})
+
+                dP = (P_of - P_uf)
+                dP_r12 = (P_of_r12 - P_uf_r12)
+                dP_r34 = (P_of_r34 - P_uf_r34)
+                dP_s12 = (P_of_s12 - P_uf_s12)
+                dP_s34 = (P_of_s34 - P_uf_s34)
+                logger.info("Differences in FFT of the images:\n"
+                            "dP:     %s.\n"
+                            "dP_r12: %s.\n"
+                            "dP_r34: %s.\n"
+                            "dP_s12: %s.\n"
+                            "dP_s34: %s.", dP, dP_r12, dP_r34, dP_s12, dP_s34,
+                            extra={'event': 'powerDifferences', 'iteration': iteration, 'total': float(dP),
+                                   'r12': float(dP_r12), 'r34': float(dP_r34), 's12': float(dP_s12), 's34': float(dP_s34)})
 
-        for _ in range(self.numberOfIterations):
-            print("--------------------")
-            
-            self.sem.imageX = self.rasterX
-            self.sem.imageY = self.rasterY
-            self.sem.imageWidth = self.rasterWidth
-            self.sem.imageHeight = self.rasterHeight
-
-            wd = self.sem.sem().Get("AP_WD", 0.0)[1] * 1000 # In mm.
-            sx = self.sem.sem().Get("AP_STIG_X", 0.0)[1] # In per cent.
-            sy = self.sem.sem().Get("AP_STIG_Y", 0.0)[1] # In per cent.
-            ft = self.sem.sem().Get("AP_FRAME_TIME", 0.0)[1] / 1000 # In s.
-            print("SemCorrector: start iteration.")
-            print("Initial settings: ")
-            print("Working distance {} mm.".format(wd))
-            print("Stigmator X      {}.".format(sx))
-            print("Stigmator Y      {}.".format(sy))
-            print("Frame time       {} s.".format(ft))
-
-            segmentMasks = MatrixWindows.segmentMasks(self.rasterWidth, self.rasterHeight)
-            r12 = segmentMasks[0]
-            s12 = segmentMasks[1]
-            r34 = segmentMasks[2]
-            s34 = segmentMasks[3]
-
-            self.sem.sem().Set("AP_WD", str(wd - self.workingDistanceOffset))
-            time.sleep(self.frameWaitTimeFactor * ft)
-            image = self.sem.grabImage()
-            imageUf = SemImage(image)
-            if self.applyHann:
-                imageUf.applyHann()
-            fft = imageUf.fft()
-            if self.applyDiscMask:
-                discMask = MatrixWindows.discMask(self.rasterWidth, self.rasterHeight, self.discMaskRadius)
-                fft = numpy.multiply(fft, discMask)
-            P_uf = fft.sum()
-            P_uf_r12 = numpy.multiply(fft, r12).sum()
-            P_uf_r34 = numpy.multiply(fft, r34).sum()
-            P_uf_s12 = numpy.multiply(fft, s12).sum()
-            P_uf_s34 = numpy.multiply(fft, s34).sum()
-            print("FFT of the underfocused image:")
-            print("P_uf     {}.".format(P_uf))
-            print("P_uf_r12 {}.".format(P_uf_r12))
-            print("P_uf_r34 {}.".format(P_uf_r34))
-            print("P_uf_s12 {}.".format(P_uf_s12))
-            print("P_uf_s34 {}.".format(P_uf_s34))
-
-            self.sem.sem().Set("AP_WD", str(wd + self.workingDistanceOffset))
-            time.sleep(self.frameWaitTimeFactor * ft)
-            image = self.sem.grabImage()
-            imageOf = SemImage(image)
-            if self.applyHann:
-                imageOf.applyHann()
-            fft = imageOf.fft()
-            if self.applyDiscMask:
-                discMask = MatrixWindows.discMask(self.rasterWidth, self.rasterHeight, self.discMaskRadius)
-                fft = numpy.multiply(fft, discMask)
-            P_of = fft.sum()
-            P_of_r12 = numpy.multiply(fft, r12).sum()
-            P_of_r34 = numpy.multiply(fft, r34).sum()
-            P_of_s12 = numpy.multiply(fft, s12).sum()
-            P_of_s34 = numpy.multiply(fft, s34).sum()
-            print("FFT of the overfocused image:")
-            print("P_of     {}.".format(P_of))
-            print("P_of_r12 {}.".format(P_of_r12))
-            print("P_of_r34 {}.".format(P_of_r34))
-            print("P_of_s12 {}.".format(P_of_s12))
-            print("P_of_s34 {}.".format(P_of_s34))
-
-            dP = (P_of - P_uf)
-            dP_r12 = (P_of_r12 - P_uf_r12)
-            dP_r34 = (P_of_r34 - P_uf_r34)
-            dP_s12 = (P_of_s12 - P_uf_s12)
-            dP_s34 = (P_of_s34 - P_uf_s34)
-            print("Differences in FFT of the images:")
-            print("dP:     {}.".format(dP))
-            print("dP_r12: {}.".format(dP_r12))
-            print("dP_r34: {}.".format(dP_r34))
-            print("dP_s12: {}.".format(dP_s12))
-            print("dP_s34: {}.".format(dP_s34))
-
-            self.sem.sem().Set("AP_WD", str(wd))
-
-            if not self.workingDistanceCorrected:
-                if abs(dP) > self.defocusingThreshold:
-                    self.adjustWorkingDistance(dP, wd)        
+                estimate = None
+                if scale == 1 and self.usingFocusEstimator:
+                    height, width = powersUf.frameShape
+                    estimate = self.focusEstimator.estimate(powersUf.polarPowers, powersOf.polarPowers, width, height, self.workingDistanceOffset, self.rasterWidth / width)
+                    logger.info("Estimated errors:\n"
+                                "Working distance %s mm.\n"
+                                "Stigmator X      %s.\n"
+                                "Stigmator Y      %s.\n"
+                                "Confidence       %s.", estimate.workingDistance, estimate.stigmatorX, estimate.stigmatorY, estimate.confidence,
+                                extra={'event': 'estimatedErrors', 'iteration': iteration, 'workingDistance': estimate.workingDistance,
+                                       'stigmatorX': estimate.stigmatorX, 'stigmatorY': estimate.stigmatorY, 'confidence': estimate.confidence})
+
+                underfocused = self.pipelined and iteration < self.numberOfIterations - 1
+                if scale > 1:
+                    newWd = self.stepWorkingDistanceCoarsely(numpy.log(P_of / P_uf), wd)
+                    offset = -self.workingDistanceOffset * 2**self._level if underfocused else 0.0
+                    self.sem.setParameter("AP_WD", newWd + offset)
+                elif estimate is not None and estimate.confidence >= self.focusEstimatorConfidence:
+                    offset = -self.workingDistanceOffset if underfocused else 0.0
+                    newWd = self.applyFocusEstimate(estimate, wd, sx, sy, offset)
+                else:
+                    offset = -self.workingDistanceOffset if underfocused else 0.0
+                    newWd = wd
+                    if not self.workingDistanceCorrected:
+                        if abs(dP) > self.defocusingThreshold:
+                            newWd = self.adjustWorkingDistance(dP, wd, offset)
+                        else:
+                            self.workingDistanceCorrected = True
+                    if newWd == wd:
+                        self.sem.setParameter("AP_WD", wd + offset)
+
+                    if not self.stigmatorCorrected:
+                        if abs(dP_r12) > self.astigmatismThreshold or abs(dP_r34) > self.astigmatismThreshold:
+                            self.adjustStigmatorX(dP_r12, dP_r34, sx)
+                        elif abs(dP_s12) > self.astigmatismThreshold or abs(dP_s34) > self.astigmatismThreshold:
+                            self.adjustStigmatorY(dP_s12, dP_s34, sy)
+                        else:
+                            self.stigmatorCorrected = True
+
+                if underfocused:
+                    wd = newWd
+                offNominal = underfocused
+
+                parameters = self.sem.getParameters(["AP_WD", "AP_STIG_X", "AP_STIG_Y", "AP_FRAME_TIME"])
+                if not underfocused:
+                    wd = parameters["AP_WD"] * 1000 # In mm.
+                sx = parameters["AP_STIG_X"] # In per cent.
+                sy = parameters["AP_STIG_Y"] # In per cent.
+                ft = parameters["AP_FRAME_TIME"] / 1000 # In s.
+                logger.info("Final settings: \n"
+                            "Working distance %s mm.\n"
+                            "Stigmator X      %s.\n"
+                            "Stigmator Y      %s.\n"
+                            "Frame time       %s s.", wd, sx, sy, ft,
+                            extra={'event': 'finalSettings', 'iteration': iteration, 'workingDistance': wd,
+                                   'stigmatorX': sx, 'stigmatorY': sy, 'frameTime': ft})
+
+                self.wdIterations.append(wd)
+                self.sxIterations.append(sx)
+                self.syIterations.append(sy)
+
+                self.iterationTimes.append(time.perf_counter() - start)
+                self.waitTimes.append(self._waitTime)
+                self.fixedWaitTimes.append(self._fixedWaitTime)
+                instrumentation.record('iteration', self.iterationTimes[-1])
+                logger.info("Iteration time   %s s.\n"
+                            "Wait time        %s s, %s s saved.", self.iterationTimes[-1], self._waitTime, self._fixedWaitTime - self._waitTime,
+                            extra={'event': 'iterationTime', 'iteration': iteration, 'iterationTime': self.iterationTimes[-1],
+                                   'waitTime': self._waitTime, 'fixedWaitTime': self._fixedWaitTime})
+        finally:
+            if offNominal:
+                self.sem.setParameter("AP_WD", wd)
+            if self._recorder is not None:
+                self._recorder.close()
+                self._recorder = None
+
+    def measureFocusPair(self, wd, ft, underfocused=False, offset=None, raster=None):
+        # In pipelined mode the underfocused image is analysed while the overfocused image is acquired.
+        if offset is None:
+            offset = self.workingDistanceOffset
+        imageUf = self.acquireImage(wd - offset, ft, underfocused, raster)
+        if self.pipelined:
+            powersUf = self._analysisExecutor().submit(self.sectorPowers, imageUf)
+            imageOf = self.acquireImage(wd + offset, ft, raster=raster)
+            powersOf = self.sectorPowers(imageOf)
+            powersUf = powersUf.result()
+        else:
+            powersUf = self.sectorPowers(imageUf)
+            imageOf = self.acquireImage(wd + offset, ft, raster=raster)
+            powersOf = self.sectorPowers(imageOf)
+        if self._recorder is not None:
+            self.recordFrame(imageUf, wd - offset, ft, powersUf, wd)
+            self.recordFrame(imageOf, wd + offset, ft, powersOf, wd)
+        return (powersUf, powersOf)
+
+    def recordFrame(self, image, wd, ft, powers, nominalWd):
+        # wd is the working distance of the frame, nominalWd the setting it was offset from, which a replay reads back.
+        sx = self.sem.getParameter("AP_STIG_X") # In per cent.
+        sy = self.sem.getParameter("AP_STIG_Y") # In per cent.
+        sectorPowers = {'total': powers.total, 'r12': powers.r12, 's12': powers.s12, 'r34': powers.r34, 's34': powers.s34}
+        sectorPowers = {name: float(value) for name, value in sectorPowers.items()}
+        self._recorder.record(image, workingDistance=float(wd), nominalWorkingDistance=float(nominalWd), stigmatorX=float(sx), stigmatorY=float(sy), frameTime=float(ft), level=self._level, sectorPowers=sectorPowers)
+
+    def raster(self, reduction=None):
+        # The raster grabbed by the corrector as (x, y, width, height, reduction), passed with each grab
+        # so that the raster of the controller, which SemImageViewer grabs, is never changed.
+        if reduction is None:
+            reduction = self.sem.imageReduction
+        return (self.rasterX, self.rasterY, self.rasterWidth, self.rasterHeight, reduction)
+
+    def acquireImage(self, wd, ft, alreadySet=False, raster=None):
+        if raster is None:
+            raster = self.raster()
+        if not alreadySet:
+            self.sem.setParameter("AP_WD", wd)
+        self.waitForSettling(ft, raster)
+        return self.sem.grabArray(raster)
+
+    def waitForSettling(self, ft, raster=None):
+        # Poll small, cheap frames from the middle of the raster until the FFT energy of successive frames stops changing,
+        # falling back to the fixed wait if it does not settle within that time.
+        fixedWait = self.frameWaitTimeFactor * ft
+        start = time.perf_counter()
+        if not self.detectingSettling:
+            time.sleep(fixedWait)
+        else:
+            x, y, width, height, _ = raster if raster is not None else self.raster()
+            settleWidth = min(self.settleRasterWidth, width)
+            settleHeight = min(self.settleRasterHeight, height)
+            settleRaster = (x + (width - settleWidth) // 2, y + (height - settleHeight) // 2, settleWidth, settleHeight, self.settleImageReduction)
+            if self.settlingOnDrift:
+                self.driftTracker.reset()
+            previousMetric = None
+            stableFrames = 0
+            while time.perf_counter() - start < fixedWait:
+                image = self.settleImage(self.sem.grabArray(settleRaster))
+                metric = self.settleMetric(image)
+                if self.settlingOnDrift:
+                    self.driftTracker.update(image)
+                if previousMetric is not None and abs(metric - previousMetric) <= self.settleTolerance * abs(previousMetric):
+                    stableFrames += 1
+                    driftSettled = self.driftTracker.stable or not self.driftTracker.reliable
+                    if stableFrames >= self.settleStableFrames and (not self.settlingOnDrift or driftSettled):
+                        break
                 else:
-                    self.workingDistanceCorrected = True
+                    stableFrames = 0
+                previousMetric = metric
+        self._waitTime += time.perf_counter() - start
+        self._fixedWaitTime += fixedWait
+        instrumentation.record('settleWait', time.perf_counter() - start)
+
+    def settleImage(self, frame):
+        image = SemImage(frame, FftEngine.fftEngine(frame.shape, onDevice=True))
+        image.applyHann()
+        return image
+
+    def settleMetric(self, image):
+        # The half spectrum computed here is reused by driftTracker.
+        return float(image.halfPower().sum())
 
-            if not self.stigmatorCorrected:
-                if abs(dP_r12) > self.astigmatismThreshold or abs(dP_r34) > self.astigmatismThreshold:
-                    self.adjustStigmatorX(dP_r12, dP_r34, sx)
-                elif abs(dP_s12) > self.astigmatismThreshold or abs(dP_s34) > self.astigmatismThreshold:
-                    self.adjustStigmatorY(dP_s12, dP_s34, sy)
+    def sectorPowers(self, image):
+        shape = image.shape
+        width = image.shape[1]
+        if self.usingFftEngine:
+            image = SemImage(image, FftEngine.fftEngine(image.shape, onDevice=True))
+        else:
+            image = SemImage(image)
+        if self.applyHann:
+            with instrumentation.stage('window'):
+                image.applyHann()
+        radius = self.discMaskRadius * width / self.rasterWidth if self.applyDiscMask else None
+        with instrumentation.stage('fft'):
+            fft = image.halfFft() if self.usingRealFft else image.fft()
+        with instrumentation.stage('maskReduction'):
+            if self.usingRealFft:
+                powers = SectorPowers.halfSectorPowers(fft, width, radius, self.radialBins)
+            else:
+                powers = SectorPowers.sectorPowers(fft, radius, self.radialBins)
+        powers.frameShape = shape
+        if self.usingFocusEstimator:
+            powers.polarPowers = self.focusEstimator.polarPowers(image.halfPower(), width)
+        return powers
+
+    def focusThroughSeries(self):
+        wd = self.sem.getParameter("AP_WD") * 1000 # In mm.
+        ft = self.sem.getParameter("AP_FRAME_TIME") / 1000 # In s.
+        logger.info("SemCorrector: start through-focus series.")
+        logger.info("Working distance %s mm.", wd)
+
+        start = time.perf_counter()
+        # The working distance is moved back to where it started if the series stops or fails before the peak is found.
+        peak = wd
+        try:
+            distances = numpy.linspace(wd - self.throughFocusSpan / 2, wd + self.throughFocusSpan / 2, self.throughFocusFrames)
+            stack = self.acquireSeries(distances, ft)
+            acquired = time.perf_counter()
+            powers = numpy.array([powers.total for powers in self.sectorPowersBatch(stack)])
+            peak = self.fitFocusPeak(distances, powers)
+        finally:
+            self.sem.setParameter("AP_WD", peak)
+
+        self.throughFocusDistances = distances
+        self.throughFocusPowers = powers
+        analysed = time.perf_counter()
+        logger.info("Focus peak       %s mm.\n"
+                    "Acquisition time %s s.\n"
+                    "Analysis time    %s s.", peak, acquired - start, analysed - acquired,
+                    extra={'event': 'throughFocusPeak', 'focusPeak': float(peak), 'acquisitionTime': acquired - start, 'analysisTime': analysed - acquired})
+        return peak
+
+    def acquireSeries(self, distances, ft):
+        # The frames are grabbed straight into one (N, H, W) stack.
+        raster = self.raster()
+        stack = None
+        for i, wd in enumerate(distances):
+            self.sem.setParameter("AP_WD", wd)
+            self.waitForSettling(ft, raster)
+            if stack is None:
+                frame = self.sem.grabArray(raster)
+                stack = numpy.empty((len(distances),) + frame.shape, dtype=frame.dtype)
+                stack[0] = frame
+            else:
+                self.sem.grabArray(raster, out=stack[i])
+        return stack
+
+    def sectorPowersBatch(self, stack):
+        # Window, transform and reduce all the frames of the stack in single calls.
+        width = stack.shape[2]
+        engine = FftEngine.fftEngine(stack.shape, onDevice=True)
+        images = engine.buffer('windowed', stack.shape, 'float32')
+        images[...] = stack
+        if self.applyHann:
+            images *= MatrixWindows.hann(stack.shape[1], stack.shape[2], returnCupy=engine.onDevice)
+        radius = self.discMaskRadius * width / self.rasterWidth if self.applyDiscMask else None
+        if self.usingRealFft:
+            ffts = engine.halfPower(images)
+            ffts **= 0.5
+            return SectorPowers.halfSectorPowersBatch(ffts, width, radius, self.radialBins)
+        return SectorPowers.sectorPowersBatch(engine.fft(images), radius, self.radialBins)
+
+    def fitFocusPeak(self, distances, powers):
+        # Fit a parabola to the log powers around the largest one, which is exact for a Gaussian peak.
+        # The best distance of the series is used if the peak is not inside it.
+        best = int(numpy.argmax(powers))
+        first = max(best - 2, 0)
+        last = min(best + 3, len(powers))
+        if best == 0 or best == len(powers) - 1 or last - first < 3:
+            logger.warning("SemCorrector: the focus peak is not inside the series.")
+            return float(distances[best])
+        a, b, _ = numpy.polyfit(distances[first:last], numpy.log(powers[first:last]), 2)
+        if a >= 0:
+            return float(distances[best])
+        return float(numpy.clip(-b / (2 * a), distances[first], distances[last - 1]))
+
+    def focusMap(self):
+        self.sem.clearParameterCache()
+        parameters = self.sem.getParameters(["AP_WD", "AP_FRAME_TIME"])
+        wd = parameters["AP_WD"] * 1000 # In mm.
+        ft = parameters["AP_FRAME_TIME"] / 1000 # In s.
+        logger.info("SemCorrector: start focus map.")
+
+        start = time.perf_counter()
+        try:
+            tilesUf = self.acquireTiles(wd - self.workingDistanceOffset, ft)
+            tilesOf = self.acquireTiles(wd + self.workingDistanceOffset, ft)
+        finally:
+            self.sem.setParameter("AP_WD", wd)
+        acquired = time.perf_counter()
+        powersUf = self.sectorPowersBatch(tilesUf)
+        powersOf = self.sectorPowersBatch(tilesOf)
+
+        shape = (self.focusMapRows, self.focusMapColumns)
+        defocus = numpy.empty(len(powersUf))
+        astigmatismX = numpy.empty(len(powersUf))
+        astigmatismY = numpy.empty(len(powersUf))
+        for i, (uf, of) in enumerate(zip(powersUf, powersOf)):
+            total = uf.total + of.total
+            d = of - uf
+            defocus[i] = d.total / total
+            astigmatismX[i] = (d.r12 - d.r34) / total
+            astigmatismY[i] = (d.s12 - d.s34) / total
+        self.focusMapDefocus = defocus.reshape(shape)
+        self.focusMapAstigmatismX = astigmatismX.reshape(shape)
+        self.focusMapAstigmatismY = astigmatismY.reshape(shape)
+        analysed = time.perf_counter()
+        logger.info("Tiles            %s by %s.\n"
+                    "Acquisition time %s s.\n"
+                    "Analysis time    %s s.", self.focusMapColumns, self.focusMapRows, acquired - start, analysed - acquired,
+                    extra={'event': 'focusMap', 'workingDistance': wd, 'defocus': self.focusMapDefocus.tolist(),
+                           'astigmatismX': self.focusMapAstigmatismX.tolist(), 'astigmatismY': self.focusMapAstigmatismY.tolist(),
+                           'acquisitionTime': acquired - start, 'analysisTime': analysed - acquired})
+        return self.focusMapDefocus, self.focusMapAstigmatismX, self.focusMapAstigmatismY
+
+    def acquireTiles(self, wd, ft):
+        # Gives the tiles of the raster at the working distance as an (N, H, W) stack, in rows from the top left.
+        tileWidth = self.rasterWidth // self.focusMapColumns
+        tileHeight = self.rasterHeight // self.focusMapRows
+        raster = self.raster()
+        self.sem.setParameter("AP_WD", wd)
+        self.waitForSettling(ft, raster)
+        if not self.focusMapGrabbingTiles:
+            return self.splitIntoTiles(self.sem.grabArray(raster))
+        stack = None
+        for row in range(self.focusMapRows):
+            for column in range(self.focusMapColumns):
+                tileRaster = (self.rasterX + column * tileWidth, self.rasterY + row * tileHeight, tileWidth, tileHeight, raster[4])
+                if stack is None:
+                    tile = self.sem.grabArray(tileRaster)
+                    stack = numpy.empty((self.focusMapRows * self.focusMapColumns,) + tile.shape, dtype=tile.dtype)
+                    stack[0] = tile
                 else:
-                    self.stigmatorCorrected = True
-
-            wd = self.sem.sem().Get("AP_WD", 0.0)[1] * 1000 # In mm.
-            sx = self.sem.sem().Get("AP_STIG_X", 0.0)[1] # In per cent.
-            sy = self.sem.sem().Get("AP_STIG_Y", 0.0)[1] # In per cent.
-            ft = self.sem.sem().Get("AP_FRAME_TIME", 0.0)[1] / 1000 # In s.
-            print("Final settings: ")
-            print("Working distance {} mm.".format(wd))
-            print("Stigmator X      {}.".format(sx))
-            print("Stigmator Y      {}.".format(sy))
-            print("Frame time       {} s.".format(ft))
-
-            self.wdIterations.append(wd)
-            self.sxIterations.append(sx)
-            self.syIterations.append(sy)
-            
-    def adjustWorkingDistance(self, dP, wd):
+                    self.sem.grabArray(tileRaster, out=stack[row * self.focusMapColumns + column])
+        return stack
+
+    def splitIntoTiles(self, frame):
+        # A view of the frame as an (N, H, W) stack of tiles, the pixels left over at the right and bottom are dropped.
+        tileHeight = frame.shape[0] // self.focusMapRows
+        tileWidth = frame.shape[1] // self.focusMapColumns
+        tiles = frame[:tileHeight * self.focusMapRows, :tileWidth * self.focusMapColumns]
+        tiles = tiles.reshape(self.focusMapRows, tileHeight, self.focusMapColumns, tileWidth).swapaxes(1, 2)
+        return tiles.reshape(-1, tileHeight, tileWidth)
+
+    def adjustWorkingDistance(self, dP, wd, offset=0.0):
         if dP > 0:
-            self.sem.sem().Set("AP_WD", str(wd + self.workingDistanceStep))
-            print("Increased working distance.")
+            wd = wd + self.workingDistanceStep
+            logger.info("Increased working distance.")
         else:
-            self.sem.sem().Set("AP_WD", str(wd - self.workingDistanceStep))
-            print("Decreased working distance.")
+            wd = wd - self.workingDistanceStep
+            logger.info("Decreased working distance.")
+        self.sem.setParameter("AP_WD", wd + offset)
+        return wd
+
+    def stepWorkingDistanceCoarsely(self, ratio, wd):
+        # ratio is log(P_of / P_uf), which changes sign at the focus.
+        # The step is the secant estimate of the focus from the last two iterations, limited to the step of the level.
+        levelStep = self.workingDistanceStep * 2**self._level
+        step = levelStep if ratio > 0 else -levelStep
+        previousWd = self._previousWd
+        previousRatio = self._previousRatio
+        self._previousWd = wd
+        self._previousRatio = ratio
+        if previousRatio is not None and ratio != previousRatio and wd != previousWd:
+            secant = -ratio * (wd - previousWd) / (ratio - previousRatio)
+            if secant * step > 0:
+                step = numpy.sign(step) * min(max(abs(secant), self.workingDistanceStep), levelStep)
+        if previousRatio is not None and (ratio > 0) != (previousRatio > 0):
+            self._level -= 1
+            self._previousRatio = None
+            logger.info("Passed the focus, moved to level %s.", self._level)
+        logger.info("Stepped working distance by %s mm.", step)
+        return float(wd + step)
+
+    def applyFocusEstimate(self, estimate, wd, sx, sy, offset=0.0):
+        wdStep = max(self.workingDistanceStep, self.workingDistanceOffset)
+        self.workingDistanceCorrected = abs(estimate.workingDistance) <= self.focusEstimator.workingDistanceTolerance
+        if not self.workingDistanceCorrected:
+            wd = wd - float(numpy.clip(estimate.workingDistance, -wdStep, wdStep))
+        self.sem.setParameter("AP_WD", wd + offset)
+
+        tolerance = self.focusEstimator.stigmatorTolerance
+        self.stigmatorCorrected = abs(estimate.stigmatorX) <= tolerance and abs(estimate.stigmatorY) <= tolerance
+        if abs(estimate.stigmatorX) > tolerance:
+            self.sem.setParameter("AP_STIG_X", sx - float(numpy.clip(estimate.stigmatorX, -self.stigmatorStep, self.stigmatorStep)))
+        if abs(estimate.stigmatorY) > tolerance:
+            self.sem.setParameter("AP_STIG_Y", sy - float(numpy.clip(estimate.stigmatorY, -self.stigmatorStep, self.stigmatorStep)))
+        logger.info("Applied the estimated corrections.")
+        return wd
 
     def adjustStigmatorX(self, dP_r12, dP_r34, sx):
         if dP_r12 - dP_r34 > self.astigmatismThreshold:
-            self.sem.sem().Set("AP_STIG_X", str(sx - self.stigmatorStep))
-            print("Decreased stigmator X.")
+            self.sem.setParameter("AP_STIG_X", sx - self.stigmatorStep)
+            logger.info("Decreased stigmator X.")
         elif dP_r34 - dP_r12 > self.astigmatismThreshold:
-            self.sem.sem().Set("AP_STIG_X", str(sx + self.stigmatorStep))
-            print("Increased stigmator X.")
+            self.sem.setParameter("AP_STIG_X", sx + self.stigmatorStep)
+            logger.info("Increased stigmator X.")
 
     def adjustStigmatorY(self, dP_s12, dP_s34, sy):
         if dP_s12 - dP_s34 > self.astigmatismThreshold:
-            self.sem.sem().Set("AP_STIG_Y", str(sy - self.stigmatorStep))
-            print("Decreased stigmator Y.")
+            self.sem.setParameter("AP_STIG_Y", sy - self.stigmatorStep)
+            logger.info("Decreased stigmator Y.")
         elif dP_s34 - dP_s12 > self.astigmatismThreshold:
-            self.sem.sem().Set("AP_STIG_Y", str(sy + self.stigmatorStep))
-            print("Increased stigmator Y.")
+            self.sem.setParameter("AP_STIG_Y", sy + self.stigmatorStep)
+            logger.info("Increased stigmator Y.")
 
-    def guiRun(self):
-        thread = threading.Thread(target=self.iterate)
+    def _analysisExecutor(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return self._executor
+
+    def runInBackground(self, function):
+        # Only one run at a time, a second run would move the same settings as the first.
+        if not self._runLock.acquire(blocking=False):
+            logger.warning('SemCorrector: a run is already in progress.')
+            return None
+        self._stopping = False
+        thread = threading.Thread(target=self._run, args=(function,))
+        self._runThread = thread
         thread.start()
+        return thread
+
+    def _run(self, function):
+        try:
+            function()
+        except concurrent.futures.CancelledError:
+            pass
+        finally:
+            if self._stopping:
+                logger.info('SemCorrector: stopped.')
+            self._runLock.release()
+
+    def stop(self):
+        # The run stops at its next iteration, or at once if one of its commands was waiting for the SEM.
+        # Only the commands of the run are cancelled, those of other callers such as SemImageViewer are left waiting.
+        self._stopping = True
+        if self._runThread is not None:
+            self.sem.cancelCommands(CommandQueue.normalPriority, self._runThread)
+
+    def guiRun(self):
+        self.runInBackground(self.iterate)
+
+    def guiRunThroughFocus(self):
+        self.runInBackground(self.focusThroughSeries)
+
+    def guiRunFocusMap(self):
+        self.runInBackground(self.focusMap)
+
+    def guiStop(self):
+        self.stop()
 
     def guiPlotSettings(self):
         if self.wdIterations is None:
-            print('SemCorrector: run a few iterations first.')
+            logger.warning('SemCorrector: run a few iterations first.')
             return
         plt.figure()
         plt.subplot(211)
-        plt.plot(range(self.numberOfIterations + 1), self.wdIterations, 'r^')
+        # A stopped run has fewer iterations than numberOfIterations.
+        iterations = range(len(self.wdIterations))
+        plt.plot(iterations, self.wdIterations, 'r^')
         plt.ylabel('Working Distance')
         plt.subplot(212)
-        plt.plot(range(self.numberOfIterations + 1), self.sxIterations, 'g^', label='Stigmator X')
-        plt.plot(range(self.numberOfIterations + 1), self.syIterations, 'b^', label='Stigmator Y')
+        plt.plot(iterations, self.sxIterations, 'g^', label='Stigmator X')
+        plt.plot(iterations, self.syIterations, 'b^', label='Stigmator Y')
         plt.xlabel('Iteration')
         plt.ylabel('Stigmator Setting')
         plt.legend(loc='upper right')
         plt.show()
 
+    def guiPlotThroughFocus(self):
+        if self.throughFocusDistances is None:
+            logger.warning('SemCorrector: run a through-focus series first.')
+            return
+        plt.figure()
+        plt.plot(self.throughFocusDistances, self.throughFocusPowers, 'r^')
+        plt.xlabel('Working Distance')
+        plt.ylabel('FFT Power')
+        plt.show()
+
+    def guiPlotFocusMap(self):
+        if self.focusMapDefocus is None:
+            logger.warning('SemCorrector: run a focus map first.')
+            return
+        plt.figure()
+        maps = [(self.focusMapDefocus, 'Defocus'), (self.focusMapAstigmatismX, 'Astigmatism X'), (self.focusMapAstigmatismY, 'Astigmatism Y')]
+        for i, (values, title) in enumerate(maps):
+            plt.subplot(1, 3, i + 1)
+            limit = numpy.abs(values).max() or 1
+            plt.imshow(values, cmap='coolwarm', vmin=-limit, vmax=limit)
+            plt.colorbar(orientation='horizontal')
+            plt.title(title)
+            plt.axis('off')
+        plt.show()
+
 if __name__ == '__main__':
     import sys
     from PySide2 import QtWidgets
     from SemController import SemController
     from ObjectInspector import ObjectInspector
+    from Instrumentation import configureLogging
 
+    configureLogging()
     app = QtWidgets.QApplication(sys.argv)
     semc = ObjectInspector(SemCorrector(SemController()))
     semc.show()
@@ -1,30 +1,58 @@
 #   File:   SemImage.py
 #
 #   Author: Liuchuyao Xu, 2020
+#
+#   Brief:  Implement the SemImage classes, which hold an image with its FFT and histogram.
+#           fft gives the shifted magnitude of the full complex FFT.
+#           halfPower gives the squared magnitude of the real-input FFT in float32,
+#           which only holds the columns of non-negative frequencies and is shifted along the rows only.
+#           halfFft gives the magnitude of the same half-plane.
+#           halfSpectrum gives the complex real-input FFT that halfPower is computed from, unshifted, for DriftTracker.
+#           With an FftEngine it is a buffer of the engine, valid while the following frames of the thread are processed.
+#           With an FftEngine, the windowed image and the spectra are written into the buffers of the engine,
+#           they can also be written into given arrays with the out arguments of applyHann, updateFft and updateHalfPower.
+#           displayImage and displayFft reduce and quantise the image and the spectrum for drawing before they leave the GPU.
+
+import numpy
+import logging
+
+import FftEngine
+import MatrixWindows
+import DisplayPreparation
+import HistogramEqualisation
+
+logger = logging.getLogger('SemImage')
 
 try:
     import cupy
 except:
-    import numpy
     cupy = None
-    print('SemImage: could not import cupy, GPU acceleration will be disabled.')
+    logger.warning('SemImage: could not import cupy, GPU acceleration will be disabled.')
 
-def SemImage(image):
+try:
+    from scipy import fft as realFft
+except:
+    realFft = numpy.fft
+
+def SemImage(image, engine=None):
     if cupy:
-        return SemImageCupy(image)
+        return SemImageCupy(image, engine)
     else:
-        return SemImageNumpy(image)
+        return SemImageNumpy(image, engine)
 
 class SemImageCupy:
 
-    def __init__(self, image=None):
+    def __init__(self, image=None, engine=None):
         self.bitDepth = 8
-        
+        self.engine = engine
+
         self._image = None
         self._fft = None
+        self._halfPower = None
+        self._halfSpectrum = None
         self._histogram = None
 
-        if image:
+        if image is not None:
             self.setImage(image)
 
     def image(self, returnCupy=False):
@@ -40,7 +68,7 @@ class SemImageCupy:
         if returnCupy:
             return self._histogram
         else:
-            return cupy.asnumpy(self._histogram)
+            return (cupy.asnumpy(self._histogram[0]), cupy.asnumpy(self._histogram[1]))
 
     def fft(self, returnCupy=False):
         if self._fft is None:
@@ -51,59 +79,126 @@ class SemImageCupy:
         else:
             return cupy.asnumpy(self._fft)
 
+    def halfPower(self, returnCupy=False):
+        if self._halfPower is None:
+            self.updateHalfPower()
+
+        if returnCupy:
+            return self._halfPower
+        else:
+            return cupy.asnumpy(self._halfPower)
+
+    def halfFft(self, returnCupy=False):
+        fft = cupy.sqrt(self.halfPower(returnCupy=True))
+        if returnCupy:
+            return fft
+        else:
+            return cupy.asnumpy(fft)
+
+    def halfSpectrum(self, returnCupy=False):
+        if self._halfSpectrum is None:
+            self.updateHalfPower()
+        if returnCupy:
+            return self._halfSpectrum
+        else:
+            return cupy.asnumpy(self._halfSpectrum)
+
+    def displayImage(self, width, height):
+        return cupy.asnumpy(DisplayPreparation.prepareImage(self._image, width, height))
+
+    def displayFft(self, width, height, usingRealFft=False, logScale=True):
+        fft = self.halfFft(returnCupy=True) if usingRealFft else self.fft(returnCupy=True)
+        return cupy.asnumpy(DisplayPreparation.prepareSpectrum(fft, width, height, logScale))
+
     def setImage(self, image):
         self._fft = None
+        self._halfPower = None
+        self._halfSpectrum = None
         self._histogram = None
         self._image = cupy.asarray(image)
 
     def updateHistogram(self):
         binEdges = cupy.arange(2**self.bitDepth + 1)
-        self._histogram = cupy.histogram(self._image, bins=binEdges)
+        if self._image.dtype.kind in 'ui':
+            self._histogram = (HistogramEqualisation.histogram(self._image, self.bitDepth), binEdges)
+        else:
+            self._histogram = cupy.histogram(self._image, bins=binEdges)
         
-    def updateFft(self):
+    def updateFft(self, out=None):
+        if self.engine:
+            self._fft = self.engine.fft(self._image, out)
+            return
         fft = cupy.fft.fft2(self._image)
-        fft = cupy.fft.fftshift(fft)
-        fft = cupy.abs(fft)
+        if out is None:
+            fft = cupy.fft.fftshift(fft)
+            fft = cupy.abs(fft)
+        else:
+            fft = FftEngine.shiftedAbs(fft, out, (0, 1))
         self._fft = fft
 
-    def applyHann(self):
+    def updateHalfPower(self, out=None):
+        if self.engine:
+            self._halfSpectrum = self.engine.rfft2(self._image)
+            self._halfPower = self.engine.halfPowerOf(self._halfSpectrum, out)
+            return
+        fft = cupy.fft.rfft2(self._image.astype('float32', copy=False))
+        if out is None:
+            power = cupy.square(fft.real)
+            power += cupy.square(fft.imag)
+            power = cupy.fft.fftshift(power, axes=0)
+        else:
+            power = FftEngine.shiftedAbs(fft, out, (0,), squared=True)
+        self._halfSpectrum = fft
+        self._halfPower = power
+
+    def applyHann(self, out=None):
         width = self._image.shape[0]
         height = self._image.shape[1]
-        row = cupy.hanning(width)
-        col = cupy.hanning(height)
-        window = cupy.outer(row, col)
-        window = cupy.sqrt(window)
-        image = cupy.multiply(window, self._image)
+        window = MatrixWindows.hann(width, height, returnCupy=True)
+        if out is None and self.engine:
+            out = self.engine.buffer('windowed')
+        image = cupy.multiply(window, self._image, out=out)
         self.setImage(image)
 
-    def applyHistogramEqualisation(self):
+    def applyHistogramEqualisation(self, inPlace=False):
         if self._histogram is None:
             self.updateHistogram()
 
-        maxLevel = 2**self.bitDepth - 1
+        transferMap = HistogramEqualisation.transferMap(self._histogram[0], self.bitDepth)
+        image = self._image
+        if image.dtype.kind not in 'ui':
+            image = image.clip(0, 2**self.bitDepth - 1).astype(transferMap.dtype)
+        image = HistogramEqualisation.remap(image, transferMap, self._inPlaceOut(image, transferMap.dtype, inPlace))
+        self.setImage(image)
+
+    def applyHistogramEqualisationInTiles(self, tilesX=8, tilesY=8, clipLimit=2.0, inPlace=False):
         dataType = 'uint{}'.format(self.bitDepth)
-        transferMap = cupy.cumsum(self._histogram[0])
-        transferMap = transferMap / transferMap.max()
-        transferMap = transferMap * maxLevel
-        transferMap = transferMap.round().astype(dataType)
-        gpuMap = cupy.ElementwiseKernel(
-            'T x, raw T y', 'T z',
-            'z = y[x]',
-            'gpuMap'
-        )
-        image = gpuMap(self._image, transferMap)
+        image = self._image
+        if image.dtype.kind not in 'ui':
+            image = image.clip(0, 2**self.bitDepth - 1).astype(dataType)
+        image = HistogramEqualisation.equaliseInTiles(image, tilesX, tilesY, clipLimit, self.bitDepth, self._inPlaceOut(image, dataType, inPlace))
         self.setImage(image)
 
+    def _inPlaceOut(self, image, dataType, inPlace):
+        if not inPlace or image.dtype != dataType:
+            return None
+        if isinstance(image, numpy.ndarray) and not image.flags.writeable:
+            return None
+        return image
+
 class SemImageNumpy:
 
-    def __init__(self, image=None):
+    def __init__(self, image=None, engine=None):
         self.bitDepth = 8
-        
+        self.engine = engine
+
         self._image = None
         self._fft = None
+        self._halfPower = None
+        self._halfSpectrum = None
         self._histogram = None
 
-        if image:
+        if image is not None:
             self.setImage(image)
 
     def image(self):
@@ -119,40 +214,98 @@ class SemImageNumpy:
             self.updateFft()
         return self._fft
 
+    def halfPower(self):
+        if self._halfPower is None:
+            self.updateHalfPower()
+        return self._halfPower
+
+    def halfFft(self):
+        return numpy.sqrt(self.halfPower())
+
+    def halfSpectrum(self):
+        if self._halfSpectrum is None:
+            self.updateHalfPower()
+        return self._halfSpectrum
+
+    def displayImage(self, width, height):
+        return DisplayPreparation.prepareImage(self._image, width, height)
+
+    def displayFft(self, width, height, usingRealFft=False, logScale=True):
+        fft = self.halfFft() if usingRealFft else self.fft()
+        return DisplayPreparation.prepareSpectrum(fft, width, height, logScale)
+
     def setImage(self, image):
         self._image = numpy.asarray(image)
         self._fft = None
+        self._halfPower = None
+        self._halfSpectrum = None
         self._histogram = None
 
     def updateHistogram(self):
         binEdges = numpy.arange(2**self.bitDepth + 1)
-        self._histogram = numpy.histogram(self._image, bins=binEdges)
+        if self._image.dtype.kind in 'ui':
+            self._histogram = (HistogramEqualisation.histogram(self._image, self.bitDepth), binEdges)
+        else:
+            self._histogram = numpy.histogram(self._image, bins=binEdges)
         
-    def updateFft(self):
+    def updateFft(self, out=None):
+        if self.engine:
+            self._fft = self.engine.fft(self._image, out)
+            return
         fft = numpy.fft.fft2(self._image)
-        fft = numpy.fft.fftshift(fft)
-        fft = numpy.abs(fft, order='C')
+        if out is None:
+            fft = numpy.fft.fftshift(fft)
+            fft = numpy.abs(fft, order='C')
+        else:
+            fft = FftEngine.shiftedAbs(fft, out, (0, 1))
         self._fft = fft
 
-    def applyHann(self):
+    def updateHalfPower(self, out=None):
+        if self.engine:
+            self._halfSpectrum = self.engine.rfft2(self._image)
+            self._halfPower = self.engine.halfPowerOf(self._halfSpectrum, out)
+            return
+        fft = realFft.rfft2(self._image.astype('float32', copy=False))
+        if out is None:
+            power = numpy.square(fft.real)
+            power += numpy.square(fft.imag)
+            power = numpy.fft.fftshift(power, axes=0)
+        else:
+            power = FftEngine.shiftedAbs(fft, out, (0,), squared=True)
+        self._halfSpectrum = fft
+        self._halfPower = power
+
+    def applyHann(self, out=None):
         width = self._image.shape[0]
         height = self._image.shape[1]
-        row = numpy.hanning(width)
-        col = numpy.hanning(height)
-        window = numpy.outer(row, col)
-        window = numpy.sqrt(window)
-        image = numpy.multiply(window, self._image, order='C')
+        window = MatrixWindows.hann(width, height)
+        if out is None and self.engine:
+            out = self.engine.buffer('windowed')
+        image = numpy.multiply(window, self._image, out=out)
         self.setImage(image)
 
-    def applyHistogramEqualisation(self):
+    def applyHistogramEqualisation(self, inPlace=False):
         if self._histogram is None:
             self.updateHistogram()
 
-        maxLevel = 2**self.bitDepth - 1
+        transferMap = HistogramEqualisation.transferMap(self._histogram[0], self.bitDepth)
+        image = self._image
+        if image.dtype.kind not in 'ui':
+            image = image.clip(0, 2**self.bitDepth - 1).astype(transferMap.dtype)
+        image = HistogramEqualisation.remap(image, transferMap, self._inPlaceOut(image, transferMap.dtype, inPlace))
+        self.setImage(image)
+
+    def applyHistogramEqualisationInTiles(self, tilesX=8, tilesY=8, clipLimit=2.0, inPlace=False):
         dataType = 'uint{}'.format(self.bitDepth)
-        transferMap = numpy.cumsum(self._histogram[0])
-        transferMap = transferMap / transferMap.max()
-        transferMap = transferMap * maxLevel
-        transferMap = transferMap.round().astype(dataType)
-        image = numpy.asarray(list(map(lambda x: transferMap[x], self._image)))
+        image = self._image
+        if image.dtype.kind not in 'ui':
+            image = image.clip(0, 2**self.bitDepth - 1).astype(dataType)
+        image = HistogramEqualisation.equaliseInTiles(image, tilesX, tilesY, clipLimit, self.bitDepth, self._inPlaceOut(image, dataType, inPlace))
         self.setImage(image)
+
+    def _inPlaceOut(self, image, dataType, inPlace):
+        if not inPlace or image.dtype != dataType:
+            return None
+        if isinstance(image, numpy.ndarray) and not image.flags.writeable:
+            return None
+        return image
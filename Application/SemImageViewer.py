@@ -3,6 +3,10 @@
 # Author:   Liuchuyao Xu, 2020
 
 import os
+import time
+import numpy
+import logging
+import concurrent.futures
 from functools import partial
 from PIL import Image
 from PySide2 import QtCharts
@@ -10,11 +14,21 @@ from PySide2 import QtGui
 from PySide2 import QtCore
 from PySide2 import QtWidgets
 
+import FftEngine
+from CommandQueue import CommandQueue
+from DriftTracker import DriftTracker
+from FramePipeline import FramePipeline
+from Instrumentation import instrumentation
+from ImageSequence import ImageSequence
+from SessionRecorder import SessionPlayback
+from SessionRecorder import SessionRecorder
 from SemImage import SemImage
 
+logger = logging.getLogger('SemImageViewer')
+
 class SemImageViewer(QtWidgets.QWidget):
 
-    _updated = QtCore.Signal()
+    _analysed = QtCore.Signal()
 
     def __init__(self):
         super().__init__()
@@ -23,15 +37,49 @@ class SemImageViewer(QtWidgets.QWidget):
         self._image = None
         self.continuouslyUpdating = False
 
+        # Local images are replayed from an ImageSequence of the tif files in localImagesFolder.
         self.usingLocalImages = True
         self._localImages = None
-        self._localImagesIndex = 0
         self.localImagesFolder = '...'
+        self.replayRate = 0.0 # In frames per second, 0 for as fast as possible.
+        self.replayLooping = True
+        self.replayPrefetchFrames = 8
+        self.replayMemoryMapping = True
+        self.replaySeekFrame = 0
+
+        # Continuous updating records the frames it grabs into a new session folder in recordingFolder.
+        # A session folder can be replayed like a folder of local images.
+        self.recording = False
+        self.recordingFolder = 'Sessions'
+        self._recorder = None
 
         self.imagePlotOn = True
         self.fftPlotOn = False
         self.histogramPlotOn = False
 
+        self.usingRealFft = False
+        self.usingFftEngine = True
+        self.logScalingFft = True
+        self.equalisingHistogram = False
+        self.equalisingHistogramInTiles = False
+
+        # Each analysed frame is given to driftTracker, which reuses its half spectrum to measure the drift.
+        # In continuous updating the spectra are computed by the analysis workers and the frames are given
+        # in the order they were grabbed, with the time they were grabbed.
+        self.trackingDrift = False
+        self.driftTracker = DriftTracker()
+
+        # Continuous updating runs a FramePipeline, frames are grabbed and analysed in other threads
+        # and the plots show the latest analysed frame.
+        self.pipelineCapacity = 4
+        self.analysisWorkers = 2
+        self.framesPerSecond = 0.0
+        self.analysedFramesPerSecond = 0.0
+        self.displayedFramesPerSecond = 0.0
+        self.queueDepth = 0
+        self.droppedFrames = 0
+        self._pipeline = None
+
         self.imagePlot = ImagePlot()
         self.imagePlot.closed.connect(partial(setattr, self, 'imagePlotOn', False))
         self.fftPlot = FftPlot()
@@ -39,57 +87,163 @@ class SemImageViewer(QtWidgets.QWidget):
         self.histogramPlot = HistogramPlot()
         self.histogramPlot.closed.connect(partial(setattr, self, 'histogramPlotOn', False))
 
-        self._updated.connect(self.grabAndUpdate, QtCore.Qt.QueuedConnection)
+        self._analysed.connect(self.showLatestFrame, QtCore.Qt.QueuedConnection)
 
     def grabAndUpdate(self):
         self.grabImage()
         self.updatePlots()
-        if self.continuouslyUpdating:
-            self._updated.emit()
 
     def grabImage(self):
+        frame = self.grabFrame()
+        if frame is not None:
+            self._image = self.createSemImage(frame)
+
+    def grabFrame(self):
+        # Called from the acquisition thread in continuous updating.
+        if not self.hasSource():
+            return None
         if self.usingLocalImages:
-            if self._localImages is None:
-                print('SemImageViewer: no local images.')
-                return
-            if self._localImagesIndex >= len(self._localImages):
-                self._localImagesIndex = 0
-            path = os.path.join(self.localImagesFolder, self._localImages[self._localImagesIndex])
-            self._image = SemImage(Image.open(path))
-            self._localImagesIndex += 1
+            sequence = self._localImages
+            sequence.playbackRate = self.replayRate
+            sequence.looping = self.replayLooping
+            if isinstance(sequence, ImageSequence):
+                sequence.prefetchFrames = self.replayPrefetchFrames
+                sequence.memoryMapping = self.replayMemoryMapping
+            frame = sequence.next()
+            if frame is not None and self._recorder is not None:
+                self._recorder.record(frame, source=self.localImagesFolder)
+            return frame
+        # Grabs go ahead of the corrector's commands, and are cancelled when the updating stops.
+        try:
+            frame = self.sem.grabArray(priority=CommandQueue.highPriority)
+            if self._recorder is not None:
+                self.recordFrame(frame)
+        except concurrent.futures.CancelledError:
+            return None
+        return frame
+
+    def recordFrame(self, frame):
+        parameters = self.sem.getParameters(["AP_WD", "AP_STIG_X", "AP_STIG_Y", "AP_FRAME_TIME"], priority=CommandQueue.highPriority)
+        self._recorder.record(frame,
+            workingDistance=parameters["AP_WD"] * 1000, # In mm.
+            stigmatorX=parameters["AP_STIG_X"], # In per cent.
+            stigmatorY=parameters["AP_STIG_Y"], # In per cent.
+            frameTime=parameters["AP_FRAME_TIME"] / 1000) # In s.
+
+    def hasSource(self):
+        if self.usingLocalImages and self._localImages is None:
+            logger.warning('SemImageViewer: no local images.')
+            return False
+        if not self.usingLocalImages and self.sem is None:
+            logger.warning('SemImageViewer: no SEM.')
+            return False
+        return True
+
+    def analyseFrame(self, frame):
+        # Called from the analysis workers in continuous updating, everything but the drawing is done here.
+        with instrumentation.stage('analysis'):
+            semImage = self.createSemImage(frame)
+            prepared = self.prepareFrame(semImage)
+        if self.trackingDrift:
+            prepared['spectrum'] = self.driftTracker.spectrumOf(semImage)
+        return prepared
+
+    def trackFrame(self, frame, sequence, grabTime):
+        # Called by the pipeline with the analysed frames in the order they were grabbed.
+        if 'spectrum' in frame:
+            with instrumentation.stage('drift'):
+                self.driftTracker.updateSpectrum(*frame['spectrum'], grabTime, sequence)
+
+    def prepareFrame(self, semImage):
+        frame = {'semImage': semImage}
+        if self.imagePlotOn:
+            frame['image'] = self.imagePlot.prepareFrame(semImage)
+        if self.fftPlotOn:
+            frame['fft'] = self.fftPlot.prepareFrame(semImage, self.usingRealFft, self.logScalingFft)
+        if self.histogramPlotOn:
+            frame['histogram'] = self.histogramPlot.prepareFrame(semImage)
+        return frame
+
+    def showFrame(self, frame):
+        with instrumentation.stage('render'):
+            if 'image' in frame and self.imagePlotOn:
+                self.imagePlot.showFrame(frame['image'])
+                self.imagePlot.show()
+            if 'fft' in frame and self.fftPlotOn:
+                self.fftPlot.showFrame(frame['fft'])
+                self.fftPlot.show()
+            if 'histogram' in frame and self.histogramPlotOn:
+                self.histogramPlot.showFrame(frame['histogram'])
+                self.histogramPlot.show()
+
+    def showLatestFrame(self):
+        if self._pipeline is None:
+            return
+        frame = self._pipeline.takeLatest()
+        self.updateCounters()
+        if frame is None:
+            return
+        self._image = frame['semImage']
+        self.showFrame(frame)
+
+    def updateCounters(self):
+        self.framesPerSecond = self._pipeline.acquisitionRate.rate
+        self.analysedFramesPerSecond = self._pipeline.analysisRate.rate
+        self.displayedFramesPerSecond = self._pipeline.displayRate.rate
+        self.queueDepth = self._pipeline.queueDepth()
+        self.droppedFrames = self._pipeline.droppedFrames()
+
+    def startContinuousUpdating(self):
+        if not self.hasSource():
+            return
+        if self.recording:
+            self._recorder = SessionRecorder(os.path.join(self.recordingFolder, time.strftime('Viewer-%Y%m%d-%H%M%S')))
+        self._pipeline = FramePipeline(self.grabFrame, self.analyseFrame, self._analysed.emit, self.pipelineCapacity, self.analysisWorkers, self.trackFrame)
+        self._pipeline.start()
+        self.continuouslyUpdating = True
+
+    def stopContinuousUpdating(self):
+        if self._pipeline is not None:
+            if not self.usingLocalImages and self.sem is not None:
+                self.sem.cancelCommands(CommandQueue.highPriority)
+            self._pipeline.stop()
+            self.updateCounters()
+            self._pipeline = None
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
+        self.continuouslyUpdating = False
+
+    def createSemImage(self, image):
+        image = numpy.asarray(image)
+        if self.usingFftEngine:
+            semImage = SemImage(image, FftEngine.fftEngine(image.shape, onDevice=True))
         else:
-            if self.sem is None:
-                print('SemImageViewer: no SEM.')
-                return
-            self._image = SemImage(self.sem.grabImage())
+            semImage = SemImage(image)
+        if self.equalisingHistogramInTiles:
+            semImage.applyHistogramEqualisationInTiles(inPlace=True)
+        elif self.equalisingHistogram:
+            semImage.applyHistogramEqualisation(inPlace=True)
+        return semImage
 
     def updatePlots(self):
         if self._image is None:
-            print('SemImageViewer: no image.')
+            logger.warning('SemImageViewer: no image.')
             return
-        if self.imagePlotOn:
-            self.imagePlot.updateFrame(self._image)
-            self.imagePlot.show()
-        if self.fftPlotOn:
-            self.fftPlot.updateFrame(self._image)
-            self.fftPlot.show()
-        if self.histogramPlotOn:
-            self.histogramPlot.updateFrame(self._image)
-            self.histogramPlot.show()
+        self.showFrame(self.prepareFrame(self._image))
 
     def guiUpdatePlots(self):
         self.updatePlots()
 
     def guiUpdatePlotsContinuously(self):
         if not self.continuouslyUpdating:
-            self.continuouslyUpdating = True
-            self._updated.emit()
+            self.startContinuousUpdating()
         else:
-            self.continuouslyUpdating = False
+            self.stopContinuousUpdating()
 
     def guiBrowseForLocalImage(self):
         if self.continuouslyUpdating:
-            print('SemImageViewer: stop the continuous updating first.')
+            logger.warning('SemImageViewer: stop the continuous updating first.')
             return
         path = QtWidgets.QFileDialog.getOpenFileName()[0]
         if path:
@@ -99,20 +253,79 @@ class SemImageViewer(QtWidgets.QWidget):
 
     def guiBrowseForLocalImagesFolder(self):
         if self.continuouslyUpdating:
-            print('SemImageViewer: stop the continuous updating first.')
+            logger.warning('SemImageViewer: stop the continuous updating first.')
             return
         path = QtWidgets.QFileDialog.getExistingDirectory()
         if path:
-            self._localImages = QtCore.QDir(path).entryList(['*.tif'])
-            self._localImagesIndex = 0
+            if self._localImages is not None:
+                self._localImages.close()
+            if os.path.exists(os.path.join(path, 'index.jsonl')):
+                self._localImages = SessionPlayback(path)
+            else:
+                self._localImages = ImageSequence(path)
             self.localImagesFolder = path
+            if len(self._localImages) == 0:
+                logger.warning('SemImageViewer: no images in the folder.')
+
+    def guiSeekReplay(self):
+        if self._localImages is None:
+            logger.warning('SemImageViewer: no local images.')
+            return
+        self._localImages.seek(self.replaySeekFrame)
 
     def closeEvent(self, event):
+        self.stopContinuousUpdating()
+        if self._localImages is not None:
+            self._localImages.close()
         self.imagePlot.destroy()
         self.fftPlot.destroy()
         self.histogramPlot.destroy()
         event.accept()
 
+class FramePresenter:
+
+    # Keeps a uint8 or uint16 backing buffer with 32-bit aligned rows and a QImage over it.
+    # Each frame is copied into the buffer in place and the QImage is drawn scaled into the widget,
+    # the buffer and the QImage are only made again when the size or the depth of the frames changes.
+    def __init__(self):
+        self._storage = None
+        self._buffer = None
+        self._qtImage = None
+
+    def present(self, frame):
+        dataType = numpy.dtype('uint8') if frame.dtype == 'uint8' else numpy.dtype('uint16')
+        if self._buffer is None or self._buffer.shape != frame.shape or self._buffer.dtype != dataType:
+            self.allocate(frame.shape[1], frame.shape[0], dataType)
+        if frame.dtype == dataType:
+            numpy.copyto(self._buffer, frame)
+        else:
+            numpy.copyto(self._buffer, numpy.clip(frame, 0, numpy.iinfo(dataType).max), casting='unsafe')
+        return self._qtImage
+
+    def allocate(self, width, height, dataType):
+        # The buffer is a view of the pixels of the QImage itself, so that frames copied into it always reach the QImage.
+        if dataType == 'uint8':
+            format = QtGui.QImage.Format_Grayscale8
+        else:
+            format = QtGui.QImage.Format_Grayscale16
+        self._qtImage = QtGui.QImage(width, height, format)
+        self._qtImage.fill(0)
+        bytesPerLine = self._qtImage.bytesPerLine()
+        self._storage = numpy.frombuffer(self._qtImage.bits(), dtype=dataType, count=height * bytesPerLine // dataType.itemsize)
+        self._storage = self._storage.reshape(height, bytesPerLine // dataType.itemsize)
+        self._buffer = self._storage[:, :width]
+
+    def paint(self, widget):
+        if self._qtImage is None:
+            return
+        size = self._qtImage.size().scaled(widget.size(), QtCore.Qt.KeepAspectRatio)
+        target = QtCore.QRect(QtCore.QPoint(0, 0), size)
+        target.moveCenter(widget.rect().center())
+        with instrumentation.stage('paint'):
+            painter = QtGui.QPainter(widget)
+            painter.drawImage(target, self._qtImage)
+            painter.end()
+
 class ImagePlot(QtWidgets.QLabel):
     closed = QtCore.Signal()
 
@@ -123,13 +336,28 @@ class ImagePlot(QtWidgets.QLabel):
         self.setMinimumSize(512, 384)
         self.setWindowTitle('Image')
 
+        # Frames are reduced to about the size of the widget before they are drawn.
+        self.displayWidth = 512
+        self.displayHeight = 384
+        self.presenter = FramePresenter()
+
     def updateFrame(self, semImage):
-        image = semImage.image()
-        width = image.shape[1]
-        height = image.shape[0]
-        qtImage = QtGui.QImage(image, width, height, QtGui.QImage.Format_Grayscale8)
-        qtPixmap = QtGui.QPixmap(qtImage)
-        self.setPixmap(qtPixmap.scaled(self.size(), QtCore.Qt.KeepAspectRatio))
+        self.showFrame(self.prepareFrame(semImage))
+
+    def prepareFrame(self, semImage):
+        return semImage.displayImage(self.displayWidth, self.displayHeight)
+
+    def showFrame(self, image):
+        self.presenter.present(image)
+        self.update()
+
+    def paintEvent(self, event):
+        self.presenter.paint(self)
+
+    def resizeEvent(self, event):
+        self.displayWidth = event.size().width()
+        self.displayHeight = event.size().height()
+        super().resizeEvent(event)
 
     def closeEvent(self, event):
         event.accept()
@@ -145,13 +373,28 @@ class FftPlot(QtWidgets.QLabel):
         self.setMinimumSize(512, 384)
         self.setWindowTitle('FFT')
 
-    def updateFrame(self, semImage):
-        fft = semImage.fft().clip(0, 65535).astype('uint16')
-        width = fft.shape[1]
-        height = fft.shape[0]
-        qtImage = QtGui.QImage(fft, width, height, QtGui.QImage.Format_Grayscale16)
-        qtPixmap = QtGui.QPixmap(qtImage)
-        self.setPixmap(qtPixmap.scaled(self.size(), QtCore.Qt.KeepAspectRatio))
+        self.displayWidth = 512
+        self.displayHeight = 384
+        self.presenter = FramePresenter()
+
+    def updateFrame(self, semImage, usingRealFft=False, logScale=True):
+        self.showFrame(self.prepareFrame(semImage, usingRealFft, logScale))
+
+    def prepareFrame(self, semImage, usingRealFft=False, logScale=True):
+        # The half-plane of the real-input FFT is shown as it is, with the zero frequency on the left edge.
+        return semImage.displayFft(self.displayWidth, self.displayHeight, usingRealFft, logScale)
+
+    def showFrame(self, fft):
+        self.presenter.present(fft)
+        self.update()
+
+    def paintEvent(self, event):
+        self.presenter.paint(self)
+
+    def resizeEvent(self, event):
+        self.displayWidth = event.size().width()
+        self.displayHeight = event.size().height()
+        super().resizeEvent(event)
 
     def closeEvent(self, event):
         event.accept()
@@ -163,22 +406,89 @@ class HistogramPlot(QtCharts.QtCharts.QChartView):
     def __init__(self):
         super().__init__()
 
+        # Groups of reduction bins are summed into one point.
+        # averaging is 'none', 'running' for the mean of all frames since the last reset,
+        # or 'exponential' for a moving average giving the newest frame the weight decay.
         self.reduction = 8
+        self.averaging = 'none'
+        self.decay = 0.2
+        self.cumulative = False
+        self.logarithmic = False
 
         self.setAlignment(QtCore.Qt.AlignCenter)
         self.setMinimumSize(512, 384)
         self.setWindowTitle('Histogram')
 
+        # One series and its axes are kept and updated in place.
         self.chart = QtCharts.QtCharts.QChart()
+        self.chart.legend().hide()
+        self.series = QtCharts.QtCharts.QLineSeries()
+        self.chart.addSeries(self.series)
+        self.axisX = QtCharts.QtCharts.QValueAxis()
+        self.axisY = QtCharts.QtCharts.QValueAxis()
+        self.chart.addAxis(self.axisX, QtCore.Qt.AlignBottom)
+        self.chart.addAxis(self.axisY, QtCore.Qt.AlignLeft)
+        self.series.attachAxis(self.axisX)
+        self.series.attachAxis(self.axisY)
         self.setChart(self.chart)
 
+        self._points = None
+        self._average = None
+        self._averagedFrames = 0
+        self._averaging = self.averaging
+
     def updateFrame(self, semImage):
-        histogram = semImage.histogram()
-        series = QtCharts.QtCharts.QLineSeries()
-        for i in range(round(2**semImage.bitDepth / self.reduction)):
-            series.append(histogram[1][self.reduction*i], histogram[0][self.reduction*i])
-        self.chart.removeAllSeries()
-        self.chart.addSeries(series)
+        self.showFrame(self.prepareFrame(semImage))
+
+    def prepareFrame(self, semImage):
+        return semImage.histogram()
+
+    def showFrame(self, histogram):
+        values = self.displayValues(histogram[0])
+        levels = len(histogram[0])
+        if self._points is None or len(self._points) != len(values):
+            step = levels / len(values)
+            self._points = [QtCore.QPointF(i * step, 0) for i in range(len(values))]
+            self.axisX.setRange(0, levels)
+        for point, value in zip(self._points, values.tolist()):
+            point.setY(value)
+        self.series.replace(self._points)
+        self.axisY.setRange(0, max(float(values.max()), 1e-9) * 1.05)
+
+    def displayValues(self, counts):
+        reduction = max(1, self.reduction)
+        counts = numpy.asarray(counts, dtype='float64')
+        counts = counts[:len(counts) // reduction * reduction].reshape(-1, reduction).sum(axis=1)
+        values = self.averageCounts(counts)
+        if self.cumulative:
+            values = numpy.cumsum(values)
+            if values[-1] > 0:
+                values = values / values[-1]
+        if self.logarithmic:
+            values = numpy.log10(1 + values)
+        return values
+
+    def averageCounts(self, counts):
+        if self.averaging != self._averaging or self._average is None or len(self._average) != len(counts):
+            self._average = numpy.zeros(len(counts))
+            self._averagedFrames = 0
+            self._averaging = self.averaging
+        if self.averaging == 'running':
+            self._averagedFrames += 1
+            self._average += (counts - self._average) / self._averagedFrames
+        elif self.averaging == 'exponential':
+            if self._averagedFrames == 0:
+                self._average[...] = counts
+            else:
+                self._average += self.decay * (counts - self._average)
+            self._averagedFrames += 1
+        else:
+            return counts
+        return self._average
+
+    def guiResetAverage(self):
+        self._average = None
+        self._averagedFrames = 0
 
     def closeEvent(self, event):
         event.accept()
@@ -186,7 +496,9 @@ class HistogramPlot(QtCharts.QtCharts.QChartView):
 
 if __name__ == '__main__':
     from ObjectInspector import ObjectInspector
+    from Instrumentation import configureLogging
 
+    configureLogging()
     app = QtWidgets.QApplication()
     gui = ObjectInspector(SemImageViewer())
     gui.show()
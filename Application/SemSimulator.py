@@ -0,0 +1,177 @@
+#   File:   SemSimulator.py
+#
+#   Brief:  Implement the SemSimulator class.
+#           The class stands in for the ole control of the SEM, so that SemController, SemCorrector and SemImageViewer
+#           can be run without the microscope.
+#           Frames are synthesised by blurring a reference image with an astigmatic Gaussian probe,
+#           whose shape is set by the errors of the working distance and the stigmators.
+#
+#           Get returns the working distance in m and Set takes it in mm, the same as SemCorrector uses the ole control.
+#           The frame time is in ms and the stigmators are in per cent.
+#           The frame time is taken for a frame of fullFrameWidth by fullFrameHeight, smaller frames take proportionally less.
+#           Get and Set take callLatency each, like a round trip to the ole control, and are counted in getCalls and setCalls.
+
+import os
+import time
+import threading
+import numpy
+from PIL import Image
+
+class SemSimulator:
+
+    def __init__(self, referenceImagePath=None):
+        if referenceImagePath is None:
+            referenceImagePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Sample Images', 'Armin241.tif')
+        self.referenceImagePath = referenceImagePath
+
+        self.focusedWorkingDistance = 5.0 # In mm.
+        self.focusedStigmatorX = 0.0 # In per cent.
+        self.focusedStigmatorY = 0.0 # In per cent.
+
+        self.defocusBlur = 100.0 # In pixels per mm.
+        self.astigmatismBlur = 0.2 # In pixels per per cent.
+        self.probeBlur = 0.7 # In pixels.
+        self.noiseLevel = 2.0 # In grey levels.
+        self.seed = 0
+
+        self.simulatingFrameTime = True
+        self.fullFrameWidth = 1024
+        self.fullFrameHeight = 768
+        self.settleTime = 0.0 # In s, time constant of the response to a change of the working distance or stigmators.
+        self.callLatency = 0.0 # In s.
+        self.getCalls = 0
+        self.setCalls = 0
+
+        self._parameters = {
+            'AP_WD': 0.0052, # In m.
+            'AP_STIG_X': 2.0,
+            'AP_STIG_Y': -2.0,
+            'AP_FRAME_TIME': 100.0 # In ms.
+        }
+        self._previousParameters = dict(self._parameters)
+        self._changeTime = 0.0
+
+        self._reference = None
+        self._referenceKey = None
+        self._referenceFft = None
+        self._random = numpy.random.default_rng(self.seed)
+        self._lock = threading.RLock()
+
+    def InitialiseRemoting(self):
+        with self._lock:
+            image = Image.open(self.referenceImagePath)
+            self._reference = numpy.asarray(image.convert('L'), dtype='float32')
+            self._referenceKey = None
+            self._random = numpy.random.default_rng(self.seed)
+        return True
+
+    def Get(self, name, default=0.0):
+        self._simulateCall()
+        with self._lock:
+            self.getCalls += 1
+            if name not in self._parameters:
+                return (1, default)
+            return (0, self._parameters[name])
+
+    def Set(self, name, value):
+        self._simulateCall()
+        with self._lock:
+            self.setCalls += 1
+        value = float(value)
+        if name == 'AP_WD':
+            value = value / 1000
+        with self._lock:
+            if name not in self._parameters:
+                return 1
+            self._previousParameters = self._effectiveParameters()
+            self._changeTime = time.perf_counter()
+            self._parameters[name] = value
+        return 0
+
+    def Grab(self, x, y, width, height, reduction, filename):
+        frame = self.GrabArray(x, y, width, height, reduction)
+        Image.fromarray(frame).save(filename, format='BMP')
+        return 0
+
+    def GrabArray(self, x, y, width, height, reduction, out=None):
+        start = time.perf_counter()
+        with self._lock:
+            parameters = self._effectiveParameters()
+            referenceFft = self._referenceSpectrum(x, y, width, height, reduction)
+            noise = self._random.normal(0, self.noiseLevel, (referenceFft.shape[0], 2*(referenceFft.shape[1]-1)))
+
+        factor = 2**max(reduction, 0)
+        frameHeight = height // factor
+        frameWidth = width // factor
+
+        # The probe is a Gaussian with covariance M^2 + probeBlur^2,
+        # M = d * I + [[ax, ay], [ay, -ax]] for a defocus d and astigmatism ax, ay in pixels.
+        d = self.defocusBlur * (parameters['AP_WD'] * 1000 - self.focusedWorkingDistance) / factor
+        ax = self.astigmatismBlur * (parameters['AP_STIG_X'] - self.focusedStigmatorX) / factor
+        ay = self.astigmatismBlur * (parameters['AP_STIG_Y'] - self.focusedStigmatorY) / factor
+        p = self.probeBlur**2
+        sxx = (d + ax)**2 + ay**2 + p
+        syy = (d - ax)**2 + ay**2 + p
+        sxy = 2 * d * ay
+
+        fy = numpy.fft.fftfreq(referenceFft.shape[0]).astype('float32')[:, None]
+        fx = numpy.fft.rfftfreq(2*(referenceFft.shape[1]-1)).astype('float32')[None, :]
+        transfer = numpy.exp(-2 * numpy.pi**2 * (sxx*fx*fx + 2*sxy*fx*fy + syy*fy*fy))
+        frame = numpy.fft.irfft2(referenceFft * transfer, s=noise.shape)
+        frame = frame[:frameHeight, :frameWidth] + noise[:frameHeight, :frameWidth]
+
+        if out is None:
+            out = numpy.empty((frameHeight, frameWidth), dtype='uint8')
+        numpy.clip(frame, 0, 255, out=frame)
+        numpy.rint(frame, out=frame)
+        out[...] = frame
+
+        if self.simulatingFrameTime:
+            frameTime = parameters['AP_FRAME_TIME'] / 1000 * frameWidth * frameHeight / (self.fullFrameWidth * self.fullFrameHeight)
+            remaining = frameTime - (time.perf_counter() - start)
+            if remaining > 0:
+                time.sleep(remaining)
+        return out
+
+    def _simulateCall(self):
+        if self.callLatency > 0:
+            time.sleep(self.callLatency)
+
+    def _effectiveParameters(self):
+        if self.settleTime <= 0:
+            return dict(self._parameters)
+        decay = numpy.exp(-(time.perf_counter() - self._changeTime) / self.settleTime)
+        parameters = {}
+        for name, value in self._parameters.items():
+            parameters[name] = value + (self._previousParameters[name] - value) * decay
+        return parameters
+
+    def _referenceSpectrum(self, x, y, width, height, reduction):
+        if self._reference is None:
+            self.InitialiseRemoting()
+        key = (x, y, width, height, reduction)
+        if key != self._referenceKey:
+            # The raster wraps around the reference image if it is larger than the image.
+            rows = numpy.arange(y, y + height) % self._reference.shape[0]
+            cols = numpy.arange(x, x + width) % self._reference.shape[1]
+            raster = self._reference[numpy.ix_(rows, cols)]
+            factor = 2**max(reduction, 0)
+            if factor > 1:
+                raster = raster[:height//factor*factor, :width//factor*factor]
+                raster = raster.reshape(height//factor, factor, width//factor, factor).mean(axis=(1, 3))
+            # Pad to even sizes so that irfft2 gives back the same shape.
+            padded = numpy.zeros((raster.shape[0] + raster.shape[0] % 2, raster.shape[1] + raster.shape[1] % 2), dtype='float32')
+            padded[:raster.shape[0], :raster.shape[1]] = raster
+            self._referenceFft = numpy.fft.rfft2(padded)
+            self._referenceKey = key
+        return self._referenceFft
+
+if __name__ == '__main__':
+    import sys
+    from PySide2 import QtWidgets
+    from ObjectInspector import ObjectInspector
+
+    app = QtWidgets.QApplication(sys.argv)
+    sims = ObjectInspector(SemSimulator())
+    sims.show()
+    sys.exit(app.exec_())
@@ -7,16 +7,25 @@
 from PySide2 import QtGui
 from PySide2 import QtWidgets
 
+from Instrumentation import configureLogging
+from Instrumentation import instrumentation
 from ObjectInspector import ObjectInspector
 from SemController import SemController
 from SemCorrector import SemCorrector
 from SemImageViewer import SemImageViewer
+from SemSimulator import SemSimulator
+from SessionRecorder import SessionPlayback
 
 class SemTool(QtWidgets.QWidget):
 
-    def __init__(self):
+    def __init__(self, simulating=False, replayFolder=None):
         super().__init__()
-        controller = SemController()
+        if replayFolder:
+            controller = SemController(SessionPlayback(replayFolder))
+        elif simulating:
+            controller = SemController(SemSimulator())
+        else:
+            controller = SemController()
         corrector = SemCorrector(controller)
         imageViewer = SemImageViewer()
         imageViewer.sem = controller
@@ -24,7 +33,11 @@ class SemTool(QtWidgets.QWidget):
         tab = QtWidgets.QTabWidget()
         tab.addTab(ObjectInspector(controller), 'Controller')
         tab.addTab(ObjectInspector(corrector), 'Corrector')
+        tab.addTab(ObjectInspector(corrector.focusEstimator), 'Focus Estimator')
         tab.addTab(ObjectInspector(imageViewer), 'Image Viewer')
+        tab.addTab(ObjectInspector(imageViewer.histogramPlot), 'Histogram')
+        tab.addTab(ObjectInspector(imageViewer.driftTracker), 'Drift')
+        tab.addTab(ObjectInspector(instrumentation), 'Timings')
 
         layout = QtWidgets.QBoxLayout(QtWidgets.QBoxLayout.TopToBottom, self)
         layout.addWidget(tab)
@@ -33,7 +46,17 @@ class SemTool(QtWidgets.QWidget):
         self.setWindowTitle('SemTool')
 
 if __name__ == '__main__':
+    import sys
+
+    logPath = None
+    if '--log' in sys.argv[:-1]:
+        logPath = sys.argv[sys.argv.index('--log') + 1]
+    configureLogging(path=logPath)
+
     app = QtWidgets.QApplication()
-    gui = SemTool()
+    replayFolder = None
+    if '--replay' in sys.argv[:-1]:
+        replayFolder = sys.argv[sys.argv.index('--replay') + 1]
+    gui = SemTool('--simulate' in sys.argv, replayFolder)
     gui.show()
     app.exec_()
@@ -0,0 +1,190 @@
+#   File:   SessionRecorder.py
+#
+#   Brief:  Implement the SessionRecorder class, which records frames and their settings into a session folder,
+#           and the SessionPlayback class, which plays a session back.
+#
+#           A session folder holds chunks of frames, frames-0000.npy, frames-0001.npy, ..., each a preallocated
+#           .npy stack of chunkFrames frames of one shape written through a memory map, and index.jsonl,
+#           which holds one line of JSON per frame with its chunk, its slot in the chunk, the time it was recorded
+#           and its metadata, such as workingDistance in mm, stigmatorX and stigmatorY in per cent,
+#           frameTime in s and the sector powers computed by SemCorrector, which also records nominalWorkingDistance,
+#           the setting the working distance of a frame of a focus pair was offset from.
+#           Recording a frame is a copy into the memory map, no image is encoded.
+#           A chunk left partly filled, by a change of the frames or by close, is rewritten to hold only its recorded frames.
+#
+#           SessionPlayback memory maps the chunks back, so a frame is read without decoding or copying.
+#           It is a source of frames like ImageSequence and a backend for SemController like SemSimulator.
+#           As a backend it gives the recorded frames in order whatever is set, and Get gives the recorded settings
+#           of the next frame, its nominal working distance if it has one, so a corrector replaying a session
+#           reads the settings it read when recording and should run with the settings it was recorded with.
+
+import os
+import glob
+import json
+import time
+import threading
+import numpy
+from PIL import Image
+
+class SessionRecorder:
+
+    def __init__(self, folder, chunkFrames=64):
+        self.folder = folder
+        self.chunkFrames = chunkFrames
+
+        os.makedirs(folder, exist_ok=True)
+        self._chunk = None
+        self._chunkName = None
+        self._chunkCount = len(glob.glob(os.path.join(glob.escape(folder), 'frames-*.npy')))
+        self._slot = 0
+        self._frames = 0
+        self._lock = threading.Lock()
+
+        indexPath = os.path.join(folder, 'index.jsonl')
+        if os.path.exists(indexPath):
+            with open(indexPath) as index:
+                self._frames = sum(1 for _ in index)
+        self._index = open(indexPath, 'a')
+
+    def __len__(self):
+        return self._frames
+
+    def record(self, frame, **metadata):
+        frame = numpy.asarray(frame)
+        with self._lock:
+            if self._chunk is None or self._slot >= self.chunkFrames or self._chunk.shape[1:] != frame.shape or self._chunk.dtype != frame.dtype:
+                self._newChunk(frame.shape, frame.dtype)
+            self._chunk[self._slot] = frame
+            entry = {'frame': self._frames, 'chunk': self._chunkName, 'slot': self._slot, 'time': time.time()}
+            entry.update(metadata)
+            self._index.write(json.dumps(entry) + '\n')
+            self._slot += 1
+            self._frames += 1
+            return entry['frame']
+
+    def close(self):
+        with self._lock:
+            self._closeChunk()
+            self._index.close()
+
+    def _newChunk(self, shape, dataType):
+        self._closeChunk()
+        self._chunkName = 'frames-{:04d}.npy'.format(self._chunkCount)
+        self._chunkCount += 1
+        path = os.path.join(self.folder, self._chunkName)
+        self._chunk = numpy.lib.format.open_memmap(path, mode='w+', dtype=dataType, shape=(self.chunkFrames,) + tuple(shape))
+        self._slot = 0
+        self._index.flush()
+
+    def _closeChunk(self):
+        if self._chunk is None:
+            return
+        chunk = self._chunk
+        self._chunk = None
+        chunk.flush()
+        if self._slot < len(chunk):
+            # The memory map is released before the file is replaced, which Windows requires.
+            path = os.path.join(self.folder, self._chunkName)
+            numpy.save(path + '.part', chunk[:self._slot])
+            del chunk
+            os.replace(path + '.part.npy', path)
+
+class SessionPlayback:
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.looping = True
+        self.playbackRate = 0.0 # In frames per second.
+
+        with open(os.path.join(folder, 'index.jsonl')) as index:
+            self._entries = [json.loads(line) for line in index if line.strip()]
+        self._chunks = {}
+        self._index = 0
+        self._nextTime = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def position(self):
+        return self._index
+
+    def seek(self, index):
+        with self._lock:
+            if not self._entries:
+                return
+            self._index = index % len(self._entries)
+            self._nextTime = None
+
+    def frame(self, index):
+        entry = self._entries[index]
+        if entry['chunk'] not in self._chunks:
+            self._chunks[entry['chunk']] = numpy.load(os.path.join(self.folder, entry['chunk']), mmap_mode='r')
+        return self._chunks[entry['chunk']][entry['slot']]
+
+    def metadata(self, index):
+        return self._entries[index]
+
+    def next(self):
+        # Give the next frame, or None at the end of a session that does not loop.
+        with self._lock:
+            if self._index >= len(self._entries):
+                if not self.looping or not self._entries:
+                    return None
+                self._index = 0
+            index = self._index
+            self._index += 1
+            frame = self.frame(index)
+        self._waitForPlayback()
+        return frame
+
+    def close(self):
+        with self._lock:
+            self._chunks.clear()
+
+    def _waitForPlayback(self):
+        if self.playbackRate <= 0:
+            self._nextTime = None
+            return
+        now = time.perf_counter()
+        if self._nextTime is not None and self._nextTime > now:
+            time.sleep(self._nextTime - now)
+            now = self._nextTime
+        self._nextTime = now + 1 / self.playbackRate
+
+    # Backend for SemController, in the units of the ole control.
+    def InitialiseRemoting(self):
+        return 0
+
+    def Get(self, name, default=0.0):
+        if not self._entries:
+            return (0, default)
+        entry = self._entries[self._index % len(self._entries)]
+        if name == 'AP_WD' and 'workingDistance' in entry:
+            return (0, entry.get('nominalWorkingDistance', entry['workingDistance']) / 1000) # In m.
+        if name == 'AP_STIG_X' and 'stigmatorX' in entry:
+            return (0, entry['stigmatorX'])
+        if name == 'AP_STIG_Y' and 'stigmatorY' in entry:
+            return (0, entry['stigmatorY'])
+        if name == 'AP_FRAME_TIME' and 'frameTime' in entry:
+            return (0, entry['frameTime'] * 1000) # In ms.
+        return (0, default)
+
+    def Set(self, name, value):
+        return 0
+
+    def Grab(self, x, y, width, height, reduction, path):
+        frame = self.next()
+        if frame is None:
+            return 1
+        Image.fromarray(numpy.asarray(frame)).save(path, format='BMP')
+        return 0
+
+    def GrabArray(self, x, y, width, height, reduction, out=None):
+        frame = self.next()
+        if frame is None:
+            return None
+        if out is None:
+            return frame
+        numpy.copyto(out, frame)
+        return out
@@ -0,0 +1,8 @@
+#   File:   conftest.py
+#
+#   Brief:  Put the modules of Application on the path of the tests, which import them the same way the modules import each other.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Application'))
@@ -0,0 +1,77 @@
+#   File:   test_CommandQueue.py
+#
+#   Brief:  Check the order, cancelling and owner thread of the commands of CommandQueue.
+
+import threading
+import concurrent.futures
+import pytest
+
+from CommandQueue import CommandQueue
+
+@pytest.fixture
+def queue():
+    queue = CommandQueue()
+    yield queue
+    queue.close()
+
+def blocked(queue):
+    # Keep the owner thread busy until the returned event is set, so that the next commands wait in the queue.
+    release = threading.Event()
+    started = threading.Event()
+    queue.submit(lambda: started.set() or release.wait())
+    started.wait()
+    return release
+
+def testCommandsRunByPriorityThenInOrder(queue):
+    order = []
+    release = blocked(queue)
+    futures = [queue.submit(order.append, 'low', priority=CommandQueue.lowPriority),
+               queue.submit(order.append, 'normal 1'),
+               queue.submit(order.append, 'high', priority=CommandQueue.highPriority),
+               queue.submit(order.append, 'normal 2')]
+    release.set()
+    concurrent.futures.wait(futures)
+    assert order == ['high', 'normal 1', 'normal 2', 'low']
+
+def testCommandsRunOnTheOwnerThread(queue):
+    thread = queue.call(threading.current_thread)
+    assert thread is not threading.current_thread()
+    assert queue.call(threading.current_thread) is thread
+    # A command calling another runs it at once instead of waiting for itself.
+    assert queue.call(lambda: queue.call(queue.onOwnerThread))
+
+def testExceptionsReachTheCaller(queue):
+    with pytest.raises(ZeroDivisionError):
+        queue.call(lambda: 1 / 0)
+    assert queue.call(lambda: 1) == 1
+
+def testCancelByPriority(queue):
+    release = blocked(queue)
+    normal = queue.submit(lambda: 'normal')
+    high = queue.submit(lambda: 'high', priority=CommandQueue.highPriority)
+    assert queue.cancel(CommandQueue.normalPriority) == 1
+    release.set()
+    assert high.result() == 'high'
+    assert normal.cancelled()
+    with pytest.raises(concurrent.futures.CancelledError):
+        normal.result()
+
+def testCancelByThread(queue):
+    # Only the commands submitted by the thread are cancelled, those of other threads still run.
+    release = blocked(queue)
+    mine = queue.submit(lambda: 'mine')
+    others = []
+    thread = threading.Thread(target=lambda: others.append(queue.submit(lambda: 'other')))
+    thread.start()
+    thread.join()
+    assert queue.cancel(CommandQueue.normalPriority, threading.current_thread()) == 1
+    release.set()
+    assert mine.cancelled()
+    assert others[0].result() == 'other'
+
+def testClosedQueueRefusesCommands():
+    queue = CommandQueue()
+    queue.call(lambda: None)
+    queue.close()
+    with pytest.raises(RuntimeError):
+        queue.submit(lambda: None)
@@ -0,0 +1,81 @@
+#   File:   test_DriftTracker.py
+#
+#   Brief:  Check the drifts measured by DriftTracker on shifted copies of a smooth random image.
+
+import numpy
+import pytest
+
+from DriftTracker import DriftTracker
+from SemImage import SemImage
+
+shape = (96, 128)
+
+def shifted(x, y):
+    # A smooth random image shifted by x, y pixels, right and down, through its spectrum so that the shift may be fractional.
+    rng = numpy.random.default_rng(0)
+    spectrum = numpy.fft.fft2(rng.normal(size=shape))
+    fy = numpy.fft.fftfreq(shape[0])[:, None]
+    fx = numpy.fft.fftfreq(shape[1])[None, :]
+    spectrum *= numpy.exp(-(fx**2 + fy**2) / (2 * 0.08**2))
+    spectrum *= numpy.exp(-2j * numpy.pi * (fx * x + fy * y))
+    image = numpy.fft.ifft2(spectrum).real
+    image = (image - image.min()) / (image.max() - image.min()) * 200 + 20
+    return SemImage(image.astype('uint8'))
+
+@pytest.mark.parametrize('x, y', [(3, -2), (0.4, 0), (-1.5, 2.25)])
+def testDrift(x, y):
+    tracker = DriftTracker()
+    assert tracker.update(shifted(0, 0)) is None
+    entry = tracker.update(shifted(x, y))
+    assert entry['driftX'] == pytest.approx(x, abs=0.15)
+    assert entry['driftY'] == pytest.approx(y, abs=0.15)
+    assert tracker.reliable
+
+def testPositionIsTheSumOfTheDrifts():
+    tracker = DriftTracker()
+    for x in range(4):
+        tracker.update(shifted(x, -x))
+    assert tracker.position() == pytest.approx((3, -3), abs=0.1)
+    assert len(tracker.history()) == 3
+
+def testComparingWithReference():
+    tracker = DriftTracker()
+    tracker.comparingWithReference = True
+    tracker.update(shifted(0, 0))
+    tracker.update(shifted(2, 0))
+    entry = tracker.update(shifted(3, 1))
+    assert tracker.position() == pytest.approx((3, 1), abs=0.1)
+    assert (entry['driftX'], entry['driftY']) == pytest.approx((1, 1), abs=0.1)
+
+def testSkippedAndLateFrames():
+    tracker = DriftTracker()
+    tracker.update(shifted(0, 0), sequence=0)
+    tracker.update(shifted(4, 0), sequence=2)
+    assert tracker.driftPerFrame == pytest.approx(2, abs=0.1)
+    # A frame older than the previous one is ignored.
+    assert tracker.update(shifted(1, 0), sequence=1) is None
+    assert tracker.position() == pytest.approx((4, 0), abs=0.1)
+
+def testStability():
+    tracker = DriftTracker()
+    tracker.update(shifted(0, 0))
+    for _ in range(tracker.stableFrames):
+        assert not tracker.stable
+        tracker.update(shifted(0, 0))
+    assert tracker.stable
+    tracker.update(shifted(2, 0))
+    assert not tracker.stable
+
+def testFeaturelessFramesAreNotReliable():
+    tracker = DriftTracker()
+    flat = numpy.full(shape, 100, dtype='uint8')
+    tracker.update(SemImage(flat))
+    tracker.update(SemImage(flat))
+    assert not tracker.reliable
+
+def testNewShapeStartsAgain():
+    tracker = DriftTracker()
+    tracker.update(shifted(0, 0))
+    tracker.update(shifted(1, 0))
+    assert tracker.update(SemImage(numpy.zeros((48, 64), dtype='uint8'))) is None
+    assert tracker.position() == (0.0, 0.0)
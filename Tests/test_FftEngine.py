@@ -0,0 +1,66 @@
+#   File:   test_FftEngine.py
+#
+#   Brief:  Check the transforms of FftEngine against numpy.fft and the handing out of its pooled buffers.
+
+import threading
+import numpy
+import pytest
+
+import FftEngine
+
+shapes = [(48, 64), (49, 65), (3, 48, 64), (2, 49, 64)]
+
+def image(shape):
+    return numpy.random.default_rng(0).uniform(0, 255, shape).astype('float32')
+
+@pytest.mark.parametrize('shape', shapes)
+def testFft(shape):
+    frames = image(shape)
+    engine = FftEngine.FftEngine(shape)
+    expected = numpy.abs(numpy.fft.fftshift(numpy.fft.fft2(frames), axes=(-2, -1)))
+    numpy.testing.assert_allclose(engine.fft(frames), expected, rtol=1e-4, atol=expected.max() * 1e-6)
+
+@pytest.mark.parametrize('shape', shapes)
+def testHalfPower(shape):
+    frames = image(shape)
+    engine = FftEngine.FftEngine(shape)
+    expected = numpy.abs(numpy.fft.fftshift(numpy.fft.rfft2(frames), axes=-2))**2
+    numpy.testing.assert_allclose(engine.halfPower(frames), expected, rtol=1e-3, atol=expected.max() * 1e-7)
+
+def testShiftedAbsMatchesFftshift():
+    spectrum = numpy.random.default_rng(0).normal(size=(5, 7)) + 1j * numpy.random.default_rng(1).normal(size=(5, 7))
+    out = numpy.empty((5, 7))
+    FftEngine.shiftedAbs(spectrum, out, (0, 1))
+    numpy.testing.assert_allclose(out, numpy.abs(numpy.fft.fftshift(spectrum)))
+    FftEngine.shiftedAbs(spectrum, out, (0,), squared=True)
+    numpy.testing.assert_allclose(out, numpy.abs(numpy.fft.fftshift(spectrum, axes=0))**2)
+
+def testBuffersAreHandedOutInTurn():
+    engine = FftEngine.FftEngine((48, 64))
+    buffers = [engine.buffer('test') for _ in range(engine.poolSize + 1)]
+    assert len({id(buffer) for buffer in buffers[:engine.poolSize]}) == engine.poolSize
+    assert buffers[engine.poolSize] is buffers[0]
+
+def testResultsStayValidForFollowingFrames():
+    shape = (48, 64)
+    engine = FftEngine.FftEngine(shape)
+    first = image(shape)
+    halfSpectrum = engine.rfft2(first)
+    fft = engine.fft(first)
+    expectedHalf = halfSpectrum.copy()
+    expectedFft = fft.copy()
+    for _ in range(engine.poolSize - 1):
+        engine.rfft2(first * 2)
+        engine.fft(first * 2)
+    numpy.testing.assert_array_equal(halfSpectrum, expectedHalf)
+    numpy.testing.assert_array_equal(fft, expectedFft)
+
+def testEnginesAreKeptPerThread():
+    engine = FftEngine.fftEngine((48, 64))
+    assert FftEngine.fftEngine((48, 64)) is engine
+    assert FftEngine.fftEngine((49, 64)) is not engine
+    others = []
+    thread = threading.Thread(target=lambda: others.append(FftEngine.fftEngine((48, 64))))
+    thread.start()
+    thread.join()
+    assert others[0] is not engine
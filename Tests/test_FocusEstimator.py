@@ -0,0 +1,59 @@
+#   File:   test_FocusEstimator.py
+#
+#   Brief:  Check FocusEstimator and the corrections of SemCorrector with it against SemSimulator,
+#           whose calibration matches the defaults of the estimator.
+
+import pytest
+
+from SemController import SemController
+from SemCorrector import SemCorrector
+from SemSimulator import SemSimulator
+
+focusedWorkingDistance = 5.0 # In mm.
+
+def simulatedCorrector(wdError, sxError, syError):
+    simulator = SemSimulator()
+    simulator.simulatingFrameTime = False
+    sem = SemController(simulator)
+    sem.setParameter('AP_WD', focusedWorkingDistance + wdError)
+    sem.setParameter('AP_STIG_X', sxError)
+    sem.setParameter('AP_STIG_Y', syError)
+    corrector = SemCorrector(sem)
+    corrector.frameWaitTimeFactor = 0
+    corrector.usingFocusEstimator = True
+    return corrector
+
+def estimate(corrector):
+    wd = corrector.sem.getParameter('AP_WD') * 1000
+    offset = corrector.workingDistanceOffset
+    powersUf, powersOf = corrector.measureFocusPair(wd, 0.0, offset=offset)
+    height, width = powersUf.frameShape
+    return corrector.focusEstimator.estimate(powersUf.polarPowers, powersOf.polarPowers, width, height, offset)
+
+@pytest.mark.parametrize('wdError, sxError, syError', [(0.02, -6, 0), (-0.02, 0, 6), (0.01, 4, 4), (0.0, 0, 0)])
+def testEstimatesNearFocus(wdError, sxError, syError):
+    result = estimate(simulatedCorrector(wdError, sxError, syError))
+    assert result.confidence >= 0.9
+    assert result.workingDistance == pytest.approx(wdError, abs=0.005)
+    assert result.stigmatorX == pytest.approx(sxError, abs=1.0)
+    assert result.stigmatorY == pytest.approx(syError, abs=1.0)
+
+@pytest.mark.parametrize('wdError, sxError', [(0.08, -8), (-0.08, 6), (0.2, 0), (-0.2, 0)])
+def testNotConfidentFarFromFocus(wdError, sxError):
+    assert estimate(simulatedCorrector(wdError, sxError, 0)).confidence < 0.9
+
+@pytest.mark.parametrize('wdError, sxError, syError', [(0.08, -8, 0), (0.08, 6, 0), (-0.08, -8, 0), (-0.08, 6, 0), (0.04, 0, -6), (-0.04, 0, 6)])
+def testIterateConverges(wdError, sxError, syError):
+    corrector = simulatedCorrector(wdError, sxError, syError)
+    corrector.numberOfIterations = 8
+    corrector.iterate()
+    assert corrector.wdIterations[-1] == pytest.approx(focusedWorkingDistance, abs=0.005)
+    assert corrector.sxIterations[-1] == pytest.approx(0, abs=1.0)
+    assert corrector.syIterations[-1] == pytest.approx(0, abs=1.0)
+
+def testIterateStaysInFocus():
+    corrector = simulatedCorrector(0.0, 0.06, 0)
+    corrector.numberOfIterations = 3
+    corrector.iterate()
+    assert all(abs(wd - focusedWorkingDistance) <= 0.005 for wd in corrector.wdIterations)
+    assert all(abs(sx) <= 1.0 for sx in corrector.sxIterations)
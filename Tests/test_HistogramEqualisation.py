@@ -0,0 +1,56 @@
+#   File:   test_HistogramEqualisation.py
+#
+#   Brief:  Check the histograms, look-up tables and equalisations of HistogramEqualisation.
+
+import warnings
+import numpy
+import pytest
+
+import HistogramEqualisation
+
+def image(shape, bitDepth=8):
+    rng = numpy.random.default_rng(0)
+    return rng.integers(0, 2**bitDepth // 4, shape).astype('uint{}'.format(bitDepth))
+
+@pytest.mark.parametrize('bitDepth', [8, 16])
+def testHistogram(bitDepth):
+    frame = image((48, 64), bitDepth)
+    counts = HistogramEqualisation.histogram(frame, bitDepth)
+    assert counts.shape == (2**bitDepth,)
+    numpy.testing.assert_array_equal(counts, numpy.bincount(frame.ravel(), minlength=2**bitDepth))
+
+@pytest.mark.parametrize('bitDepth', [8, 16])
+def testEqualiseSpreadsTheLevels(bitDepth):
+    frame = image((48, 64), bitDepth)
+    equalised = HistogramEqualisation.equalise(frame, bitDepth)
+    assert equalised.dtype == frame.dtype
+    assert equalised.max() == 2**bitDepth - 1
+    # The look-up table keeps the order of the levels.
+    order = numpy.argsort(frame.ravel(), kind='stable')
+    assert numpy.all(numpy.diff(equalised.ravel()[order].astype('int64')) >= 0)
+
+def testEqualiseInPlace():
+    frame = image((48, 64))
+    expected = HistogramEqualisation.equalise(frame)
+    HistogramEqualisation.equalise(frame, out=frame)
+    numpy.testing.assert_array_equal(frame, expected)
+
+def testOneTileMatchesEqualise():
+    frame = image((48, 64))
+    tiled = HistogramEqualisation.equaliseInTiles(frame, 1, 1, clipLimit=0)
+    assert numpy.abs(tiled.astype('int64') - HistogramEqualisation.equalise(frame)).max() <= 1
+
+@pytest.mark.parametrize('shape, tiles', [((48, 64), (8, 8)), ((10, 10), (8, 8)), ((7, 100), (8, 8)), ((1, 5), (8, 8)), ((33, 17), (4, 6))])
+def testEqualiseInTilesHasNoEmptyTiles(shape, tiles):
+    # Tile sizes rounded up for these shapes would leave some tiles empty, whose maps divide by zero.
+    frame = image(shape)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        equalised = HistogramEqualisation.equaliseInTiles(frame, *tiles)
+    assert equalised.shape == shape
+    assert equalised.dtype == numpy.uint8
+
+def testEqualiseInTilesOfAConstantImage():
+    frame = numpy.full((48, 64), 100, dtype='uint8')
+    equalised = HistogramEqualisation.equaliseInTiles(frame)
+    assert len(numpy.unique(equalised)) == 1
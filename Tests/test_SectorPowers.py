@@ -0,0 +1,65 @@
+#   File:   test_SectorPowers.py
+#
+#   Brief:  Check the sector sums of SectorPowers against the masks of MatrixWindows.segmentMasks.
+
+import numpy
+import pytest
+
+import MatrixWindows
+import SectorPowers
+
+sizes = [(64, 48), (65, 49), (64, 49), (33, 64)]
+
+def spectra(width, height):
+    # A shifted power spectrum and its half-plane from a random image.
+    image = numpy.random.default_rng(0).normal(size=(height, width))
+    fft = numpy.fft.fftshift(numpy.abs(numpy.fft.fft2(image))**2)
+    halfFft = numpy.fft.fftshift(numpy.abs(numpy.fft.rfft2(image))**2, axes=0)
+    return fft, halfFft
+
+def sums(powers):
+    return [powers.total, powers.r12, powers.s12, powers.r34, powers.s34]
+
+def maskSums(fft, width, height, mask=True):
+    return [fft[mask].sum()] + [fft[segment & mask].sum() for segment in MatrixWindows.segmentMasks(width, height)]
+
+@pytest.mark.parametrize('width, height', sizes)
+def testMatchesMaskSums(width, height):
+    fft, halfFft = spectra(width, height)
+    expected = maskSums(fft, width, height)
+    assert sums(SectorPowers.sectorPowers(fft)) == pytest.approx(expected, rel=1e-9)
+    assert sums(SectorPowers.halfSectorPowers(halfFft, width)) == pytest.approx(expected, rel=1e-9)
+
+@pytest.mark.parametrize('width, height', sizes)
+def testRingsKeepTheCorners(width, height):
+    # Without a radius the outer ring reaches the corners, so the rings add up to the whole spectrum.
+    fft, halfFft = spectra(width, height)
+    for powers in (SectorPowers.sectorPowers(fft, radialBins=4), SectorPowers.halfSectorPowers(halfFft, width, radialBins=4)):
+        assert powers.table.shape == (4, 5)
+        assert powers.radialProfile.sum() == pytest.approx(fft.sum(), rel=1e-9)
+
+@pytest.mark.parametrize('width, height', sizes)
+def testRadiusLeavesOutTheOuterPixels(width, height):
+    fft, halfFft = spectra(width, height)
+    radius = min(width, height) / 3
+    rows, cols = numpy.ogrid[0:height, 0:width]
+    disc = (rows - (height - 1) / 2)**2 + (cols - (width - 1) / 2)**2 <= radius * radius
+    expected = maskSums(fft, width, height, disc)
+    assert sums(SectorPowers.sectorPowers(fft, radius)) == pytest.approx(expected, rel=1e-9)
+    assert sums(SectorPowers.halfSectorPowers(halfFft, width, radius)) == pytest.approx(expected, rel=1e-9)
+
+def testBatchMatchesSingleFrames():
+    width, height = 64, 48
+    ffts, halfFfts = zip(*(spectra(width, height) for _ in range(3)))
+    ffts = numpy.stack([fft * (i + 1) for i, fft in enumerate(ffts)])
+    halfFfts = numpy.stack([halfFft * (i + 1) for i, halfFft in enumerate(halfFfts)])
+    for single, batch in zip(ffts, SectorPowers.sectorPowersBatch(ffts, radialBins=2)):
+        numpy.testing.assert_allclose(batch.table, SectorPowers.sectorPowers(single, radialBins=2).table)
+    for single, batch in zip(halfFfts, SectorPowers.halfSectorPowersBatch(halfFfts, width, radialBins=2)):
+        numpy.testing.assert_allclose(batch.table, SectorPowers.halfSectorPowers(single, width, radialBins=2).table)
+
+def testDifferenceOfPowers():
+    fft, _ = spectra(64, 48)
+    a = SectorPowers.sectorPowers(fft)
+    b = SectorPowers.sectorPowers(fft * 3)
+    assert sums(b - a) == pytest.approx([2 * s for s in sums(a)])
@@ -0,0 +1,60 @@
+#   File:   test_SemCorrector.py
+#
+#   Brief:  Check that SemCorrector leaves the working distance of SemSimulator where it should when a run is interrupted.
+
+import concurrent.futures
+import pytest
+
+from SemController import SemController
+from SemCorrector import SemCorrector
+from SemSimulator import SemSimulator
+
+def simulatedCorrector(wd):
+    simulator = SemSimulator()
+    simulator.simulatingFrameTime = False
+    sem = SemController(simulator)
+    sem.setParameter('AP_WD', wd)
+    corrector = SemCorrector(sem)
+    corrector.frameWaitTimeFactor = 0
+    corrector.rasterWidth = 512
+    corrector.rasterHeight = 384
+    return corrector
+
+def failGrab(corrector, failing):
+    # Make the grab numbered failing raise as if it had been cancelled by stop.
+    grabArray = corrector.sem.grabArray
+    grabs = [0]
+    def grab(*args, **kwargs):
+        grabs[0] += 1
+        if grabs[0] == failing:
+            raise concurrent.futures.CancelledError()
+        return grabArray(*args, **kwargs)
+    corrector.sem.grabArray = grab
+
+def workingDistance(corrector):
+    corrector.sem.clearParameterCache()
+    return corrector.sem.getParameter('AP_WD') * 1000
+
+@pytest.mark.parametrize('pipelined', [False, True])
+@pytest.mark.parametrize('failing', [1, 2, 4])
+def testInterruptedPairRestoresTheWorkingDistance(pipelined, failing):
+    corrector = simulatedCorrector(5.2)
+    corrector.pipelined = pipelined
+    corrector.numberOfIterations = 4
+    failGrab(corrector, failing)
+    with pytest.raises(concurrent.futures.CancelledError):
+        corrector.iterate()
+    assert workingDistance(corrector) == pytest.approx(corrector.wdIterations[-1])
+
+def testInterruptedSeriesRestoresTheWorkingDistance():
+    corrector = simulatedCorrector(5.03)
+    failGrab(corrector, 2)
+    with pytest.raises(concurrent.futures.CancelledError):
+        corrector.focusThroughSeries()
+    assert workingDistance(corrector) == pytest.approx(5.03)
+
+def testSeriesMovesToThePeak():
+    corrector = simulatedCorrector(5.03)
+    peak = corrector.focusThroughSeries()
+    assert peak == pytest.approx(5.0, abs=0.01)
+    assert workingDistance(corrector) == pytest.approx(peak)
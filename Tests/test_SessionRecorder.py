@@ -0,0 +1,76 @@
+#   File:   test_SessionRecorder.py
+#
+#   Brief:  Check that SessionRecorder records sessions that SessionPlayback plays back unchanged.
+
+import os
+import numpy
+import pytest
+
+from SessionRecorder import SessionPlayback, SessionRecorder
+
+def frames(count, shape=(48, 64)):
+    rng = numpy.random.default_rng(0)
+    return [rng.integers(0, 256, shape, dtype='uint8') for _ in range(count)]
+
+def testRecordAndPlayBack(tmp_path):
+    recorded = frames(5) + frames(2, (24, 32))
+    recorder = SessionRecorder(str(tmp_path), chunkFrames=3)
+    for i, frame in enumerate(recorded):
+        assert recorder.record(frame, workingDistance=5.0 + i) == i
+    recorder.close()
+
+    playback = SessionPlayback(str(tmp_path))
+    assert len(playback) == len(recorded)
+    for i, frame in enumerate(recorded):
+        numpy.testing.assert_array_equal(playback.frame(i), frame)
+        assert playback.metadata(i)['workingDistance'] == 5.0 + i
+    playback.close()
+
+def testPartlyFilledChunksAreTrimmed(tmp_path):
+    # Chunks of 3 frames hold 3, 2 then, after the change of shape, 2 frames.
+    recorder = SessionRecorder(str(tmp_path), chunkFrames=3)
+    for frame in frames(5) + frames(2, (24, 32)):
+        recorder.record(frame)
+    recorder.close()
+    lengths = [len(numpy.load(str(tmp_path / name), mmap_mode='r')) for name in sorted(os.listdir(str(tmp_path))) if name.endswith('.npy')]
+    assert lengths == [3, 2, 2]
+
+def testRecordingIntoAnExistingSession(tmp_path):
+    first = frames(2)
+    recorder = SessionRecorder(str(tmp_path))
+    for frame in first:
+        recorder.record(frame)
+    recorder.close()
+    second = frames(3, (24, 32))
+    recorder = SessionRecorder(str(tmp_path))
+    assert len(recorder) == 2
+    for frame in second:
+        recorder.record(frame)
+    recorder.close()
+
+    playback = SessionPlayback(str(tmp_path))
+    for i, frame in enumerate(first + second):
+        numpy.testing.assert_array_equal(playback.frame(i), frame)
+
+def testPlaybackAsABackend(tmp_path):
+    recorder = SessionRecorder(str(tmp_path))
+    recorded = frames(2)
+    recorder.record(recorded[0], workingDistance=4.98, nominalWorkingDistance=5.0, stigmatorX=1.5, stigmatorY=-2.0, frameTime=0.5)
+    recorder.record(recorded[1], workingDistance=5.02, stigmatorX=1.5, stigmatorY=-2.0, frameTime=0.5)
+    recorder.close()
+
+    playback = SessionPlayback(str(tmp_path))
+    # Get gives the nominal working distance of the next frame in m, and its frame time in ms.
+    assert playback.Get('AP_WD') == (0, pytest.approx(0.005))
+    assert playback.Get('AP_STIG_X') == (0, 1.5)
+    assert playback.Get('AP_FRAME_TIME') == (0, 500.0)
+    out = numpy.empty((48, 64), dtype='uint8')
+    numpy.testing.assert_array_equal(playback.GrabArray(0, 0, 64, 48, 0, out), recorded[0])
+    assert playback.Get('AP_WD') == (0, pytest.approx(0.00502))
+    numpy.testing.assert_array_equal(playback.GrabArray(0, 0, 64, 48, 0), recorded[1])
+
+    # A looping session starts again, one that does not loop ends.
+    numpy.testing.assert_array_equal(playback.next(), recorded[0])
+    playback.looping = False
+    playback.next()
+    assert playback.next() is None